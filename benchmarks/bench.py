@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of ecopass on synthetic files (see generate.py).
+
+For every size and every case the benchmark runs in a fresh process and reports:
+- records/s and MB/s (of input)
+- the peak RSS of the process (and of its worker processes)
+
+Cases:
+- read_records: the original reader (one Python tuple per record)
+- read_records_table: the original conversion without the Parquet write: read_records tuples
+  turned into an Arrow table every 500k records (through a pandas DataFrame when pandas is installed)
+- scan_index: header scan only
+- read_batches: Arrow batches built from the memory map
+- read_batches_index: read_batches from a prebuilt sidecar index
+- convert: end-to-end CLI conversion to Parquet (sequential)
+- convert_workers: CLI conversion with --workers (one per core)
+- convert_pipeline: CLI conversion with --pipeline
+- convert_fixed: CLI conversion with --fixed-size-values
+
+The results are written as JSON to the results directory, with the version of ecopass and the git
+commit, and can be compared with a previous run to spot regressions:
+
+    python benchmarks/bench.py --sizes 10MB,100MB,1GB
+    python benchmarks/bench.py --sizes 100MB --compare benchmarks/results/<previous>.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from generate import generate_file, parse_size
+
+CASES = (
+    'read_records', 'read_records_table', 'scan_index', 'read_batches', 'read_batches_index', 'convert', 'convert_workers', 'convert_pipeline',
+    'convert_fixed',
+)
+DEFAULT_CASES = ('scan_index', 'read_batches', 'convert')
+
+# a case slower than the previous run by more than this ratio is reported as a regression
+REGRESSION_RATIO = 0.10
+
+
+#--------------------------------------------
+# one case (runs in its own process)
+#--------------------------------------------
+def run_case(case: str, path: str, header_size: int, alignment: int, workdir: str) -> Dict[str, Any]:
+    """
+    Run one case on a file and return the number of records and the elapsed time.
+    """
+    from ecopass.core.record_header import RecordHeader
+    from ecopass.core.record_index import index_path_for
+
+    #-------------------------------------------------------------------
+    # NumPy and pyarrow are imported on first use, load them before the timer
+    # so the Arrow cases aren't charged for the import (pyarrow also imports
+    # pandas, when it's installed, on its first pa.array of a NumPy array)
+    #-------------------------------------------------------------------
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute  # noqa: F401
+    pa.array(np.zeros(1))
+
+    records = 0
+    if case == 'read_batches_index':
+        with RecordHeader(filename=path, header_size=header_size, alignment=alignment) as record_header:
+            record_header.load_index()
+
+    start = time.perf_counter()
+    if case == 'read_records':
+        with RecordHeader(filename=path, header_size=header_size, alignment=alignment) as record_header:
+            for _ in record_header.read_records():
+                records += 1
+    elif case == 'read_records_table':
+        with RecordHeader(filename=path, header_size=header_size, alignment=alignment) as record_header:
+            rows = []
+            for row in record_header.read_records():
+                rows.append(row)
+                if len(rows) >= 500_000:
+                    records += _rows_table(rows, pa).num_rows
+                    rows = []
+            records += _rows_table(rows, pa).num_rows
+    elif case == 'scan_index':
+        with RecordHeader(filename=path, header_size=header_size, alignment=alignment) as record_header:
+            records = len(record_header.scan_index().offsets)
+    elif case in ('read_batches', 'read_batches_index'):
+        with RecordHeader(filename=path, header_size=header_size, alignment=alignment) as record_header:
+            if case == 'read_batches_index':
+                record_header.load_index(build=False)
+            for batch in record_header.read_batches():
+                records += batch.num_rows
+    else:
+        from ecopass.cli import main as cli_main
+        output = os.path.join(workdir, 'output')
+        shutil.rmtree(output, ignore_errors=True)
+        args = ['--input', path, '--output', output, '--header-size', str(header_size), '--alignment', str(alignment)]
+        if case == 'convert_workers':
+            args += ['--workers', str(os.cpu_count() or 1)]
+        elif case == 'convert_pipeline':
+            args += ['--pipeline']
+        elif case == 'convert_fixed':
+            args += ['--fixed-size-values']
+        with contextlib.redirect_stdout(io.StringIO()):
+            cli_main(args, standalone_mode=False)
+        with open(os.path.join(output, '_ecopass_checkpoint.json')) as f:
+            records = json.load(f)['records']
+        shutil.rmtree(output, ignore_errors=True)
+    seconds = time.perf_counter() - start
+
+    if case == 'read_batches_index':
+        os.remove(index_path_for(path))
+    return dict(records=records, seconds=seconds, peak_rss_mb=_peak_rss_mb())
+
+
+def _rows_table(rows: List[Tuple[int, bytes]], pa: Any) -> Any:
+    """
+    Arrow table of (rdw, value) tuples, built like the original CLI did.
+    """
+    schema = pa.schema([('rdw', pa.int32()), ('value', pa.binary())])
+    try:
+        import pandas as pd
+    except ImportError:
+        return pa.Table.from_arrays([pa.array([row[0] for row in rows]), pa.array([row[1] for row in rows])],
+                                    schema=schema)
+    return pa.Table.from_pandas(pd.DataFrame(rows, columns=['rdw', 'value']), schema=schema, preserve_index=False)
+
+
+def _peak_rss_mb() -> float:
+    """
+    Peak RSS of this process and of its worker processes in MB.
+    ru_maxrss of a new process starts at the RSS of its parent on Linux, so VmHWM is used for
+    this process when it is available.
+    """
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024   # ru_maxrss is in bytes on macOS, KB elsewhere
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return max(rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def _run_case_process(case: str, path: str, header_size: int, alignment: int, workdir: str) -> Dict[str, Any]:
+    """
+    Run a case in a new process, so the peak RSS only covers that case.
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run-case', case, '--file', path,
+        '--header-size', str(header_size), '--alignment', str(alignment), '--workdir', workdir,
+    ]
+    completed = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+#--------------------------------------------
+# compare with a previous run
+#--------------------------------------------
+def compare(results: List[Dict[str, Any]], previous: List[Dict[str, Any]]) -> List[str]:
+    """
+    Return a line for every case of both runs, flagging the ones slower by more than REGRESSION_RATIO.
+    """
+    before = {(r['case'], r['size']): r for r in previous}
+    lines = []
+    for result in results:
+        old = before.get((result['case'], result['size']))
+        if old is None:
+            continue
+        ratio = result['records_per_s'] / old['records_per_s'] - 1
+        flag = "  REGRESSION" if ratio < -REGRESSION_RATIO else ""
+        lines.append(f"{result['case']:<20} {result['size_label']:>8} {ratio:+7.1%} records/s{flag}")
+    return lines
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _version() -> str:
+    try:
+        from importlib.metadata import version
+        return version('ecopass')
+    except Exception:
+        return 'unknown'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark ecopass on synthetic files.")
+    parser.add_argument('--sizes', default='10MB,100MB', help="Comma-separated file sizes (e.g. 10MB,1GB,20GB).")
+    parser.add_argument('--cases', default=','.join(DEFAULT_CASES), help=f"Comma-separated cases among {', '.join(CASES)}.")
+    parser.add_argument('--header-size', type=int, default=2, choices=(2, 4))
+    parser.add_argument('--alignment', type=int, default=2)
+    parser.add_argument('--statuses', default="4:0.8,2:0.1,3:0.1")
+    parser.add_argument('--lengths', default="uniform:0:300")
+    parser.add_argument('--run-length', type=float, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per case (the fastest one is kept).")
+    parser.add_argument('--workdir', help="Directory of the generated files (kept between runs).")
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'))
+    parser.add_argument('--compare', help="Results file of a previous run to compare with.")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.file, args.header_size, args.alignment, args.workdir)))
+        return
+
+    cases = [case.strip() for case in args.cases.split(',')]
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(sorted(unknown))}")
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ecopass-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    for size_label in args.sizes.split(','):
+        size = parse_size(size_label)
+        #-------------------------------------------------------------------
+        # the generated files are reused by the next runs with the same options
+        #-------------------------------------------------------------------
+        name = (f"synthetic-{size_label}-h{args.header_size}-a{args.alignment}-{args.lengths}-{args.statuses}"
+                f"-r{args.run_length:g}.bin").replace(':', '_').replace(',', '_')
+        path = os.path.join(workdir, name)
+        if not os.path.exists(path):
+            print(f"Generating {path} ...", flush=True)
+            generate_file(path, size=size, header_size=args.header_size, alignment=args.alignment,
+                          statuses=args.statuses, lengths=args.lengths, run_length=args.run_length)
+        file_size = os.path.getsize(path)
+
+        for case in cases:
+            runs = [_run_case_process(case, path, args.header_size, args.alignment, workdir) for _ in range(args.repeat)]
+            best = min(runs, key=lambda run: run['seconds'])
+            result = dict(
+                case=case, size=file_size, size_label=size_label, records=best['records'],
+                seconds=round(best['seconds'], 4),
+                records_per_s=round(best['records'] / best['seconds']),
+                mb_per_s=round(file_size / 1024 / 1024 / best['seconds'], 1),
+                peak_rss_mb=round(max(run['peak_rss_mb'] for run in runs), 1),
+            )
+            results.append(result)
+            print(f"{case:<20} {size_label:>8} {result['records_per_s']:>14,} records/s "
+                  f"{result['mb_per_s']:>9,.1f} MB/s {result['peak_rss_mb']:>9,.1f} MB peak RSS", flush=True)
+
+    #-------------------------------------------------------------------
+    # save the results
+    #-------------------------------------------------------------------
+    commit = _git_commit()
+    report = dict(
+        date=datetime.now().isoformat(timespec='seconds'), version=_version(), commit=commit,
+        python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count(),
+        options=dict(header_size=args.header_size, alignment=args.alignment, statuses=args.statuses,
+                     lengths=args.lengths, run_length=args.run_length),
+        results=results,
+    )
+    os.makedirs(args.results, exist_ok=True)
+    path_results = os.path.join(args.results, f"{datetime.now():%Y%m%d-%H%M%S}-{commit or 'nogit'}.json")
+    with open(path_results, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {path_results}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f"\nCompared with {args.compare} ({previous.get('version')}, {previous.get('commit')}):")
+        for line in compare(results, previous['results']):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Generator of synthetic Micro Focus variable-record files, used by the benchmarks.
+
+The files are valid inputs for RecordHeader: every record is a 2 or 4-byte big-endian header
+(status in the first 4 bits, length in the remaining 12 or 28 bits), the record data (random
+bytes) and zero padding up to the alignment.
+
+The records are generated with NumPy in chunks, so files of tens of GB are written at disk speed
+with a bounded amount of memory:
+- statuses: drawn from a mix, e.g. "4:0.8,2:0.1,3:0.1" (status:weight)
+- lengths: "fixed:836", "uniform:0:300" (min:max) or "choice:120,836,2000"
+- run_length: mean number of consecutive records with the same length (1 = independent lengths),
+  like the files where records of the same type are written together
+
+Usage:
+    python benchmarks/generate.py file.bin --size 1GB --lengths uniform:0:300 --statuses 4:0.9,2:0.1
+"""
+import argparse
+import os
+from typing import Dict, Optional
+
+import numpy as np
+
+# largest length of a record for each header size
+MAX_LENGTH = {2: (1 << 12) - 1, 4: (1 << 28) - 1}
+
+_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+
+#--------------------------------------------
+# parse the command line values
+#--------------------------------------------
+def parse_size(value: str) -> int:
+    """
+    Parse a size like "500MB", "10GB" or "4096" into bytes.
+    """
+    value = value.strip().upper()
+    number = value.rstrip('KMGTB')
+    return int(float(number) * _UNITS[value[len(number):]])
+
+
+def parse_statuses(value: str) -> Dict[int, float]:
+    """
+    Parse a status mix like "4:0.8,2:0.2" into {status: weight}.
+    """
+    statuses = {}
+    for item in value.split(','):
+        status, _, weight = item.partition(':')
+        statuses[int(status)] = float(weight or 1)
+    if not all(0 <= status <= 15 for status in statuses):
+        raise ValueError("A status is between 0 and 15")
+    return statuses
+
+
+class LengthDistribution():
+    """
+    Distribution of the record lengths: "fixed:<n>", "uniform:<min>:<max>" or "choice:<n>,<n>,...".
+    """
+    def __init__(self, spec: str):
+        kind, _, args = spec.partition(':')
+        if kind == 'fixed':
+            self.values = np.array([int(args)])
+            self.low = self.high = None
+        elif kind == 'uniform':
+            low, high = args.split(':')
+            self.values = None
+            self.low, self.high = int(low), int(high)
+        elif kind == 'choice':
+            self.values = np.array([int(v) for v in args.split(',')])
+            self.low = self.high = None
+        else:
+            raise ValueError(f"Unknown length distribution {spec!r}, use fixed, uniform or choice")
+        self.spec = spec
+
+    @property
+    def max(self) -> int:
+        return int(self.values.max()) if self.values is not None else self.high
+
+    def draw(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        if self.values is not None:
+            return rng.choice(self.values, size=count)
+        return rng.integers(self.low, self.high + 1, size=count)
+
+
+#--------------------------------------------
+# generate the records of a chunk
+#--------------------------------------------
+def _chunk(rng: np.random.Generator, count: int, header_size: int, alignment: int,
+           statuses: Dict[int, float], lengths: LengthDistribution, run_length: float) -> bytes:
+    """
+    Return the bytes of `count` records.
+    """
+    #-------------------------------------------------------------------
+    # lengths: one draw per run of same-length records
+    #-------------------------------------------------------------------
+    if run_length > 1:
+        runs = rng.geometric(1 / run_length, size=count)
+        runs = runs[:int(np.searchsorted(np.cumsum(runs), count)) + 1]
+        record_lengths = np.repeat(lengths.draw(rng, len(runs)), runs)[:count]
+    else:
+        record_lengths = lengths.draw(rng, count)
+    record_lengths = record_lengths.astype(np.int64)
+
+    weights = np.array(list(statuses.values()), dtype=np.float64)
+    record_statuses = rng.choice(np.array(list(statuses), dtype=np.int64), size=count, p=weights / weights.sum())
+
+    padding = (alignment - (header_size + record_lengths) % alignment) % alignment
+    sizes = header_size + record_lengths + padding
+    starts = np.zeros(count, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+
+    #-------------------------------------------------------------------
+    # random data everywhere, then the headers and the zero padding
+    #-------------------------------------------------------------------
+    buffer = rng.integers(0, 256, size=int(sizes.sum()), dtype=np.uint8)
+    header = (record_statuses << (header_size * 8 - 4)) | record_lengths
+    for i in range(header_size):
+        buffer[starts + i] = (header >> (8 * (header_size - 1 - i))) & 0xFF
+    for i in range(alignment - 1):
+        padded = padding > i
+        buffer[(starts + header_size + record_lengths + i)[padded]] = 0
+    return buffer.tobytes()
+
+
+#--------------------------------------------
+# generate a file
+#--------------------------------------------
+def generate_file(path: str, size: Optional[int] = None, records: Optional[int] = None, header_size: int = 2,
+                  alignment: int = 2, statuses: str = "4:0.8,2:0.1,3:0.1", lengths: str = "uniform:0:300",
+                  run_length: float = 1, seed: int = 0, chunk_records: int = 1_000_000) -> int:
+    """
+    Write a synthetic file of about `size` bytes (it stops at the first record past it) or of
+    `records` records, and return the number of records written.
+    """
+    if header_size not in MAX_LENGTH:
+        raise ValueError("Only 2-byte or 4-byte headers are supported")
+    if size is None and records is None:
+        raise ValueError("Give the size or the number of records of the file")
+    distribution = LengthDistribution(lengths)
+    if distribution.max > MAX_LENGTH[header_size]:
+        raise ValueError(f"Records longer than {MAX_LENGTH[header_size]} bytes need 4-byte headers")
+    status_mix = parse_statuses(statuses)
+
+    rng = np.random.default_rng(seed)
+    written = count = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        while (size is None or written < size) and (records is None or count < records):
+            n = chunk_records if records is None else min(chunk_records, records - count)
+            data = _chunk(rng, n, header_size, alignment, status_mix, distribution, run_length)
+            if size is not None and written + len(data) > size:
+                #-------------------------------------------------------------------
+                # last chunk: keep the records up to the first one past the size
+                #-------------------------------------------------------------------
+                cut, kept = _cut(data, size - written, header_size, alignment)
+                data, n = data[:cut], kept
+            f.write(data)
+            written += len(data)
+            count += n
+    os.replace(tmp_path, path)
+    return count
+
+
+def _cut(data: bytes, limit: int, header_size: int, alignment: int):
+    """
+    Return the end of the first record ending at or after limit, and the number of records kept.
+    """
+    pos = count = 0
+    while pos < limit and pos < len(data):
+        length = int.from_bytes(data[pos:pos + header_size], 'big') & ((1 << (header_size * 8 - 4)) - 1)
+        pos += header_size + length
+        pos += (alignment - pos % alignment) % alignment
+        count += 1
+    return pos, count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Write a synthetic Micro Focus variable-record file.")
+    parser.add_argument('path')
+    parser.add_argument('--size', type=parse_size, help="Size of the file (e.g. 500MB, 10GB).")
+    parser.add_argument('--records', type=int, help="Number of records (instead of --size).")
+    parser.add_argument('--header-size', type=int, default=2, choices=(2, 4))
+    parser.add_argument('--alignment', type=int, default=2)
+    parser.add_argument('--statuses', default="4:0.8,2:0.1,3:0.1", help="Status mix, status:weight,...")
+    parser.add_argument('--lengths', default="uniform:0:300", help="fixed:<n>, uniform:<min>:<max> or choice:<n>,...")
+    parser.add_argument('--run-length', type=float, default=1, help="Mean number of consecutive same-length records.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    count = generate_file(
+        args.path, size=args.size, records=args.records, header_size=args.header_size, alignment=args.alignment,
+        statuses=args.statuses, lengths=args.lengths, run_length=args.run_length, seed=args.seed,
+    )
+    print(f"{args.path}: {count:,} records, {os.path.getsize(args.path):,} bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
+import contextlib
+import json
+import logging
 import os
+import sys
 import time
 from datetime import datetime
-from typing import List, Tuple, Dict
+from typing import Iterator, List, Optional
 
 import click
-import psutil
-import pyarrow as pa
-import pyarrow.parquet as pq
-import pandas as pd
-from rich.console import Console
-from rich.table import Table
 
-from ecopass.core.record_header import RecordHeader
+from ecopass.core.checkpoint import Checkpoint
+from ecopass.core.decoder import ENCODINGS, RecordDecoder
+from ecopass.core.manifest import expand_inputs, source_names, write_manifest
+from ecopass.core.metrics import DISABLED, Metrics
+from ecopass.core.partitioned_writer import (
+    BYTE_STREAM_SPLIT_PYARROW, FILE_EXTENSIONS, PartitionedWriter, byte_stream_split_columns, write_dataset_metadata,
+)
+from ecopass.core.record_header import RecordHeader, RecordType, debug_logging, record_schema
+from ecopass.core.verify import BadRegion, verify_file, write_skipped
+
+logger = logging.getLogger(__name__)
 
 
 # -------------------------------------------------
@@ -20,6 +28,7 @@ from ecopass.core.record_header import RecordHeader
 # -------------------------------------------------
 def get_memory_usage() -> float:
     """Get current memory usage in MB."""
+    import psutil
     process = psutil.Process(os.getpid())
     return process.memory_info().rss / 1024 / 1024
 
@@ -27,16 +36,16 @@ def get_memory_usage() -> float:
 # -------------------------------------------------------------------------------------------------------------
 # Custom Display Function To show smooth animation of loading with ram usage and record counting in real-time
 # -------------------------------------------------------------------------------------------------------------
-def display_utils(batch_count: int, records: List[Tuple[int, bytes]], total_records: int) -> None:
+def display_utils(batch_count: int, batch_records: int, total_records: int, err: bool = False) -> None:
     spinner_frames = ['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏']  # Spinner frames
     frame = spinner_frames[batch_count % len(spinner_frames)]
     message = (
-        f"{frame} Processing batch {batch_count}: {len(records):,} records | "
+        f"{frame} Processing batch {batch_count}: {batch_records:,} records | "
         f"Total: {total_records:,} | "
         f"Memory: {get_memory_usage():.2f} MB | "
         f"Time: {datetime.now().strftime('%H:%M:%S')}"
     )
-    click.echo(f"\r{message}", nl=False)
+    click.echo(f"\r{message}", nl=False, err=err)
 
 
 # -------------------------------------------------------------------------------
@@ -50,24 +59,99 @@ def format_time(seconds: float) -> str:
     return f"{int(hours)}h {int(minutes)}m {int(seconds)}s"
 
 
+# -------------------------------------------------------------------------------
+# Bad record of a file read in strict mode: a short message instead of a traceback
+# -------------------------------------------------------------------------------
+@contextlib.contextmanager
+def bad_record_errors(path_input: Optional[str] = None) -> Iterator[None]:
+    """Turn the ValueError of a bad record into a message pointing to ecopass verify and --tolerant."""
+    try:
+        yield
+    except ValueError as error:
+        prefix = f"{path_input}: " if path_input else ""
+        raise click.ClickException(f"{prefix}{error} (see ecopass verify, or use --tolerant)")
+
+
 
 def validate_header_size(ctx, param, value):
     if value not in {2, 4}:
         raise click.BadParameter('header-size must be 2 or 4.')
     return value
+
+
+def validate_inputs(ctx, param, value):
+    """Input files of the paths, directories and glob patterns."""
+    try:
+        return expand_inputs(value)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+
+
+def validate_statuses(ctx, param, value):
+    """Statuses given as numbers (4) or RecordType names (NORMAL_USER_DATA)."""
+    statuses = []
+    for item in value:
+        for status in item.split(','):
+            status = status.strip()
+            if status.isdigit() and 0 <= int(status) <= 15:
+                statuses.append(int(status))
+            elif status.upper() in RecordType.__members__:
+                statuses.append(RecordType[status.upper()].value)
+            else:
+                raise click.BadParameter(f"{status!r} is not a status number (0-15) or a record type name.")
+    return statuses
+
+
+# -------------------------------------------------------------------------------------------------------------
+# Command group: `ecopass <command> ...`, a command line without a command runs `convert`
+# (so `ecopass --input file.bin --output out_dir` keeps working)
+# -------------------------------------------------------------------------------------------------------------
+class DefaultGroup(click.Group):
+    default_command = 'convert'
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, context_settings=dict(help_option_names=['-h', '--help']))
+def main() -> None:
+    """
+    Convert Micro Focus variable-record files to Parquet (ecopass convert, the default command),
+    look up the records of indexed files by key (ecopass get), check files (ecopass verify),
+    count their records per status and length (ecopass stats) and write the changes between
+    two snapshots of a file (ecopass diff).
+    """
+
+
 # ---------------------------------------------------------------------------------------------------------------------------------------
 # User Input: Define File Paths Output_Dir with header-size and alignment and also custom batch-size to control the ram and cpu if needed
 # ---------------------------------------------------------------------------------------------------------------------------------------
-@click.command(context_settings=dict(help_option_names=['-h', '--help']), cls=click.Command, help='Process binary files with specified options.')
+@main.command('convert', help='Process binary files with specified options.')
 @click.option(
-    '--input', 'path_input', required=True,
-    type=click.Path(exists=True, dir_okay=False, readable=True),
-    help="Path to the binary file to process."
+    '--input', 'path_inputs', required=True, multiple=True,
+    callback=validate_inputs,
+    help=(
+        "Path to the binary file to process. Can be repeated, and can be a directory or a glob pattern "
+        "(e.g. \"extracts/*.dat\") to convert several files with one pool of workers: each file is "
+        "written to <output>/source=<file name> and a manifest is written to the output directory."
+    )
 )
 @click.option(
     '--output', 'path_output', required=True,
-    type=click.Path(file_okay=False, writable=True),
-    help="Output directory for encoded data as Parquet files."
+    type=click.Path(file_okay=False, writable=True, allow_dash=True),
+    help="Output directory for encoded data as Parquet files, or - to stream the batches to stdout as an Arrow IPC stream."
+)
+@click.option(
+    '--format', 'file_format', default='parquet', show_default=True,
+    type=click.Choice(sorted(FILE_EXTENSIONS)),
+    help="Format of the output files: parquet, arrow (Arrow IPC file / Feather v2, can be memory mapped) or arrow-stream (Arrow IPC stream, the format used for stdout)."
+)
+@click.option(
+    '--split-by', default='rdw', show_default=True,
+    type=click.Choice(['rdw', 'status', 'none']),
+    help="Partition the output files by record length (rdw=<length>/), by status (status=<status>/) or not at all."
 )
 @click.option(
     '--batch-size', default=500_000, show_default=True,
@@ -94,24 +178,193 @@ def validate_header_size(ctx, param, value):
     type=click.IntRange(min=2),
     help="Alignment to use with RecordHeader."
 )
+@click.option(
+    '--workers', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of worker processes. With more than one worker the file is split in shards at record boundaries and each worker writes its own part files."
+)
+@click.option(
+    '--pipeline', is_flag=True, default=False,
+    help="Read, convert and write at the same time: a reader thread, the conversion and --writer-threads writer threads connected by bounded queues (single process)."
+)
+@click.option(
+    '--writer-threads', default=2, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of Parquet writer threads with --pipeline (each rdw partition is written by one of them)."
+)
+@click.option(
+    '--max-memory', default=1024, show_default=True,
+    type=click.IntRange(min=16),
+    help="Memory budget in MB of --pipeline: the batches are sized in bytes from it, and the writer buffers are bounded by it."
+)
+@click.option(
+    '--max-file-size', default=512, show_default=True,
+    type=click.IntRange(min=1),
+    help="Target size in MB of a Parquet file. Once a file of a rdw partition reaches it, the next rows go to a new file."
+)
+@click.option(
+    '--max-open-files', default=64, show_default=True,
+    type=click.IntRange(min=1),
+    help="Maximum number of Parquet files open at the same time (per worker). The least recently used one is closed first."
+)
+@click.option(
+    '--fixed-size-values', 'fixed_size', is_flag=True, default=False,
+    help=(
+        "Write the value column of every rdw=N partition as fixed_size_binary(N) instead of binary "
+        "(no per-row length, smaller files and faster scans). The partitions then have different schemas: "
+        "read the dataset with the schema of _common_metadata."
+    )
+)
+@click.option(
+    '--compression', default=None,
+    type=click.Choice(['snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none']),
+    help="Compression codec (default: snappy for Parquet, none for the Arrow formats, which support lz4 and zstd)."
+)
+@click.option(
+    '--compression-level', default=None,
+    type=click.INT,
+    help="Compression level of the codec (e.g. 1-22 for zstd)."
+)
+@click.option(
+    '--row-group-size', default=128, show_default=True,
+    type=click.IntRange(min=1),
+    help="Data buffered per partition before it is written as a Parquet row group (MB)."
+)
+@click.option(
+    '--page-size', default=1024, show_default=True,
+    type=click.IntRange(min=1),
+    help="Target size of the Parquet data pages (KB)."
+)
+@click.option(
+    '--dictionary/--no-dictionary', 'use_dictionary', default=True, show_default=True,
+    help="Dictionary-encode the Parquet columns (useful for repeated values, wasted on unique record data)."
+)
+@click.option(
+    '--byte-stream-split/--no-byte-stream-split', 'use_byte_stream_split', default=False, show_default=True,
+    help="Use the BYTE_STREAM_SPLIT encoding for the integer and fixed-size columns (helps the compression of numbers, needs pyarrow 16 or later)."
+)
+@click.option(
+    '--index/--no-index', 'use_index', default=False, show_default=True,
+    help="Use the sidecar index of the input (<input>.ecpidx) to skip the header walk. It is built and written next to the input when missing or out of date."
+)
+@click.option(
+    '--resume', is_flag=True, default=False,
+    help="Resume an interrupted conversion from the checkpoint of the output directory (the files of the interrupted part are rewritten)."
+)
+@click.option(
+    '--incremental', is_flag=True, default=False,
+    help="Only convert the records appended to the input since the previous run into the same output directory."
+)
+@click.option(
+    '--checkpoint-every', default=1024, show_default=True,
+    type=click.IntRange(min=1),
+    help="Commit the Parquet files and write the checkpoint every N MB of record data (sequential mode; in parallel mode every shard is committed, and a shard is at least N MB unless there would be fewer shards than workers)."
+)
+@click.option(
+    '--include-status', 'include_statuses', multiple=True,
+    callback=validate_statuses,
+    help="Only convert the records with this status, as a number or a record type name (e.g. 4 or NORMAL_USER_DATA). Can be repeated or comma-separated."
+)
+@click.option(
+    '--exclude-status', 'exclude_statuses', multiple=True,
+    callback=validate_statuses,
+    help="Skip the records with this status (e.g. DELETED_RECORD). Can be repeated or comma-separated."
+)
+@click.option(
+    '--record-length', 'record_lengths', multiple=True,
+    type=click.IntRange(min=0),
+    help="Only convert the records with this length. Can be repeated."
+)
+@click.option(
+    '--tolerant', is_flag=True, default=False,
+    help=(
+        "Skip the bad regions of the input (invalid status, record past the end of the file, record longer than "
+        "--max-record-length) instead of stopping: the reader resumes at the next plausible header and the skipped "
+        "byte ranges are written to _ecopass_skipped.json in the output directory."
+    )
+)
+@click.option(
+    '--max-record-length', default=None,
+    type=click.IntRange(min=0),
+    help="With --tolerant, a record longer than this is bad (e.g. the maximum record length of the file)."
+)
+@click.option(
+    '--layout', 'path_layout', default=None,
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+    help=(
+        "JSON copybook layout used to decode the records into typed columns instead of the raw value column: "
+        "a list of [start, end, length, name, is_packed, is_comp_3] (1-based start) or of "
+        "{\"name\", \"start\", \"length\", \"type\": text|packed|zoned, \"scale\"} objects."
+    )
+)
+@click.option(
+    '--encoding', default='latin1', show_default=True,
+    type=click.Choice(ENCODINGS),
+    help="Encoding of the text fields of the layout (cp037 is EBCDIC)."
+)
+@click.option(
+    '--metrics-json', 'path_metrics_json', default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the metrics of the run (time per stage, bytes read and written, records per status, batch latency percentiles, peak RSS) to this JSON file."
+)
+@click.option(
+    '--metrics-prometheus', 'path_metrics_prometheus', default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the metrics of the run in the Prometheus text format (e.g. for the node_exporter textfile collector)."
+)
 @click.option(
     '--debug', default=False, show_default=True,
     type=bool,
     help="Enable debug mode to display detailed logs and error messages for troubleshooting."
 )
-def main(path_input: str, path_output: str, batch_size: int, header_size: int, alignment: int, debug: bool) -> None:
+def convert(path_inputs: list, path_output: str, file_format: str, split_by: str, batch_size: int, header_size: int, alignment: int, workers: int,
+         pipeline: bool, writer_threads: int, max_memory: int, max_file_size: int, max_open_files: int,
+         fixed_size: bool, compression: Optional[str], compression_level: Optional[int], row_group_size: int, page_size: int,
+         use_dictionary: bool, use_byte_stream_split: bool, use_index: bool, resume: bool, incremental: bool,
+         checkpoint_every: int, include_statuses: list, exclude_statuses: list, record_lengths: tuple,
+         tolerant: bool, max_record_length: Optional[int], path_layout: str, encoding: str, path_metrics_json: str, path_metrics_prometheus: str,
+         debug: bool) -> None:
     # -------------------------------------------
     # program start at start_time
     # -------------------------------------------
     start_time = time.time()
+    if debug:
+        debug_logging()
 
-    # -------------------------------------------
-    # Define Schema for pyarrow & pandas DataFrame
-    # -------------------------------------------
-    schema = pa.schema([
-        ('rdw', pa.int32()),
-        ('value', pa.binary())
-    ])
+    # the conversion modules (pyarrow, rich) are only imported by the commands that use them
+    import pyarrow as pa
+    from rich.console import Console
+    from rich.table import Table
+
+    from ecopass.core.convert import (
+        FileJob, ShardResult, convert_files, convert_sequential, convert_to_stream, part_prefix, writer_schema,
+    )
+    from ecopass.core.pipeline import convert_pipelined
+
+    # ------------------------------------------------------------------------------------------
+    # one input file: the output directory holds its dataset
+    # several files (or a directory / glob): one sub-directory per file, source=<file name>
+    # ------------------------------------------------------------------------------------------
+    multiple = len(path_inputs) > 1
+    if pipeline and (workers > 1 or multiple):
+        raise click.UsageError("--pipeline runs in a single process and can't be combined with --workers or several inputs.")
+
+    # ------------------------------------------------------------------------------------------
+    # --output -: one Arrow IPC stream on stdout (the messages go to stderr)
+    # ------------------------------------------------------------------------------------------
+    to_stdout = path_output == '-'
+    if to_stdout:
+        source = click.get_current_context().get_parameter_source
+        if source('file_format') == click.core.ParameterSource.DEFAULT:
+            file_format = 'arrow-stream'
+        if source('split_by') == click.core.ParameterSource.DEFAULT:
+            split_by = 'none'
+        if file_format != 'arrow-stream' or split_by != 'none':
+            raise click.UsageError("--output - writes one Arrow IPC stream: use --format arrow-stream and --split-by none.")
+        if workers > 1 or multiple or pipeline or resume or incremental:
+            raise click.UsageError("--output - can't be combined with --workers, --pipeline, --resume, --incremental or several inputs.")
+    if tolerant and use_index:
+        raise click.UsageError("--tolerant reads the headers to skip the bad regions and can't be combined with --index.")
 
     # ------------------------------------------------------------------------------------------
     # Read Records in Batches
@@ -120,64 +373,293 @@ def main(path_input: str, path_output: str, batch_size: int, header_size: int, a
     # ------------------------------------------------------------------------------------------
     # batch_size = 10_000
     # ------------------------------------------------------------------------------------------
-    
-    records = []
     total_records = 0
     batch_count = 0
 
-    
-    click.echo(f"\n{'='*50}")
-    click.echo(f"Processing started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    click.echo(f"Batch size: {batch_size:,} records")
-    click.echo(f"{'='*50}\n")
+    # ------------------------------------------------------------------------------------------
+    # one long-lived Parquet writer per rdw partition (see PartitionedWriter)
+    # ------------------------------------------------------------------------------------------
+    writer_options = dict(
+        max_file_bytes=max_file_size * 1024 * 1024,
+        max_open_writers=max_open_files,
+        partition_col=None if split_by == 'none' else split_by,
+        file_format=file_format,
+        fixed_size=fixed_size,
+        row_group_bytes=row_group_size * 1024 * 1024,
+    )
 
     # ------------------------------------------------------------------------------------------
-    # with RecordHeader(filename=path_input, header_size=2, alignment=2) as record_header:
+    # encoding of the files: Parquet writer options, or the compression of the Arrow IPC buffers
     # ------------------------------------------------------------------------------------------
-    with RecordHeader(filename=path_input, header_size=header_size, alignment=alignment, debug=debug) as record_header:
-        for length, data in record_header.read_records():
-            records.append((length, data))
-            total_records += 1
-            
-            # ---------------------------------------------
-            # Write to Parquet when batch size is reached
-            # ---------------------------------------------
-            if len(records) >= batch_size:
-                batch_count += 1
+    if file_format == 'parquet':
+        writer_options.update(
+            compression=compression or 'snappy', compression_level=compression_level,
+            use_dictionary=use_dictionary, use_byte_stream_split=use_byte_stream_split,
+            data_page_size=page_size * 1024,
+        )
+    elif compression not in (None, 'none'):
+        if compression not in ('lz4', 'zstd'):
+            raise click.UsageError("The Arrow formats only support the lz4 and zstd compressions.")
+        writer_options['compression'] = pa.Codec(compression, compression_level) if compression_level else compression
 
-                # ------------------------------------------------
-                # Console Ouput using Custom DIsplay using click
-                # ------------------------------------------------
-                display_utils(batch_count=batch_count, records=records, total_records=total_records)
+    # ------------------------------------------------------------------------------------------
+    # metrics of the run, only collected when they are exported
+    # ------------------------------------------------------------------------------------------
+    metrics = Metrics() if (path_metrics_json or path_metrics_prometheus) else DISABLED
 
+    # ------------------------------------------------------------------------------------------
+    # filters applied to the headers: the rejected records are never read
+    # ------------------------------------------------------------------------------------------
+    reader_options = dict(
+        include_statuses=include_statuses or None,
+        exclude_statuses=exclude_statuses,
+        record_length=list(record_lengths),
+        with_status=split_by == 'status',
+        tolerant=tolerant,
+        max_record_length=max_record_length,
+        growing=incremental,    # a record still being written is left for the next run
+    )
 
-                df = pd.DataFrame(records, columns=['rdw', 'value'])
+    # ------------------------------------------------------------------------------------------
+    # optional copybook layout: the records are decoded into one typed column per field
+    # ------------------------------------------------------------------------------------------
+    decoder = None
+    if path_layout:
+        try:
+            with open(path_layout) as f:
+                decoder = RecordDecoder(
+                    json.load(f), encoding=encoding, keep_columns=('rdw', 'status') if split_by == 'status' else ('rdw',),
+                )
+        except (ValueError, KeyError, TypeError) as error:
+            raise click.ClickException(f"Invalid layout {path_layout}: {error}")
 
-                # ---------------------------------------------
-                # Convert DataFrame to PyArrow Table
-                # ---------------------------------------------
-                table = pa.Table.from_pandas(df, schema=schema)
-                # table = pa.Table.from_arrays([pa.array([length for length, _ in records]),pa.array([data for _, data in records])], schema=schema)
-                # ---------------------------------------------
-                # Write to Parquet file
-                # ---------------------------------------------
-                pq.write_to_dataset(table, root_path=path_output, partition_cols=['rdw'])
+    # ------------------------------------------------------------------------------------------
+    # --byte-stream-split only applies to the integer and fixed-size columns (pyarrow 16 or later):
+    # refuse it when no column of the files would use it, instead of silently ignoring it
+    # ------------------------------------------------------------------------------------------
+    if file_format == 'parquet' and use_byte_stream_split:
+        schema = writer_schema(decoder, record_schema(split_by == 'status'))
+        if not byte_stream_split_columns(schema, writer_options['partition_col'], fixed_size):
+            raise click.UsageError(
+                f"--byte-stream-split has no effect here: pyarrow {pa.__version__} writes no column of the files "
+                f"with BYTE_STREAM_SPLIT (it needs pyarrow {BYTE_STREAM_SPLIT_PYARROW} or later, and "
+                f"--fixed-size-values for the record data of the rdw partitions)."
+            )
+
+    # ------------------------------------------------------------------------------------------
+    # Checkpoint of every input: which byte ranges are already in its output directory
+    # - new run: nothing is converted yet
+    # - resume: the gaps of the previous run (the files of the interrupted part are removed)
+    # - incremental: the gaps of the previous run + the records appended since
+    # ------------------------------------------------------------------------------------------
+    sources = source_names(path_inputs)
+    if multiple:
+        outputs = [os.path.join(path_output, f"source={name}") for name in sources]
+    else:
+        outputs = [path_output]
+    jobs = []
+    for path_input, job_output in zip(path_inputs, outputs):
+        if to_stdout:
+            break
+        checkpoint = Checkpoint.load(job_output) if (resume or incremental) else None
+        input_size = os.path.getsize(path_input)
+        if checkpoint is None:
+            checkpoint = Checkpoint(job_output, path_input, header_size, alignment)
+            end = input_size
+        else:
+            try:
+                checkpoint.validate(path_input, header_size, alignment)
+            except ValueError as error:
+                raise click.ClickException(f"{path_input}: {error}")
+            for removed in checkpoint.remove_uncommitted_files():
+                logger.debug("Removed uncommitted file %s", removed)
+            end = input_size if incremental else checkpoint.input_size
+        checkpoint.set_input_size(end)
+        checkpoint.save()
+        jobs.append(FileJob(path_input=path_input, path_output=job_output, checkpoint=checkpoint, gaps=checkpoint.gaps(end)))
+    skipped: List[List[BadRegion]] = [[] for _ in path_inputs]   # bad regions skipped with --tolerant
+    records_before = sum(job.checkpoint.records for job in jobs)
+    files_before = [len(job.checkpoint.files) for job in jobs]
+
+    click.echo(f"\n{'='*50}", err=to_stdout)
+    click.echo(f"Processing started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", err=to_stdout)
+    if multiple:
+        click.echo(f"Input files: {len(jobs):,}")
+    click.echo(f"Batch size: {batch_size:,} records", err=to_stdout)
+    click.echo(f"Workers: {workers}", err=to_stdout)
+    if records_before:
+        bytes_left = sum(stop - start for job in jobs for start, stop in job.gaps)
+        click.echo(f"Already converted: {records_before:,} records, {bytes_left:,} bytes left")
+    click.echo(f"{'='*50}\n", err=to_stdout)
+
+    # ------------------------------------------------------------------------------------------
+    # progress of the sequential and pipelined modes, displayed for every batch converted
+    # ------------------------------------------------------------------------------------------
+    def on_batch(batch) -> None:
+        nonlocal total_records, batch_count
+        batch_count += 1
+        total_records += batch.num_rows
+
+        # ------------------------------------------------
+        # Console Ouput using Custom DIsplay using click
+        # ------------------------------------------------
+        display_utils(batch_count=batch_count, batch_records=batch.num_rows, total_records=total_records, err=to_stdout)
 
+    # ------------------------------------------------------------------------------------------
+    # Stream mode: the batches are written to stdout as they are read
+    # ------------------------------------------------------------------------------------------
+    if to_stdout:
+        with RecordHeader(filename=path_inputs[0], header_size=header_size, alignment=alignment, debug=debug,
+                          metrics=metrics, **reader_options) as record_header, bad_record_errors(path_inputs[0]):
+            if use_index:
+                record_header.load_index()
+            try:
+                convert_to_stream(
+                    record_header, sys.stdout.buffer, batch_size=batch_size, on_batch=on_batch,
+                    decoder=decoder, metrics=metrics,
+                )
+                sys.stdout.flush()
+                skipped[0] = record_header.skipped
+            except BrokenPipeError:
                 # ---------------------------------------------
-                # Clear records to free memory
+                # the consumer stopped reading: stop quietly
                 # ---------------------------------------------
-                records.clear()
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+    # ------------------------------------------------------------------------------------------
+    # Parallel mode: the shards of every input are converted by one pool of workers
+    # (largest first), the progress is displayed every time a shard is done
+    # ------------------------------------------------------------------------------------------
+    elif workers > 1 or multiple:
+        shards_done = 0
+
+        def on_shard_done(job_number: int, result: ShardResult) -> None:
+            nonlocal shards_done, total_records, batch_count
+            shards_done += 1
+            total_records += result.records
+            batch_count += result.batches
+            display_utils(batch_count=shards_done, batch_records=result.records, total_records=total_records)
+
+        # the errors of convert_files already name their input
+        with bad_record_errors():
+            shard_results = convert_files(
+                jobs, workers,
+                header_size=header_size, alignment=alignment, batch_size=batch_size,
+                debug=debug, writer_options=writer_options, use_index=use_index, on_shard_done=on_shard_done,
+                decoder=decoder, reader_options=reader_options, metrics=metrics,
+                min_shard_bytes=checkpoint_every * 1024 * 1024,
+            )
+        skipped = [[region for result in job_results for region in result.skipped] for job_results in shard_results]
+
+    # ------------------------------------------------------------------------------------------
+    # Pipelined mode: the reader, the conversion and the writers run at the same time
+    # ------------------------------------------------------------------------------------------
+    elif pipeline:
+        job = jobs[0]
+        with RecordHeader(filename=job.path_input, header_size=header_size, alignment=alignment, debug=debug,
+                          metrics=metrics, **reader_options) as record_header, bad_record_errors(job.path_input):
+            if use_index:
+                record_header.load_index()
+            convert_pipelined(
+                record_header, job.path_output, job.checkpoint, job.gaps, prefix=part_prefix(0),
+                writer_threads=writer_threads, max_memory=max_memory * 1024 * 1024, batch_size=batch_size,
+                commit_bytes=checkpoint_every * 1024 * 1024, writer_options=writer_options,
+                on_batch=on_batch, decoder=decoder, metrics=metrics,
+            )
+            skipped[0] = record_header.skipped
+
+    # ------------------------------------------------------------------------------------------
+    # Sequential mode: the gaps are converted in order
+    # with RecordHeader(filename=path_input, header_size=2, alignment=2) as record_header:
+    # ------------------------------------------------------------------------------------------
+    else:
+        job = jobs[0]
+        with RecordHeader(filename=job.path_input, header_size=header_size, alignment=alignment, debug=debug,
+                          metrics=metrics, **reader_options) as record_header, \
+                PartitionedWriter(job.path_output, prefix=part_prefix(0), schema=writer_schema(decoder, record_header.schema),
+                                  **writer_options) as writer, \
+                bad_record_errors(job.path_input):
+            if use_index:
+                record_header.load_index()
+
+            # ---------------------------------------------
+            # each batch is a pyarrow RecordBatch (rdw, value) built straight from the
+            # memory map, its rows are appended to the Parquet file of their rdw partition
+            # ---------------------------------------------
+            convert_sequential(
+                record_header, writer, job.checkpoint, job.gaps, batch_size=batch_size,
+                commit_bytes=checkpoint_every * 1024 * 1024, on_batch=on_batch, decoder=decoder, metrics=metrics,
+            )
+            skipped[0] = record_header.skipped
 
     # ---------------------------------------------
-    # Write remaining records if any
+    # Bad regions skipped with --tolerant: listed on stderr
+    # and kept in the output directory of their input
     # ---------------------------------------------
-    if records:
-        batch_count += 1
-        display_utils(batch_count=batch_count, records=records, total_records=total_records)
-        df = pd.DataFrame(records, columns=['rdw', 'value'])
-        table = pa.Table.from_pandas(df, schema=schema)
-        pq.write_to_dataset(table, root_path=path_output, partition_cols=['rdw'])
-        records.clear()
+    for path_input, job_output, regions in zip(path_inputs, outputs, skipped):
+        if not regions:
+            continue
+        click.echo(f"\nSkipped {len(regions):,} bad regions of {path_input}:", err=True)
+        for region in sorted(regions)[:20]:
+            click.echo(f"  bytes {region.start:,} to {region.stop:,}: {region.reason}", err=True)
+        if len(regions) > 20:
+            click.echo(f"  ... and {len(regions) - 20:,} more", err=True)
+        if not to_stdout:
+            click.echo(f"  see {write_skipped(job_output, path_input, regions)}", err=True)
+
+    # ---------------------------------------------
+    # Write the _metadata summary of every dataset
+    # (and of the whole output with several inputs)
+    # ---------------------------------------------
+    records_in_output = total_records if to_stdout else sum(job.checkpoint.records for job in jobs)
+    with metrics.stage('metadata'):
+        for job in jobs if file_format == 'parquet' else []:
+            write_dataset_metadata(job.path_output, job.checkpoint.files)
+        if multiple and file_format == 'parquet':
+            write_dataset_metadata(path_output, [
+                f"{os.path.relpath(job.path_output, path_output)}/{relative_path}"
+                for job in jobs for relative_path in job.checkpoint.files
+            ])
+
+    # ---------------------------------------------
+    # Manifest of the run: one entry per input
+    # ---------------------------------------------
+    if multiple:
+        entries = []
+        for job, source, job_results, job_files_before in zip(jobs, sources, shard_results, files_before):
+            entries.append(dict(
+                input=os.path.abspath(job.path_input),
+                source=source,
+                output=os.path.relpath(job.path_output, path_output),
+                size=job.checkpoint.input_size,
+                records=sum(result.records for result in job_results),
+                records_in_output=job.checkpoint.records,
+                files=job.checkpoint.files[job_files_before:],
+                duration_seconds=round(
+                    max(result.finished for result in job_results) - min(result.started for result in job_results), 3
+                ) if job_results else 0.0,
+            ))
+        write_manifest(path_output, entries, workers=workers, records=total_records, records_in_output=records_in_output)
+
+    # ---------------------------------------------
+    # Export the metrics of the run
+    # ---------------------------------------------
+    if metrics.enabled:
+        metrics.add('bytes_written', sum(
+            os.path.getsize(os.path.join(job.path_output, relative_path))
+            for job, job_files_before in zip(jobs, files_before) for relative_path in job.checkpoint.files[job_files_before:]
+        ))
+        input_label = os.path.abspath(path_inputs[0]) if not multiple else f"{len(path_inputs)} files"
+        if path_metrics_json:
+            metrics.write_json(
+                path_metrics_json, input=[os.path.abspath(path) for path in path_inputs] if multiple else input_label,
+                output=os.path.abspath(path_output),
+                mode='workers' if (workers > 1 or multiple) else 'pipeline' if pipeline else 'sequential',
+                workers=workers, records=total_records, records_in_output=records_in_output,
+            )
+        if path_metrics_prometheus:
+            metrics.write_prometheus(path_metrics_prometheus, input=input_label)
+
     # ---------------------------------------------
     # since the app convert into cli this will show the ouput of the program
     # Clear Jupyter Notebook Output (if applicable)
@@ -190,8 +672,8 @@ def main(path_input: str, path_output: str, batch_size: int, header_size: int, a
     # ---------------------------------------------
     # Initialize the console
     # ---------------------------------------------
-    click.echo("\n")
-    console = Console()
+    click.echo("\n", err=to_stdout)
+    console = Console(stderr=to_stdout)
 
     # ---------------------------------------------
     # Create a table
@@ -210,8 +692,11 @@ def main(path_input: str, path_output: str, batch_size: int, header_size: int, a
     # Add rows
     # ---------------------------------------------
     table.add_row("[bold]Total records processed[/bold]", f"{total_records:,}")
+    table.add_row("[bold]Total records in output[/bold]", f"{records_in_output:,}")
+    if tolerant:
+        table.add_row("[bold]Bytes skipped[/bold]", f"{sum(r.stop - r.start for regions in skipped for r in regions):,}")
     table.add_row("[bold]Number of [red]batches[/red][/bold]", f"{batch_count}")
-    table.add_row("[bold]Average records per [red]batch[/red][/bold]", f"{total_records/batch_count:,.0f}")
+    table.add_row("[bold]Average records per [red]batch[/red][/bold]", f"{total_records/max(batch_count, 1):,.0f}")
     table.add_row("[bold]Total processing time[/bold]", format_time(duration))
     table.add_row("[bold]Processing rate[/bold]", f"{total_records/duration:,.0f} [red]R/S[/red]")
     table.add_row("[bold]Final memory usage[/bold]", f"{get_memory_usage():.2f} MB")
@@ -222,5 +707,476 @@ def main(path_input: str, path_output: str, batch_size: int, header_size: int, a
     # ---------------------------------------------
     console.print(table)
 
+# -------------------------------------------------------------------------------------------------------------
+# ecopass get: look up the records of an indexed file by primary key
+# -------------------------------------------------------------------------------------------------------------
+@main.command('get')
+@click.option(
+    '--input', 'path_input', required=True,
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+    help="Path to the data file of the indexed file."
+)
+@click.option(
+    '--key', 'keys', multiple=True,
+    help="Primary key to look up (can be repeated). Shorter keys are padded with spaces."
+)
+@click.option(
+    '--range', 'key_bounds', nargs=2, default=None,
+    help="Look up the keys between LOW and HIGH (both included)."
+)
+@click.option(
+    '--key-start', default=None,
+    type=click.IntRange(min=1),
+    help="1-based position of the primary key in the records."
+)
+@click.option(
+    '--key-length', default=None,
+    type=click.IntRange(min=1),
+    help="Length of the primary key in bytes."
+)
+@click.option(
+    '--key-field', default=None,
+    help="Field of the --layout holding the primary key (instead of --key-start and --key-length)."
+)
+@click.option(
+    '--key-hex', is_flag=True, default=False,
+    help="The keys are given in hexadecimal (for binary keys)."
+)
+@click.option(
+    '--layout', 'path_layout', default=None,
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+    help="JSON copybook layout: the records found are printed decoded, one JSON object per line."
+)
+@click.option(
+    '--encoding', default='latin1', show_default=True,
+    type=click.Choice(ENCODINGS),
+    help="Encoding of the keys and of the text fields (cp037 is EBCDIC)."
+)
+@click.option(
+    '--header-size', default=2, show_default=True,
+    type=click.INT,
+    callback=validate_header_size,
+    help="Size of the record headers (2 or 4)."
+)
+@click.option(
+    '--alignment', default=2, show_default=True,
+    type=click.IntRange(min=2),
+    help="Alignment to use with RecordHeader."
+)
+@click.option(
+    '--save-index/--no-save-index', 'persist', default=True, show_default=True,
+    help="Keep the key index next to the file (<input>.ecpkey) so the next lookups skip the header walk."
+)
+def get(path_input: str, keys: tuple, key_bounds: Optional[tuple], key_start: Optional[int], key_length: Optional[int],
+        key_field: Optional[str], key_hex: bool, path_layout: Optional[str], encoding: str, header_size: int,
+        alignment: int, persist: bool) -> None:
+    """
+    Look up records of an indexed file by primary key or key range and print them as JSON lines
+    (offset, status, rdw and the hexadecimal value, or the fields of the --layout).
+    The first lookup builds the key index of the file in one pass over the headers.
+    """
+    import pyarrow as pa
+
+    if not keys and key_bounds is None:
+        raise click.UsageError("Give at least one --key or a --range.")
+    decoder = None
+    if path_layout is not None:
+        try:
+            with open(path_layout) as f:
+                decoder = RecordDecoder(json.load(f), encoding=encoding, keep_columns=())
+        except (ValueError, KeyError, TypeError) as error:
+            raise click.ClickException(f"Invalid layout {path_layout}: {error}")
+    if key_field is not None:
+        if decoder is None:
+            raise click.UsageError("--key-field needs a --layout.")
+        fields = {field.name: field for field in decoder.fields}
+        if key_field not in fields:
+            raise click.BadParameter(f"{key_field!r} is not a field of the layout.", param_hint='--key-field')
+        key_start, key_length = fields[key_field].start + 1, fields[key_field].length
+    if key_start is None or key_length is None:
+        raise click.UsageError("Give the key with --key-start and --key-length, or with --key-field.")
+
+    def to_key(text: str) -> bytes:
+        try:
+            key = bytes.fromhex(text) if key_hex else text.encode(encoding)
+        except ValueError as error:
+            raise click.BadParameter(str(error), param_hint='--key')
+        if len(key) > key_length:
+            raise click.BadParameter(f"{text!r} is longer than the key ({key_length} bytes).", param_hint='--key')
+        return key.ljust(key_length, b'\x00' if key_hex else ' '.encode(encoding))
+
+    with RecordHeader(filename=path_input, header_size=header_size, alignment=alignment) as record_header:
+        record_header.load_key_index(key_start - 1, key_length, persist=persist)
+        lookups = [(to_key(key), None) for key in keys]
+        if key_bounds is not None:
+            lookups.append((to_key(key_bounds[0]), to_key(key_bounds[1])))
+
+        for low, high in lookups:
+            found = record_header.key_range(low, high)
+            values = [
+                record_header.mmap_obj[int(offset) + header_size:int(offset) + header_size + int(length)]
+                for offset, length in zip(found.offsets, found.lengths)
+            ]
+            if decoder is not None:
+                batch = pa.RecordBatch.from_arrays([pa.array(values, pa.binary())], names=['value'])
+                rows = decoder.decode(batch).to_pylist()
+            else:
+                rows = [dict(value=value.hex()) for value in values]
+            for offset, status, length, row in zip(found.offsets, found.statuses, found.lengths, rows):
+                record = dict(offset=int(offset), status=int(status), rdw=int(length), **row)
+                click.echo(json.dumps(record, default=str))
+
+
+
+# -------------------------------------------------------------------------------------------------------------
+# ecopass verify: check the structure of the files without converting them
+# -------------------------------------------------------------------------------------------------------------
+@main.command('verify')
+@click.option(
+    '--input', 'path_inputs', required=True, multiple=True,
+    callback=validate_inputs,
+    help="Path to the binary file to check. Can be repeated, and can be a directory or a glob pattern."
+)
+@click.option(
+    '--header-size', default=2, show_default=True,
+    type=click.INT,
+    callback=validate_header_size,
+    help="Size of the record headers (2 or 4)."
+)
+@click.option(
+    '--alignment', default=2, show_default=True,
+    type=click.IntRange(min=2),
+    help="Alignment to use with RecordHeader."
+)
+@click.option(
+    '--max-record-length', default=None,
+    type=click.IntRange(min=0),
+    help="A record longer than this is bad (e.g. the maximum record length of the file)."
+)
+@click.option(
+    '--check-padding/--no-check-padding', default=True, show_default=True,
+    help="A record whose padding bytes aren't zero is bad."
+)
+@click.option(
+    '--json', 'as_json', is_flag=True, default=False,
+    help="Print the report as JSON instead of a table."
+)
+def verify(path_inputs: list, header_size: int, alignment: int, max_record_length: Optional[int],
+           check_padding: bool, as_json: bool) -> None:
+    """
+    Check the headers and the padding of every record without reading the record data, and
+    report every bad region (the check goes on at the next plausible header).
+    The exit status is 1 when a file has a bad region.
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    reports = []
+    for path_input in path_inputs:
+        start_time = time.time()
+        with RecordHeader(filename=path_input, header_size=header_size, alignment=alignment) as record_header:
+            report = verify_file(record_header, max_length=max_record_length, check_padding=check_padding)
+        reports.append((path_input, report, time.time() - start_time))
+
+    if as_json:
+        click.echo(json.dumps([
+            dict(input=os.path.abspath(path_input), size=report.size, records=report.records,
+                 bad_bytes=report.bad_bytes, trailing_bytes=report.trailing_bytes,
+                 regions=[region._asdict() for region in report.regions], duration_seconds=round(duration, 3))
+            for path_input, report, duration in reports
+        ], indent=2))
+    else:
+        console = Console()
+        for path_input, report, duration in reports:
+            table = Table(title=f"Verify {path_input}")
+            table.add_column("Metric", style="cyan", no_wrap=True)
+            table.add_column("Value", style="magenta")
+            table.add_row("[bold]File size[/bold]", f"{report.size:,} bytes")
+            table.add_row("[bold]Valid records[/bold]", f"{report.records:,}")
+            table.add_row("[bold]Bad regions[/bold]", f"{len(report.regions):,}")
+            table.add_row("[bold]Bad bytes[/bold]", f"{report.bad_bytes:,}")
+            table.add_row("[bold]Trailing bytes[/bold]", f"{report.trailing_bytes:,}")
+            table.add_row("[bold]Verify time[/bold]", f"{duration:,.2f} s")
+            console.print(table)
+            if report.regions:
+                regions = Table(title="Bad regions")
+                regions.add_column("Start", justify="right")
+                regions.add_column("Stop", justify="right")
+                regions.add_column("Bytes", justify="right")
+                regions.add_column("Reason")
+                for region in report.regions:
+                    regions.add_row(f"{region.start:,}", f"{region.stop:,}", f"{region.stop - region.start:,}", region.reason)
+                console.print(regions)
+
+    if any(report.regions for _, report, _ in reports):
+        sys.exit(1)
+
+
+
+# -------------------------------------------------------------------------------------------------------------
+# ecopass stats: records and bytes per status and per length, from the headers only
+# -------------------------------------------------------------------------------------------------------------
+@main.command('stats')
+@click.option(
+    '--input', 'path_inputs', required=True, multiple=True,
+    callback=validate_inputs,
+    help="Path to the binary file. Can be repeated, and can be a directory or a glob pattern."
+)
+@click.option(
+    '--header-size', default=2, show_default=True,
+    type=click.INT,
+    callback=validate_header_size,
+    help="Size of the record headers (2 or 4)."
+)
+@click.option(
+    '--alignment', default=2, show_default=True,
+    type=click.IntRange(min=2),
+    help="Alignment to use with RecordHeader."
+)
+@click.option(
+    '--index/--no-index', 'use_index', default=False, show_default=True,
+    help="Use the sidecar index of the input (<input>.ecpidx) instead of walking the headers. It is built and written next to the input when missing or out of date."
+)
+@click.option(
+    '--tolerant', is_flag=True, default=False,
+    help="Skip the bad regions of the input instead of stopping (see ecopass verify); their bytes are reported as skipped."
+)
+@click.option(
+    '--max-record-length', default=None,
+    type=click.IntRange(min=0),
+    help="With --tolerant, a record longer than this is bad (e.g. the maximum record length of the file)."
+)
+@click.option(
+    '--top', default=10, show_default=True,
+    type=click.IntRange(min=0),
+    help="Number of most common lengths and of largest records to show."
+)
+@click.option(
+    '--json', 'as_json', is_flag=True, default=False,
+    help="Print the statistics as JSON (with the whole histogram) instead of tables."
+)
+def stats(path_inputs: list, header_size: int, alignment: int, use_index: bool, tolerant: bool,
+          max_record_length: Optional[int], top: int, as_json: bool) -> None:
+    """
+    Count the records and the bytes of every status, the distribution of the record lengths,
+    the header and padding overhead and the largest records, without converting the files:
+    only the headers are read.
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    if tolerant and use_index:
+        raise click.UsageError("--tolerant reads the headers to skip the bad regions and can't be combined with --index.")
+
+    results = []
+    for path_input in path_inputs:
+        start_time = time.time()
+        with RecordHeader(filename=path_input, header_size=header_size, alignment=alignment,
+                          tolerant=tolerant, max_record_length=max_record_length) as record_header, \
+                bad_record_errors(path_input):
+            if use_index:
+                record_header.load_index()
+            file_stats = record_header.stats(top=top)
+        results.append((path_input, file_stats, time.time() - start_time))
+
+    def status_name(status: int) -> str:
+        return RecordType(status).name if status in RecordType._value2member_map_ else "INVALID"
+
+    if as_json:
+        click.echo(json.dumps([
+            dict(
+                input=os.path.abspath(path_input), size=file_stats.size, records=file_stats.records,
+                header_bytes=file_stats.header_bytes, data_bytes=file_stats.data_bytes,
+                padding_bytes=file_stats.padding_bytes, padding_overhead=round(file_stats.padding_overhead, 6),
+                live_bytes=file_stats.live_bytes, deleted_bytes=file_stats.deleted_bytes,
+                trailing_bytes=file_stats.trailing_bytes, skipped_bytes=file_stats.skipped_bytes,
+                statuses=[
+                    dict(status=status, type=status_name(status), **status_stats._asdict())
+                    for status, status_stats in file_stats.by_status.items()
+                ],
+                histogram=[
+                    dict(status=status, length=length, records=count)
+                    for status, length, count in zip(
+                        file_stats.statuses.tolist(), file_stats.lengths.tolist(), file_stats.counts.tolist())
+                ],
+                largest=[record._asdict() for record in file_stats.largest],
+                duration_seconds=round(duration, 3),
+            )
+            for path_input, file_stats, duration in results
+        ], indent=2))
+        return
+
+    console = Console()
+    for path_input, file_stats, duration in results:
+        table = Table(title=f"Stats {path_input}")
+        table.add_column("Metric", style="cyan", no_wrap=True)
+        table.add_column("Value", style="magenta")
+        table.add_row("[bold]File size[/bold]", f"{file_stats.size:,} bytes")
+        table.add_row("[bold]Records[/bold]", f"{file_stats.records:,}")
+        table.add_row("[bold]Record data[/bold]", f"{file_stats.data_bytes:,} bytes")
+        table.add_row("[bold]Headers[/bold]", f"{file_stats.header_bytes:,} bytes")
+        table.add_row("[bold]Padding[/bold]", f"{file_stats.padding_bytes:,} bytes ({file_stats.padding_overhead:.2%})")
+        table.add_row("[bold]Live records[/bold]", f"{file_stats.live_bytes:,} bytes")
+        table.add_row("[bold]Deleted records[/bold]", f"{file_stats.deleted_bytes:,} bytes")
+        table.add_row("[bold]Trailing bytes[/bold]", f"{file_stats.trailing_bytes:,}")
+        if tolerant:
+            table.add_row("[bold]Skipped bytes[/bold]", f"{file_stats.skipped_bytes:,}")
+        table.add_row("[bold]Stats time[/bold]", f"{duration:,.2f} s")
+        console.print(table)
+
+        statuses = Table(title="Records per status")
+        for column in ("Status", "Type", "Records", "Data bytes", "Padding bytes", "Bytes"):
+            statuses.add_column(column, justify="left" if column == "Type" else "right")
+        for status, status_stats in file_stats.by_status.items():
+            statuses.add_row(str(status), status_name(status), f"{status_stats.records:,}", f"{status_stats.data_bytes:,}",
+                             f"{status_stats.padding_bytes:,}", f"{status_stats.bytes:,}")
+        console.print(statuses)
+
+        if top and file_stats.records:
+            lengths, counts = file_stats.length_counts()
+            common = Table(title=f"Most common lengths ({len(lengths):,} distinct, {int(lengths[0]):,} to {int(lengths[-1]):,} bytes)")
+            common.add_column("Length", justify="right")
+            common.add_column("Records", justify="right")
+            common.add_column("Share", justify="right")
+            for position in sorted(range(len(lengths)), key=lambda i: (-counts[i], lengths[i]))[:top]:
+                common.add_row(f"{int(lengths[position]):,}", f"{int(counts[position]):,}",
+                               f"{counts[position] / file_stats.records:.2%}")
+            console.print(common)
+
+            largest = Table(title="Largest records")
+            largest.add_column("Offset", justify="right")
+            largest.add_column("Length", justify="right")
+            largest.add_column("Status", justify="right")
+            for record in file_stats.largest:
+                largest.add_row(f"{record.offset:,}", f"{record.length:,}", f"{record.status} {status_name(record.status)}")
+            console.print(largest)
+
+
+
+# -------------------------------------------------------------------------------------------------------------
+# ecopass diff: the records inserted, deleted and updated between two snapshots of a file
+# -------------------------------------------------------------------------------------------------------------
+@main.command('diff')
+@click.argument('path_old', metavar='OLD', type=click.Path(exists=True, dir_okay=False, readable=True))
+@click.argument('path_new', metavar='NEW', type=click.Path(exists=True, dir_okay=False, readable=True))
+@click.option(
+    '--output', 'path_output', required=True,
+    type=click.Path(file_okay=False, writable=True),
+    help="Output directory of the changes (must be empty)."
+)
+@click.option(
+    '--format', 'file_format', default='parquet', show_default=True,
+    type=click.Choice(sorted(FILE_EXTENSIONS)),
+    help="Format of the output files: parquet, arrow (Arrow IPC file / Feather v2) or arrow-stream (Arrow IPC stream)."
+)
+@click.option(
+    '--key-start', default=None,
+    type=click.IntRange(min=1),
+    help="1-based position of the primary key in the records. Without a key the records are matched by content (inserts and deletes only)."
+)
+@click.option(
+    '--key-length', default=None,
+    type=click.IntRange(min=1),
+    help="Length of the primary key in bytes."
+)
+@click.option(
+    '--key-field', default=None,
+    help="Field of the --layout holding the primary key (instead of --key-start and --key-length)."
+)
+@click.option(
+    '--layout', 'path_layout', default=None,
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+    help="JSON copybook layout, to give the key with --key-field."
+)
+@click.option(
+    '--status', 'statuses', multiple=True,
+    callback=validate_statuses,
+    help="Compare the records with this status (default: the user data records 4, 5, 7 and 8), as a number or a record type name. Can be repeated or comma-separated."
+)
+@click.option(
+    '--header-size', default=2, show_default=True,
+    type=click.INT,
+    callback=validate_header_size,
+    help="Size of the record headers (2 or 4)."
+)
+@click.option(
+    '--alignment', default=2, show_default=True,
+    type=click.IntRange(min=2),
+    help="Alignment to use with RecordHeader."
+)
+@click.option(
+    '--workers', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of worker processes hashing the files and comparing the buckets."
+)
+@click.option(
+    '--max-memory', default=1024, show_default=True,
+    type=click.IntRange(min=16),
+    help="Memory budget in MB of the comparison: the record hashes are spilled to disk and compared by buckets that fit in it."
+)
+@click.option(
+    '--tmp-dir', 'tmp_dir', default=None,
+    type=click.Path(file_okay=False, writable=True),
+    help="Directory of the temporary hash files (default: the output directory). They take about 30 bytes (plus the key) per record."
+)
+def diff(path_old: str, path_new: str, path_output: str, file_format: str, key_start: Optional[int],
+         key_length: Optional[int], key_field: Optional[str], path_layout: Optional[str], statuses: list,
+         header_size: int, alignment: int, workers: int, max_memory: int, tmp_dir: Optional[str]) -> None:
+    """
+    Compare two snapshots of the same file and write only the records inserted, deleted or
+    updated in NEW, with their offset and status in each file, as Parquet or Arrow files.
+    With a primary key a record is matched by key (inserts, deletes and updates), without one by
+    content (inserts and deletes).
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    from ecopass.core.diff import diff_files
+    from ecopass.core.key_index import LIVE_STATUSES
+
+    if key_field is not None:
+        if path_layout is None:
+            raise click.UsageError("--key-field needs a --layout.")
+        try:
+            with open(path_layout) as f:
+                fields = {field.name: field for field in RecordDecoder(json.load(f), keep_columns=()).fields}
+        except (ValueError, KeyError, TypeError) as error:
+            raise click.ClickException(f"Invalid layout {path_layout}: {error}")
+        if key_field not in fields:
+            raise click.BadParameter(f"{key_field!r} is not a field of the layout.", param_hint='--key-field')
+        key_start, key_length = fields[key_field].start + 1, fields[key_field].length
+    if (key_start is None) != (key_length is None):
+        raise click.UsageError("Give the key with both --key-start and --key-length, or with --key-field.")
+    if os.path.isdir(path_output) and os.listdir(path_output):
+        raise click.UsageError(f"The output directory {path_output} is not empty.")
+
+    start_time = time.time()
+    try:
+        result = diff_files(
+            path_old, path_new, path_output, header_size=header_size, alignment=alignment,
+            key_start=key_start - 1 if key_start is not None else None, key_length=key_length,
+            statuses=statuses or LIVE_STATUSES, workers=workers, max_memory=max_memory * 1024 * 1024,
+            tmp_dir=tmp_dir, writer_options=dict(file_format=file_format),
+            on_step=lambda step: click.echo(f"{step.capitalize()}...", err=True),
+        )
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    duration = time.time() - start_time
+
+    console = Console()
+    table = Table(title=f"Diff {path_old} -> {path_new}")
+    table.add_column("Metric", style="cyan", no_wrap=True)
+    table.add_column("Value", style="magenta")
+    table.add_row("[bold]Records (old / new)[/bold]", f"{result.old_records:,} / {result.new_records:,}")
+    table.add_row("[bold]Common prefix[/bold]", f"{result.prefix_records:,} records")
+    table.add_row("[bold]Inserted[/bold]", f"{result.inserted:,}")
+    table.add_row("[bold]Deleted[/bold]", f"{result.deleted:,}")
+    table.add_row("[bold]Updated[/bold]", f"{result.updated:,}")
+    table.add_row("[bold]Unchanged[/bold]", f"{result.unchanged:,}")
+    table.add_row("[bold]Files written[/bold]", f"{len(result.files):,}")
+    table.add_row("[bold]Diff time[/bold]", format_time(duration))
+    console.print(table)
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
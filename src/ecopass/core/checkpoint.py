@@ -0,0 +1,195 @@
+"""
+This module contains the Checkpoint class, which records in the output directory which part
+of the input has already been converted, so a conversion can be resumed after a failure or
+continued on the records appended to the input since the previous run.
+
+The checkpoint (<output>/_ecopass_checkpoint.json) holds:
+- the input (path, header size, alignment, size and a hash of its first bytes)
+- the committed byte ranges of the input [start, stop): every record whose header is in a
+  committed range is in a closed Parquet file of the dataset
+- the number of records and the Parquet files of the committed ranges
+
+The ranges always start and stop on record headers, so the gaps between them (see gaps())
+can be read with RecordHeader.read_batches(start=..., stop=...).
+The checkpoint is written to a temporary file and renamed, so it is never partially written.
+"""
+import glob
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple
+
+CHECKPOINT_FILE = '_ecopass_checkpoint.json'
+CHECKPOINT_VERSION = 1
+
+# extensions of the part files written by the PartitionedWriter (see FILE_EXTENSIONS)
+_PART_EXTENSIONS = ('.parquet', '.arrow', '.arrows')
+
+# number of bytes at the start of the input hashed to detect a rewritten input
+_HEAD_BYTES = 64 * 1024
+
+
+#--------------------------------------------
+# hash of the first bytes of the input
+#--------------------------------------------
+def input_fingerprint(path_input: str, size: int) -> str:
+    """
+    Return a hash of the first bytes (up to size) of the input,
+    used to check that an input has only been appended to since the previous run.
+    """
+    with open(path_input, 'rb') as f:
+        return hashlib.sha1(f.read(min(size, _HEAD_BYTES))).hexdigest()
+
+
+class Checkpoint():
+    """
+    Checkpoint of a conversion: the committed byte ranges of the input and their Parquet files.
+    """
+    def __init__(self, path_output: str, path_input: str, header_size: int, alignment: int):
+        """
+        Initialize an empty checkpoint for the input.
+        """
+        self.path_output = path_output
+        self.path_input = os.path.abspath(path_input)
+        self.header_size = header_size
+        self.alignment = alignment
+        self.input_size = 0
+        self.fingerprint = ''
+        self.ranges: List[List[int]] = []   # committed [start, stop) ranges, sorted and merged
+        self.records = 0
+        self.files: List[str] = []
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.path_output, CHECKPOINT_FILE)
+
+    #--------------------------------------------
+    # load the checkpoint of the output directory
+    #--------------------------------------------
+    @classmethod
+    def load(cls, path_output: str) -> Optional['Checkpoint']:
+        """
+        Load the checkpoint of the output directory, None if there is none.
+        """
+        try:
+            with open(os.path.join(path_output, CHECKPOINT_FILE)) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {state.get('version')} in {path_output}")
+
+        checkpoint = cls(path_output, state['input'], state['header_size'], state['alignment'])
+        checkpoint.input_size = state['input_size']
+        checkpoint.fingerprint = state['fingerprint']
+        checkpoint.ranges = [list(r) for r in state['ranges']]
+        checkpoint.records = state['records']
+        checkpoint.files = list(state['files'])
+        return checkpoint
+
+    #--------------------------------------------
+    # check the checkpoint belongs to this input
+    #--------------------------------------------
+    def validate(self, path_input: str, header_size: int, alignment: int) -> None:
+        """
+        Raise a ValueError when the checkpoint was written for another input or other options,
+        or when the input was rewritten or truncated instead of appended to.
+        """
+        if os.path.abspath(path_input) != self.path_input:
+            raise ValueError(f"The checkpoint was written for {self.path_input}, not {os.path.abspath(path_input)}")
+        if (header_size, alignment) != (self.header_size, self.alignment):
+            raise ValueError(
+                f"The checkpoint was written with header-size={self.header_size} and alignment={self.alignment}"
+            )
+        size = os.path.getsize(path_input)
+        if size < self.input_size:
+            raise ValueError(f"The input is smaller than at the previous run ({size:,} < {self.input_size:,} bytes)")
+        if input_fingerprint(path_input, self.input_size) != self.fingerprint:
+            raise ValueError("The start of the input changed since the previous run (not an append-only file)")
+
+    def set_input_size(self, size: int) -> None:
+        """
+        Set the size of the input converted by this run (the end of the last gap).
+        """
+        self.input_size = size
+        self.fingerprint = input_fingerprint(self.path_input, size)
+
+    #--------------------------------------------
+    # ranges not converted yet
+    #--------------------------------------------
+    def gaps(self, end: int) -> List[Tuple[int, int]]:
+        """
+        Return the byte ranges of [0, end) that are not committed yet.
+        """
+        gaps = []
+        pos = 0
+        for start, stop in self.ranges:
+            if start > pos:
+                gaps.append((pos, min(start, end)))
+            pos = max(pos, stop)
+        if pos < end:
+            gaps.append((pos, end))
+        return [(start, stop) for start, stop in gaps if start < stop]
+
+    #--------------------------------------------
+    # commit a range
+    #--------------------------------------------
+    def commit(self, start: int, stop: int, records: int, files: List[str]) -> None:
+        """
+        Record that the records of [start, stop) are in the closed files and save the checkpoint.
+        """
+        if stop > start:
+            self.ranges.append([start, stop])
+        self.ranges.sort()
+        merged: List[List[int]] = []
+        for r in self.ranges:
+            if merged and r[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], r[1])
+            else:
+                merged.append(list(r))
+        self.ranges = merged
+        self.records += records
+        known = set(self.files)
+        self.files.extend(f for f in files if f not in known)
+        self.save()
+
+    def save(self) -> None:
+        """
+        Write the checkpoint (temporary file + rename).
+        """
+        os.makedirs(self.path_output, exist_ok=True)
+        state = dict(
+            version=CHECKPOINT_VERSION,
+            input=self.path_input,
+            header_size=self.header_size,
+            alignment=self.alignment,
+            input_size=self.input_size,
+            fingerprint=self.fingerprint,
+            ranges=self.ranges,
+            records=self.records,
+            files=self.files,
+        )
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    #--------------------------------------------
+    # remove the files of an interrupted run
+    #--------------------------------------------
+    def remove_uncommitted_files(self) -> List[str]:
+        """
+        Remove the part files of the output that are not in the checkpoint
+        (files left by an interrupted run, whose records are in a gap) and return them.
+        """
+        committed = set(self.files)
+        removed = []
+        paths = glob.glob(os.path.join(self.path_output, '*=*', 'part-*')) + glob.glob(os.path.join(self.path_output, 'part-*'))
+        for path in paths:
+            if not path.endswith(_PART_EXTENSIONS):
+                continue
+            relative_path = os.path.relpath(path, self.path_output).replace(os.sep, '/')
+            if relative_path not in committed:
+                os.remove(path)
+                removed.append(relative_path)
+        return removed
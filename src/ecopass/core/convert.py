@@ -0,0 +1,341 @@
+"""
+This module contains the conversion of a file into a Parquet dataset partitioned by rdw.
+
+The file can be converted sequentially or split in shards at record boundaries
+(RecordHeader.shard_boundaries) and converted by a pool of worker processes. Every worker
+opens its own memory map of the file, reads its shard with RecordHeader.read_batches and
+writes its own part files under the output directory with a PartitionedWriter.
+convert_files does the same for several files (each with its own output directory and
+checkpoint) with one pool, the biggest shards first.
+
+Both modes convert the gaps of a Checkpoint (the byte ranges not converted yet) and commit
+the ranges they finish to it, so a run can be resumed or continued on an appended input:
+- sequential: the files are committed every commit_bytes of record data and at the end of a gap
+- parallel: a shard is committed by the parent process once its worker is done
+
+Both modes can collect Metrics (see ecopass.core.metrics): the workers collect their own and
+send them back with their ShardResult, the parent process merges them.
+
+With a RecordDecoder (see ecopass.core.decoder) the value column of every batch is decoded
+into typed columns (one per field of the layout) before it is written.
+
+The part files are named after the shard and a sequence number per partition, so two runs
+with the same options always write the same files:
+    rdw=<length>/part-<shard>-<sequence>.parquet
+"""
+import contextlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import pyarrow as pa
+
+from ecopass.core.checkpoint import Checkpoint
+from ecopass.core.decoder import RecordDecoder
+from ecopass.core.metrics import DISABLED, Metrics
+from ecopass.core.partitioned_writer import PartitionedWriter
+from ecopass.core.record_header import RECORD_SCHEMA, RecordHeader, debug_logging
+from ecopass.core.verify import BadRegion
+
+
+# smallest shard of the parallel mode (unless there would be fewer shards than workers)
+MIN_SHARD_BYTES = 1024 * 1024 * 1024
+
+
+class ShardResult(NamedTuple):
+    """
+    Result of the conversion of one shard [start, stop) of the file.
+    stop is before the stop of the shard when the file ends before it (an incomplete header,
+    or an incomplete record of a growing file): only [start, stop) is committed.
+    """
+    shard: int
+    start: int
+    stop: int
+    records: int
+    batches: int
+    files: List[str]
+    metrics: Optional[Dict[str, Any]] = None
+    started: float = 0.0        # time.time() at the start and the end of the conversion
+    finished: float = 0.0
+    skipped: Tuple[BadRegion, ...] = ()     # bad regions skipped in tolerant mode
+
+
+#--------------------------------------------
+# prefix of the part files of a shard
+#--------------------------------------------
+def part_prefix(shard: int) -> str:
+    """
+    Prefix of the part files written for a shard.
+    """
+    return f"part-{shard:05d}"
+
+
+#--------------------------------------------
+# schema of the files written
+#--------------------------------------------
+def writer_schema(decoder: Optional[RecordDecoder] = None, input_schema: pa.Schema = RECORD_SCHEMA) -> pa.Schema:
+    """
+    Schema of the batches written: the schema of the batches read (RECORD_SCHEMA or STATUS_SCHEMA),
+    or the decoded columns with a decoder.
+    """
+    return decoder.schema(input_schema) if decoder is not None else input_schema
+
+
+#--------------------------------------------
+# convert the gaps sequentially
+#--------------------------------------------
+def convert_sequential(record_header: RecordHeader, writer: PartitionedWriter, checkpoint: Checkpoint,
+                       gaps: List[Tuple[int, int]], batch_size: int = 500_000,
+                       commit_bytes: int = 1024 * 1024 * 1024,
+                       on_batch: Optional[Callable[[pa.RecordBatch], None]] = None,
+                       decoder: Optional[RecordDecoder] = None, metrics: Metrics = DISABLED) -> None:
+    """
+    Convert the gaps in order with one PartitionedWriter.
+    Every commit_bytes of record data (and at the end of every gap) the open files are
+    closed and the range converted so far is committed to the checkpoint.
+    on_batch is called with every batch written.
+    With a decoder the batches are decoded before they are written (the writer must have been
+    created with the schema of the decoder, see writer_schema).
+    """
+    for start, stop in gaps:
+        range_start = end = start
+        records = 0
+        written = 0
+        batch_start = time.perf_counter()
+        for end, batch in record_header.read_positioned_batches(max_rows=batch_size, start=start, stop=stop):
+            _write_batch(batch, writer, decoder, metrics, batch_start)
+            records += batch.num_rows
+            written += batch.nbytes
+            if on_batch is not None and batch.num_rows:
+                on_batch(batch)
+
+            #-------------------------------------------------------------------
+            # commit: close the files and record the range in the checkpoint
+            #-------------------------------------------------------------------
+            if written >= commit_bytes:
+                with metrics.stage('commit'):
+                    checkpoint.commit(range_start, end, records, writer.commit())
+                range_start, records, written = end, 0, 0
+            if metrics.enabled:
+                batch_start = time.perf_counter()
+
+        if end > range_start:
+            with metrics.stage('commit'):
+                checkpoint.commit(range_start, end, records, writer.commit())
+
+
+def _write_batch(batch: pa.RecordBatch, writer: PartitionedWriter, decoder: Optional[RecordDecoder],
+                 metrics: Metrics, batch_start: float) -> None:
+    """
+    Decode (with a decoder) and write a batch read since batch_start.
+    """
+    if decoder is not None:
+        with metrics.stage('decode'):
+            batch = decoder.decode(batch)
+    with metrics.stage('write'):
+        writer.write_batch(batch)
+    if metrics.enabled and batch.num_rows:
+        metrics.add('batches')
+        metrics.add('records_written', batch.num_rows)
+        metrics.observe_batch(time.perf_counter() - batch_start)
+
+
+#--------------------------------------------
+# stream the records to a file object
+#--------------------------------------------
+def convert_to_stream(record_header: RecordHeader, sink: Any, batch_size: int = 500_000,
+                      on_batch: Optional[Callable[[pa.RecordBatch], None]] = None,
+                      decoder: Optional[RecordDecoder] = None, metrics: Metrics = DISABLED) -> None:
+    """
+    Write all the records of the file to sink (e.g. sys.stdout.buffer) as one Arrow IPC stream,
+    so another process can read the batches as they come without a round trip to the disk.
+    There is no checkpoint: a stream can't be resumed.
+    """
+    with pa.ipc.new_stream(sink, writer_schema(decoder, record_header.schema)) as writer:
+        batch_start = time.perf_counter()
+        for batch in record_header.read_batches(max_rows=batch_size):
+            if decoder is not None:
+                with metrics.stage('decode'):
+                    batch = decoder.decode(batch)
+            with metrics.stage('write'):
+                writer.write_batch(batch)
+            if metrics.enabled:
+                metrics.add('batches')
+                metrics.add('records_written', batch.num_rows)
+                metrics.observe_batch(time.perf_counter() - batch_start)
+                batch_start = time.perf_counter()
+            if on_batch is not None:
+                on_batch(batch)
+
+
+#--------------------------------------------
+# convert one shard (runs in a worker process)
+#--------------------------------------------
+def convert_shard(path_input: str, path_output: str, shard: int, start: int, stop: int,
+                  header_size: int = 2, alignment: int = 2, batch_size: int = 500_000,
+                  debug: bool = False, writer_options: Optional[Dict[str, Any]] = None,
+                  use_index: bool = False, decoder: Optional[RecordDecoder] = None,
+                  reader_options: Optional[Dict[str, Any]] = None, collect_metrics: bool = False) -> ShardResult:
+    """
+    Convert the records whose header is in [start, stop) into part files of the dataset.
+    writer_options are passed to the PartitionedWriter (max_file_bytes, max_open_writers, ...),
+    reader_options to the RecordHeader (include_statuses, exclude_statuses, record_length).
+    With use_index the records are taken from the sidecar index when it is valid.
+    With a decoder the batches are decoded before they are written.
+    With collect_metrics the Metrics of the shard are returned in the ShardResult.
+    """
+    if debug:
+        debug_logging()
+    started = time.time()
+    records = 0
+    batches = 0
+    metrics = Metrics() if collect_metrics else DISABLED
+    with RecordHeader(filename=path_input, header_size=header_size, alignment=alignment, debug=debug,
+                      metrics=metrics, **(reader_options or {})) as record_header, \
+            PartitionedWriter(path_output, prefix=part_prefix(shard), schema=writer_schema(decoder, record_header.schema),
+                              **(writer_options or {})) as writer:
+        if use_index:
+            record_header.load_index(build=False)
+        batch_start = time.perf_counter()
+        end = start
+        for end, batch in record_header.read_positioned_batches(max_rows=batch_size, start=start, stop=stop):
+            if not batch.num_rows:
+                continue
+            batches += 1
+            records += batch.num_rows
+            _write_batch(batch, writer, decoder, metrics, batch_start)
+            if metrics.enabled:
+                batch_start = time.perf_counter()
+        with metrics.stage('commit'):
+            writer.commit()
+    return ShardResult(
+        shard=shard, start=start, stop=min(end, stop), records=records, batches=batches, files=writer.files,
+        metrics=metrics.to_dict() if collect_metrics else None, started=started, finished=time.time(),
+        skipped=tuple(record_header.skipped),
+    )
+
+
+#--------------------------------------------
+# convert the gaps with a pool of workers
+#--------------------------------------------
+def convert_parallel(path_input: str, path_output: str, workers: int, checkpoint: Checkpoint,
+                     gaps: List[Tuple[int, int]], header_size: int = 2, alignment: int = 2,
+                     batch_size: int = 500_000, debug: bool = False,
+                     writer_options: Optional[Dict[str, Any]] = None, use_index: bool = False,
+                     on_shard_done: Optional[Callable[[ShardResult], None]] = None,
+                     decoder: Optional[RecordDecoder] = None,
+                     reader_options: Optional[Dict[str, Any]] = None,
+                     metrics: Metrics = DISABLED, min_shard_bytes: int = MIN_SHARD_BYTES) -> List[ShardResult]:
+    """
+    Split the gaps in shards at record boundaries and convert them with a process pool.
+    There are a few shards per worker so a slow shard doesn't leave the other workers idle,
+    as long as they are at least min_shard_bytes (see convert_files).
+    Every shard is committed to the checkpoint once it is written, then on_shard_done is called
+    (both in the parent process).
+    With use_index the sidecar index is loaded (or built and written) once by the parent,
+    the shards are cut from it and the workers read their records from it.
+    The decoder and the reader_options (filters) are sent to every worker.
+    The metrics of the workers are merged into metrics.
+    """
+    job = FileJob(path_input=path_input, path_output=path_output, checkpoint=checkpoint, gaps=gaps)
+    return convert_files(
+        [job], workers, header_size=header_size, alignment=alignment, batch_size=batch_size, debug=debug,
+        writer_options=writer_options, use_index=use_index,
+        on_shard_done=(lambda _, result: on_shard_done(result)) if on_shard_done is not None else None,
+        decoder=decoder, reader_options=reader_options, metrics=metrics, min_shard_bytes=min_shard_bytes,
+    )[0]
+
+
+class FileJob(NamedTuple):
+    """
+    An input to convert by convert_files: its output directory, checkpoint and gaps.
+    """
+    path_input: str
+    path_output: str
+    checkpoint: Checkpoint
+    gaps: List[Tuple[int, int]]
+
+
+@contextlib.contextmanager
+def _input_errors(path_input: str) -> Iterator[None]:
+    """
+    Add the input file to the ValueError of a bad record, so the failing file of several is known.
+    """
+    try:
+        yield
+    except ValueError as error:
+        raise ValueError(f"{path_input}: {error}") from error
+
+
+#--------------------------------------------
+# convert several files with one pool of workers
+#--------------------------------------------
+def convert_files(jobs: List[FileJob], workers: int, header_size: int = 2, alignment: int = 2,
+                  batch_size: int = 500_000, debug: bool = False,
+                  writer_options: Optional[Dict[str, Any]] = None, use_index: bool = False,
+                  on_shard_done: Optional[Callable[[int, ShardResult], None]] = None,
+                  decoder: Optional[RecordDecoder] = None,
+                  reader_options: Optional[Dict[str, Any]] = None,
+                  metrics: Metrics = DISABLED, min_shard_bytes: int = MIN_SHARD_BYTES) -> List[List[ShardResult]]:
+    """
+    Convert the gaps of several files with one process pool and return the ShardResults of
+    every job.
+    - the gaps are split in shards of about (total size / (workers * 4)) bytes, so a big file
+      is converted by several workers and a small file is a single shard
+    - a shard is at least min_shard_bytes (or total size / workers when the input is smaller
+      than workers * min_shard_bytes): every shard writes its own file per partition, so small
+      shards multiply the part files (min_shard_bytes plays the part of commit_bytes in the
+      sequential mode, which closes the files as often)
+    - the shards are submitted largest first, so the long ones don't end up last
+    - every shard is committed to the checkpoint of its job once it is written, then
+      on_shard_done(job number, result) is called (both in the parent process)
+    """
+    total = sum(stop - start for job in jobs for start, stop in job.gaps) or 1
+    target = max(total // (workers * 4), min(min_shard_bytes, -(-total // workers)), 1)
+
+    tasks: List[Tuple[int, int, int, int]] = []   # job number, shard, start, stop
+    with metrics.stage('shard'):
+        for number, job in enumerate(jobs):
+            shard = 0
+            with RecordHeader(filename=job.path_input, header_size=header_size, alignment=alignment,
+                              **(reader_options or {})) as record_header, _input_errors(job.path_input):
+                if use_index:
+                    record_header.load_index()
+                for start, stop in job.gaps:
+                    #-------------------------------------------------------------------
+                    # a gap smaller than the target size is a single shard (no header walk)
+                    #-------------------------------------------------------------------
+                    shards = max(1, round((stop - start) / target))
+                    boundaries = record_header.shard_boundaries(shards, start=start, stop=stop) if shards > 1 else [(start, stop)]
+                    for shard_start, shard_stop in boundaries:
+                        tasks.append((number, shard, shard_start, shard_stop))
+                        shard += 1
+    tasks.sort(key=lambda task: task[3] - task[2], reverse=True)
+
+    for job in jobs:
+        os.makedirs(job.path_output, exist_ok=True)
+    results: List[List[ShardResult]] = [[] for _ in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                convert_shard, jobs[number].path_input, jobs[number].path_output, shard, start, stop,
+                header_size, alignment, batch_size, debug, writer_options, use_index, decoder, reader_options,
+                metrics.enabled,
+            ): number
+            for number, shard, start, stop in tasks
+        }
+        for future in as_completed(futures):
+            number = futures[future]
+            with _input_errors(jobs[number].path_input):
+                result = future.result()
+            with metrics.stage('commit'):
+                jobs[number].checkpoint.commit(result.start, result.stop, result.records, result.files)
+            metrics.merge(result.metrics)
+            results[number].append(result)
+            if on_shard_done is not None:
+                on_shard_done(number, result)
+
+    for job_results in results:
+        job_results.sort()
+    return results
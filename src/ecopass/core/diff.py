@@ -0,0 +1,545 @@
+"""
+This module contains the comparison of two snapshots of the same file (change data capture),
+used by `ecopass diff old.bin new.bin`: only the records inserted, deleted or modified between
+the two snapshots are written, with their position and status in each file.
+
+The records are matched by key:
+- with a primary key (key_start, key_length), the records with the same key are the same
+  record: a key only in the old file is a delete, only in the new file an insert, and a key in
+  both with a different content an update
+- without a key, the content hash is the key: a file is a multiset of records, and the records
+  of the old file not found in the new one are deletes, the others inserts (no updates)
+A key found several times in a file is matched in file order (the first with the first, ...).
+
+The files are compared in three steps, within a memory budget whatever their size:
+1. the common prefix of the files is compared block by block: the records inside it are
+   identical and are not hashed (an extract that only got appended to is compared at once)
+2. the rest of both files is split in shards at record boundaries and hashed by a pool of
+   worker processes: every record gets a 64-bit hash of its content (blake2b), its key and its
+   position, and the entries are spilled to a temporary file per shard, grouped in PARTITIONS
+   partitions of the key hash (counting sort of every chunk of the shard)
+3. the partitions are grouped in buckets of entries that fit in the memory budget, and every
+   bucket is compared by a worker: the entries of both files are matched by (key, occurrence)
+   and the record data of the changes only is read back and written
+
+Only the headers and one read of the record data are needed for the files, plus the data of
+the changed records: hashing runs on every core, and the comparison only touches the entries.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from ecopass.core.key_index import LIVE_STATUSES
+from ecopass.core.lazy import lazy_import
+from ecopass.core.partitioned_writer import PartitionedWriter, write_dataset_metadata
+from ecopass.core.record_header import RecordHeader
+
+np = lazy_import('numpy')
+pa = lazy_import('pyarrow')
+
+DIFF_FILE = '_ecopass_diff.json'
+
+# values of the change column
+CHANGES = ('insert', 'delete', 'update')
+_INSERT, _DELETE, _UPDATE = range(3)
+
+# partitions of the key hash the entries are spilled in (grouped in buckets for the comparison)
+_PARTITION_BITS = 8
+PARTITIONS = 1 << _PARTITION_BITS
+
+# bytes compared at once while searching the end of the common prefix
+_BLOCK_BYTES = 16 * 1024 * 1024
+
+# records hashed and spilled at once by a worker
+_HASH_CHUNK = 500_000
+
+# changes written per batch (and at most _BATCH_BYTES of record data)
+_BATCH_ROWS = 100_000
+_BATCH_BYTES = 256 * 1024 * 1024
+
+# 64-bit FNV-1a, used to spread the keys over the partitions
+_FNV_OFFSET = 0xcbf29ce484222325
+_FNV_PRIME = 0x100000001b3
+
+
+class HashedShard(NamedTuple):
+    """
+    Entries of one shard of a file, spilled to path by hash_shard.
+    - side: 0 for the old file, 1 for the new one
+    - bases: first entry of every chunk in the file, counts: entries of every partition per chunk
+      (a chunk is sorted by partition, so a range of partitions is a slice of every chunk)
+    """
+    side: int
+    shard: int
+    path: str
+    records: int
+    bases: List[int]
+    counts: np.ndarray
+
+
+class BucketResult(NamedTuple):
+    """
+    Changes found in one bucket, and the files they were written to.
+    """
+    bucket: int
+    inserted: int
+    deleted: int
+    updated: int
+    files: List[str]
+
+
+class DiffResult(NamedTuple):
+    """
+    Result of diff_files.
+    - old_records / new_records: records compared in each file (prefix included)
+    - prefix_records: records of the common prefix, identical in both files and not hashed
+    - files: files written, relative to the output directory
+    """
+    old_records: int
+    new_records: int
+    prefix_records: int
+    inserted: int
+    deleted: int
+    updated: int
+    files: List[str]
+
+    @property
+    def unchanged(self) -> int:
+        return self.old_records - self.deleted - self.updated
+
+
+#--------------------------------------------
+# schema of the changes
+#--------------------------------------------
+def diff_schema(key_length: Optional[int] = None) -> pa.Schema:
+    """
+    Schema of the files written by diff_files:
+    - change: 'insert', 'delete' or 'update'
+    - key: the primary key (only with a key)
+    - old_offset / old_status and new_offset / new_status: position of the record header and
+      status in each file (null when the record isn't in that file)
+    - rdw, value: the record in the new file (in the old one for a delete)
+    """
+    fields = [('change', pa.string())]
+    if key_length:
+        fields.append(('key', pa.binary(key_length)))
+    fields += [
+        ('old_offset', pa.int64()), ('old_status', pa.uint8()),
+        ('new_offset', pa.int64()), ('new_status', pa.uint8()),
+        ('rdw', pa.int32()), ('value', pa.binary()),
+    ]
+    return pa.schema(fields)
+
+
+def _entry_dtype(key_length: int) -> np.dtype:
+    """
+    Entry of a record in the spill files: the key (the big-endian content hash without a
+    primary key), the content hash and the position, length and status of the record.
+    """
+    return np.dtype([
+        ('key', f'S{key_length}'), ('hash', '<u8'), ('offset', '<i8'), ('length', '<i4'), ('status', 'u1'),
+    ])
+
+
+#--------------------------------------------
+# common prefix of the files
+#--------------------------------------------
+def common_prefix(old_data, new_data) -> int:
+    """
+    Return the length of the common prefix of two buffers (memory maps), compared block by block.
+    """
+    size = min(len(old_data), len(new_data))
+    pos = 0
+    while pos < size:
+        count = min(_BLOCK_BYTES, size - pos)
+        old_block = np.frombuffer(old_data, dtype=np.uint8, count=count, offset=pos)
+        new_block = np.frombuffer(new_data, dtype=np.uint8, count=count, offset=pos)
+        try:
+            different = np.flatnonzero(old_block != new_block)
+        finally:
+            del old_block, new_block
+        if different.size:
+            return pos + int(different[0])
+        pos += count
+    return size
+
+
+def _prefix_records(record_header: RecordHeader, prefix: int, statuses: Sequence[int]) -> Tuple[int, int]:
+    """
+    Return the end of the last record entirely inside the first prefix bytes of the file
+    (the position to hash from) and the number of records with one of the statuses before it.
+    """
+    end = records = 0
+    alignment = record_header.alignment
+    header_size = record_header.header_size
+    for index in record_header._scan_chunks(stop=prefix, max_records=1_000_000):
+        lengths = index.lengths.astype(np.int64)
+        ends = index.offsets + header_size + lengths + (alignment - (header_size + lengths) % alignment) % alignment
+        inside = int(np.searchsorted(ends, prefix, side='right'))
+        if inside:
+            end = int(ends[inside - 1])
+            records += int(np.isin(index.statuses[:inside], np.array(statuses, dtype=np.uint8)).sum())
+        if inside < len(ends):
+            break
+    return end, records
+
+
+#--------------------------------------------
+# hash a shard (runs in a worker process)
+#--------------------------------------------
+def hash_shard(path_input: str, side: int, shard: int, start: int, stop: int, tmp_dir: str,
+               header_size: int = 2, alignment: int = 2, key_start: Optional[int] = None,
+               key_length: Optional[int] = None, statuses: Sequence[int] = LIVE_STATUSES) -> HashedShard:
+    """
+    Hash the records with one of the statuses whose header is in [start, stop) and spill their
+    entries to a file of tmp_dir, every chunk sorted by partition.
+    Records too short to hold the whole key get the bytes they have, padded with x'00'.
+    """
+    keyed = key_length is not None
+    dtype = _entry_dtype(key_length if keyed else 8)
+    path = os.path.join(tmp_dir, f"{side}-{shard:05d}.entries")
+    bases: List[int] = []
+    counts: List[np.ndarray] = []
+    records = 0
+    with RecordHeader(filename=path_input, header_size=header_size, alignment=alignment) as record_header, \
+            open(path, 'wb') as f:
+        data = record_header.mmap_obj
+        size = len(data)
+        for index in record_header._scan_chunks(start=start, stop=stop, max_records=_HASH_CHUNK):
+            keep = np.flatnonzero(np.isin(index.statuses, np.array(statuses, dtype=np.uint8)))
+            if not len(keep):
+                continue
+            entries = np.empty(len(keep), dtype=dtype)
+            entries['offset'] = index.offsets[keep]
+            entries['length'] = index.lengths[keep]
+            entries['status'] = index.statuses[keep]
+
+            #-------------------------------------------------------------------
+            # content hash of every record (hashlib releases the GIL on large records)
+            #-------------------------------------------------------------------
+            with memoryview(data) as view:
+                digests = b''.join(
+                    hashlib.blake2b(view[offset:offset + length], digest_size=8).digest()
+                    for offset, length in zip((entries['offset'] + header_size).tolist(), entries['length'].tolist())
+                )
+            entries['hash'] = np.frombuffer(digests, dtype='<u8')
+
+            if keyed:
+                columns = np.arange(key_length)
+                positions = (entries['offset'] + header_size + key_start)[:, None] + columns
+                inside = columns < (entries['length'].astype(np.int64) - key_start)[:, None]
+                view = np.frombuffer(data, dtype=np.uint8)
+                try:
+                    key_bytes = np.where(inside, view[np.minimum(positions, size - 1)], 0).astype(np.uint8)
+                finally:
+                    del view
+            else:
+                key_bytes = entries['hash'].astype('>u8').view(np.uint8).reshape(len(entries), 8)
+            entries['key'] = key_bytes.view(dtype['key']).ravel()
+
+            partitions = _partitions(key_bytes)
+            order = np.argsort(partitions, kind='stable')
+            bases.append(records)
+            counts.append(np.bincount(partitions, minlength=PARTITIONS))
+            entries[order].tofile(f)
+            records += len(entries)
+    return HashedShard(side, shard, path, records, bases,
+                       np.array(counts, dtype=np.int64).reshape(len(counts), PARTITIONS))
+
+
+def _partitions(key_bytes: np.ndarray) -> np.ndarray:
+    """
+    Partition of every key (a row of key_bytes): the top bits of its FNV-1a hash.
+    """
+    hashes = np.full(len(key_bytes), _FNV_OFFSET, dtype=np.uint64)
+    for column in key_bytes.T:
+        hashes ^= column
+        hashes *= np.uint64(_FNV_PRIME)
+    return (hashes >> np.uint64(64 - _PARTITION_BITS)).astype(np.int64)
+
+
+#--------------------------------------------
+# group the partitions in buckets
+#--------------------------------------------
+def plan_buckets(shards: Sequence[HashedShard], max_entries: int) -> List[Tuple[int, int]]:
+    """
+    Group the partitions in ranges [first, last) of up to max_entries entries (both files),
+    a partition larger than that being a bucket on its own.
+    """
+    totals = sum((shard.counts.sum(axis=0) for shard in shards), np.zeros(PARTITIONS, dtype=np.int64))
+    buckets = []
+    first = 0
+    entries = 0
+    for partition, count in enumerate(totals.tolist()):
+        if partition > first and entries + count > max_entries:
+            buckets.append((first, partition))
+            first, entries = partition, 0
+        entries += count
+    if entries:
+        buckets.append((first, PARTITIONS))
+    return buckets
+
+
+def _read_entries(shards: Sequence[HashedShard], side: int, first: int, last: int, dtype: np.dtype) -> np.ndarray:
+    """
+    Read the entries of the partitions [first, last) of one file, in file order.
+    """
+    parts = [np.empty(0, dtype=dtype)]
+    for shard in sorted((shard for shard in shards if shard.side == side), key=lambda shard: shard.shard):
+        for base, counts in zip(shard.bases, shard.counts):
+            begin = base + int(counts[:first].sum())
+            count = int(counts[first:last].sum())
+            if count:
+                parts.append(np.fromfile(shard.path, dtype=dtype, count=count, offset=begin * dtype.itemsize))
+    return np.concatenate(parts)
+
+
+def _match_keys(entries: np.ndarray) -> np.ndarray:
+    """
+    Return the key of every entry followed by its occurrence number among the entries with the
+    same key (big-endian), so duplicated keys are matched in file order.
+    """
+    order = np.argsort(entries['key'], kind='stable')
+    keys = entries['key'][order]
+    positions = np.arange(len(keys))
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    occurrence = np.empty(len(keys), dtype='>u4')
+    occurrence[order] = positions - np.maximum.accumulate(np.where(first, positions, 0))
+
+    key_length = entries.dtype['key'].itemsize
+    matched = np.empty(len(entries), dtype=[('key', f'S{key_length}'), ('occurrence', '>u4')])
+    matched['key'] = entries['key']
+    matched['occurrence'] = occurrence
+    return matched.view(f'S{key_length + 4}')
+
+
+#--------------------------------------------
+# compare a bucket (runs in a worker process)
+#--------------------------------------------
+def compare_bucket(bucket: int, first: int, last: int, shards: Sequence[HashedShard], path_old: str, path_new: str,
+                   path_output: str, header_size: int = 2, alignment: int = 2, key_length: Optional[int] = None,
+                   writer_options: Optional[dict] = None) -> BucketResult:
+    """
+    Match the entries of the partitions [first, last) of both files and write their changes,
+    ordered by change and position, to the part files of the bucket.
+    """
+    dtype = _entry_dtype(key_length if key_length is not None else 8)
+    old = _read_entries(shards, 0, first, last, dtype)
+    new = _read_entries(shards, 1, first, last, dtype)
+    _, old_matched, new_matched = np.intersect1d(_match_keys(old), _match_keys(new), assume_unique=True,
+                                                 return_indices=True)
+    changed = old['hash'][old_matched] != new['hash'][new_matched]
+    deleted = np.setdiff1d(np.arange(len(old)), old_matched, assume_unique=True)
+    inserted = np.setdiff1d(np.arange(len(new)), new_matched, assume_unique=True)
+    old_updated, new_updated = old_matched[changed], new_matched[changed]
+    del old_matched, new_matched
+
+    #-------------------------------------------------------------------
+    # one row per change: the old and new entries (-1: not in that file)
+    #-------------------------------------------------------------------
+    change = np.concatenate([
+        np.full(len(inserted), _INSERT, np.int8), np.full(len(deleted), _DELETE, np.int8),
+        np.full(len(old_updated), _UPDATE, np.int8),
+    ])
+    old_entries = _take(old, np.concatenate([np.full(len(inserted), -1), deleted, old_updated]))
+    new_entries = _take(new, np.concatenate([inserted, np.full(len(deleted), -1), new_updated]))
+    del old, new
+    in_new = new_entries['status'] > 0
+    entries = np.where(in_new, new_entries, old_entries)
+    order = np.lexsort((entries['offset'], change))
+    change, old_entries, new_entries, entries = change[order], old_entries[order], new_entries[order], entries[order]
+
+    files: List[str] = []
+    if len(change):
+        schema = diff_schema(key_length)
+        with RecordHeader(filename=path_old, header_size=header_size, alignment=alignment) as old_header, \
+                RecordHeader(filename=path_new, header_size=header_size, alignment=alignment) as new_header, \
+                PartitionedWriter(path_output, prefix=f"part-{bucket:05d}", schema=schema, partition_col=None,
+                                  **(writer_options or {})) as writer:
+            for begin, end in _batch_bounds(entries['length']):
+                writer.write_batch(_changes_batch(
+                    schema, change[begin:end], old_entries[begin:end], new_entries[begin:end],
+                    old_header.mmap_obj, new_header.mmap_obj, header_size,
+                ))
+            files = writer.commit()
+    return BucketResult(bucket, len(inserted), len(deleted), len(old_updated), files)
+
+
+def _take(entries: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Return the entries of the rows, with zeros (status 0, never a valid status) for the rows -1.
+    """
+    taken = np.zeros(len(rows), dtype=entries.dtype)
+    found = rows >= 0
+    taken[found] = entries[rows[found].astype(np.int64)]
+    return taken
+
+
+def _batch_bounds(lengths: np.ndarray) -> Iterable[Tuple[int, int]]:
+    """
+    Split the rows in batches of up to _BATCH_ROWS rows and _BATCH_BYTES of record data.
+    """
+    sizes = np.cumsum(lengths, dtype=np.int64)
+    begin = 0
+    while begin < len(lengths):
+        done = int(sizes[begin - 1]) if begin else 0
+        end = int(np.searchsorted(sizes, done + _BATCH_BYTES, side='right'))
+        end = min(max(end, begin + 1), begin + _BATCH_ROWS)
+        yield begin, end
+        begin = end
+
+
+def _changes_batch(schema: pa.Schema, change: np.ndarray, old_entries: np.ndarray, new_entries: np.ndarray,
+                   old_data, new_data, header_size: int) -> pa.RecordBatch:
+    """
+    Build the batch of some changes, reading their record data from the memory maps.
+    """
+    in_old, in_new = old_entries['status'] > 0, new_entries['status'] > 0
+    entries = np.where(in_new, new_entries, old_entries)
+    values = [
+        (new_data if from_new else old_data)[offset + header_size:offset + header_size + length]
+        for from_new, offset, length in zip(in_new.tolist(), entries['offset'].tolist(), entries['length'].tolist())
+    ]
+    columns = [pa.array(CHANGES, pa.string()).take(pa.array(change))]
+    if 'key' in schema.names:
+        keys = np.ascontiguousarray(entries['key'])
+        columns.append(pa.FixedSizeBinaryArray.from_buffers(
+            schema.field('key').type, len(keys), [None, pa.py_buffer(keys.tobytes())],
+        ))
+    columns += [
+        pa.array(old_entries['offset'], pa.int64(), mask=~in_old),
+        pa.array(old_entries['status'], pa.uint8(), mask=~in_old),
+        pa.array(new_entries['offset'], pa.int64(), mask=~in_new),
+        pa.array(new_entries['status'], pa.uint8(), mask=~in_new),
+        pa.array(entries['length'], pa.int32()),
+        pa.array(values, pa.binary()),
+    ]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+#--------------------------------------------
+# compare two files
+#--------------------------------------------
+def diff_files(path_old: str, path_new: str, path_output: str, header_size: int = 2, alignment: int = 2,
+               key_start: Optional[int] = None, key_length: Optional[int] = None,
+               statuses: Sequence[int] = LIVE_STATUSES, workers: int = 1, max_memory: int = 1024 * 1024 * 1024,
+               tmp_dir: Optional[str] = None, writer_options: Optional[dict] = None,
+               on_step: Optional[Callable[[str], None]] = None) -> DiffResult:
+    """
+    Compare two snapshots of a file and write the inserted, deleted and updated records (with
+    one of the statuses) to path_output, see diff_schema.
+    - key_start: 0-based position of the primary key in the records, key_length: its length
+      (None: the records are matched by content)
+    - workers: processes hashing the shards and comparing the buckets
+    - max_memory: bytes of entries compared at once by all the workers together
+    - tmp_dir: directory of the spill files (default: path_output), removed at the end
+    - writer_options: passed to the PartitionedWriter (file_format, compression, ...)
+    - on_step: called with the name of every step ('prefix', 'hash', 'compare')
+    The summary of the run is written to <path_output>/_ecopass_diff.json.
+    """
+    if (key_start is None) != (key_length is None):
+        raise ValueError("Give both key_start and key_length, or neither")
+    workers = max(workers, 1)
+    os.makedirs(path_output, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='.ecopass-diff-', dir=tmp_dir or path_output)
+    try:
+        #-------------------------------------------------------------------
+        # 1. common prefix: its records are the same in both files
+        #-------------------------------------------------------------------
+        if on_step is not None:
+            on_step('prefix')
+        tasks = []
+        with RecordHeader(filename=path_old, header_size=header_size, alignment=alignment) as old_header, \
+                RecordHeader(filename=path_new, header_size=header_size, alignment=alignment) as new_header:
+            prefix = common_prefix(old_header.mmap_obj, new_header.mmap_obj)
+            start, prefix_records = _prefix_records(old_header, prefix, statuses)
+            for side, record_header in enumerate((old_header, new_header)):
+                size = len(record_header.mmap_obj)
+                shards = workers * 2 if workers > 1 else 1
+                boundaries = record_header.shard_boundaries(shards, start=start) if shards > 1 else [(start, size)]
+                tasks.extend((side, shard, begin, stop) for shard, (begin, stop) in enumerate(boundaries))
+        tasks.sort(key=lambda task: task[3] - task[2], reverse=True)
+
+        #-------------------------------------------------------------------
+        # 2. hash the rest of both files
+        #-------------------------------------------------------------------
+        if on_step is not None:
+            on_step('hash')
+        paths = (path_old, path_new)
+        hashed = _run(workers, [
+            (hash_shard, paths[side], side, shard, begin, stop, scratch, header_size, alignment,
+             key_start, key_length, tuple(statuses))
+            for side, shard, begin, stop in tasks
+        ])
+
+        #-------------------------------------------------------------------
+        # 3. compare the buckets, each one within its share of the budget
+        # (the entries of both files, their match keys and the sorts: ~4 copies)
+        #-------------------------------------------------------------------
+        if on_step is not None:
+            on_step('compare')
+        entry_size = _entry_dtype(key_length if key_length is not None else 8).itemsize
+        max_entries = max(max_memory // workers // (4 * entry_size), 1)
+        options = dict(writer_options or {})
+        options.setdefault('row_group_bytes', min(128 * 1024 * 1024, max(max_memory // workers // 4, 1)))
+        options.setdefault('max_buffered_bytes', options['row_group_bytes'])
+        results: List[BucketResult] = _run(workers, [
+            (compare_bucket, bucket, first, last, hashed, path_old, path_new, path_output, header_size, alignment,
+             key_length, options)
+            for bucket, (first, last) in enumerate(plan_buckets(hashed, max_entries))
+        ])
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    files = sorted(path for result in results for path in result.files)
+    result = DiffResult(
+        old_records=prefix_records + sum(shard.records for shard in hashed if shard.side == 0),
+        new_records=prefix_records + sum(shard.records for shard in hashed if shard.side == 1),
+        prefix_records=prefix_records,
+        inserted=sum(result.inserted for result in results),
+        deleted=sum(result.deleted for result in results),
+        updated=sum(result.updated for result in results),
+        files=files,
+    )
+    if options.get('file_format', 'parquet') == 'parquet':
+        write_dataset_metadata(path_output, files)
+    write_diff_summary(path_output, path_old, path_new, result, key_start=key_start, key_length=key_length)
+    return result
+
+
+def _run(workers: int, tasks: List[Tuple[Any, ...]]) -> List[Any]:
+    """
+    Run the tasks (function, *args) in a pool of worker processes, or in this process with one worker.
+    """
+    if workers == 1 or len(tasks) <= 1:
+        return [function(*args) for function, *args in tasks]
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+        futures = [executor.submit(*task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+#--------------------------------------------
+# summary of the run
+#--------------------------------------------
+def write_diff_summary(path_output: str, path_old: str, path_new: str, result: DiffResult, **options: Any) -> str:
+    """
+    Write the counts and the files of a diff to <path_output>/_ecopass_diff.json and return its path.
+    """
+    path = os.path.join(path_output, DIFF_FILE)
+    summary = dict(
+        old=os.path.abspath(path_old), new=os.path.abspath(path_new), **options,
+        **{name: value for name, value in result._asdict().items() if name != 'files'},
+        unchanged=result.unchanged, files=result.files,
+    )
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,269 @@
+"""
+This module contains the key index, a sidecar file that maps the primary key of the records
+of an indexed file to their position, so records can be looked up by key (or by key range)
+without reading the whole file.
+
+The .idx file of a Micro Focus indexed file (or the index blocks of an IDXFORMAT8 file) is not
+read: its B-tree layout depends on the IDXFORMAT and the file options. The key index is built
+from the data records instead, in one pass over the headers, and kept next to the data file
+(<filename>.ecpkey), so every lookup after the first one is a binary search over memory mapped
+sorted keys.
+
+Pointer records (status 6) are skipped without a warning: when a record of an indexed file is
+rewritten longer, it is moved and a pointer record is left at its old position; the moved
+record ("referenced by a pointer", status 7 or 8) holds the whole record, key included, so it's
+indexed at its new position. A lookup never returns the pointer record or its old position,
+and a pointer whose moved record isn't in the file (e.g. a file copied mid-transaction) is lost.
+
+When the file only grew since the key index was written (larger, with the same bytes at the
+start and at the end of the indexed part), the index is updated instead of
+rebuilt: only the headers after the last indexed record are scanned, and their keys are
+merged into the sorted arrays. Like `ecopass convert --incremental`, this assumes the records
+already indexed weren't rewritten in place (a deleted or rewritten record of the indexed part
+is only seen by a full rebuild, e.g. after removing the .ecpkey file).
+
+The index file has a fixed 64-byte header followed by the arrays, sorted by key:
+- header: magic, format version, header size, alignment, key start and length, size and mtime
+  of the indexed file, number of records, end of the last indexed record and a hash of the
+  indexed part (little-endian)
+- keys: key_length bytes per record
+- offsets: int64[count], position of the record headers
+- lengths: int32[count]
+- statuses: uint8[count]
+Like the record index, it's only used when the file and the key match the ones it was built with.
+"""
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+from ecopass.core.lazy import lazy_import
+from ecopass.core.record_index import RecordIndex
+
+np = lazy_import('numpy')
+
+KEY_INDEX_SUFFIX = '.ecpkey'
+KEY_INDEX_MAGIC = b'ECPKEY\x00\x00'
+KEY_INDEX_VERSION = 2
+
+# statuses of the records holding user data: normal and reduced, at their place or moved
+LIVE_STATUSES = (4, 5, 7, 8)
+
+# magic, version, header_size, alignment, key_start, key_length, file_size, file_mtime_ns, count,
+# end (of the last indexed record), fingerprint (see _fingerprint)
+_KEY_INDEX_HEADER = struct.Struct('<8sHHIIIqqqq8s')
+_KEY_INDEX_HEADER_SIZE = 64
+
+# bytes hashed at the start and at the end of the indexed part of the file
+_FINGERPRINT_BYTES = 64 * 1024
+
+# records whose keys are copied at once while the index is built
+_BUILD_CHUNK = 1_000_000
+
+
+class KeyIndex(NamedTuple):
+    """
+    Records of a file sorted by key.
+    - keys: the keys (NumPy bytes array, dtype S<key_length>)
+    - offsets, lengths, statuses: like RecordIndex, in the order of the keys
+    """
+    keys: np.ndarray
+    offsets: np.ndarray
+    lengths: np.ndarray
+    statuses: np.ndarray
+
+
+#--------------------------------------------
+# path of the key index of a file
+#--------------------------------------------
+def key_index_path_for(filename: str) -> str:
+    """
+    Return the path of the sidecar key index of a file.
+    """
+    return os.fspath(filename) + KEY_INDEX_SUFFIX
+
+
+#--------------------------------------------
+# build the key index
+#--------------------------------------------
+def build_key_index(data: mmap.mmap, index: RecordIndex, header_size: int, key_start: int, key_length: int,
+                    statuses: Sequence[int] = LIVE_STATUSES) -> KeyIndex:
+    """
+    Build the KeyIndex of the records of the index with one of the statuses.
+    - data: memory map of the file
+    - key_start: 0-based position of the key in the record, key_length: its length in bytes
+    Records too short to hold the key are not indexed.
+    """
+    keep = np.isin(index.statuses, np.array(statuses, dtype=np.uint8))
+    keep &= index.lengths >= key_start + key_length
+    numbers = np.flatnonzero(keep)
+
+    keys = np.empty(len(numbers), dtype=f'S{key_length}')
+    if len(numbers):
+        view = np.frombuffer(data, dtype=np.uint8)
+        try:
+            #-------------------------------------------------------------------
+            # gather the key bytes of a chunk of records as a (records, key_length) matrix
+            #-------------------------------------------------------------------
+            key_bytes = keys.view(np.uint8).reshape(len(numbers), key_length)
+            columns = np.arange(key_length)
+            for first in range(0, len(numbers), _BUILD_CHUNK):
+                chunk = numbers[first:first + _BUILD_CHUNK]
+                starts = index.offsets[chunk].astype(np.int64) + header_size + key_start
+                key_bytes[first:first + len(chunk)] = view[starts[:, None] + columns]
+        finally:
+            del view
+
+    order = np.argsort(keys, kind='stable')
+    numbers = numbers[order]
+    return KeyIndex(
+        keys=keys[order],
+        offsets=np.asarray(index.offsets[numbers], dtype=np.int64),
+        lengths=np.asarray(index.lengths[numbers], dtype=np.int32),
+        statuses=np.asarray(index.statuses[numbers], dtype=np.uint8),
+    )
+
+
+#--------------------------------------------
+# look up keys
+#--------------------------------------------
+def key_range(key_index: KeyIndex, low: bytes, high: Optional[bytes] = None) -> KeyIndex:
+    """
+    Return the records whose key is low (high is None) or between low and high (both included).
+    """
+    first = int(np.searchsorted(key_index.keys, low, side='left'))
+    last = int(np.searchsorted(key_index.keys, low if high is None else high, side='right'))
+    last = max(first, last)
+    return KeyIndex(*(array[first:last] for array in key_index))
+
+
+#--------------------------------------------
+# add the records appended to the file
+#--------------------------------------------
+def merge_key_indexes(key_index: KeyIndex, appended: KeyIndex) -> KeyIndex:
+    """
+    Return the KeyIndex of the records of both indexes, the ones of appended being after the
+    ones of key_index in the file (the same order as build_key_index on the whole file).
+    """
+    positions = np.searchsorted(key_index.keys, appended.keys, side='right')
+    return KeyIndex(*(np.insert(np.asarray(old), positions, new) for old, new in zip(key_index, appended)))
+
+
+def _fingerprint(data: mmap.mmap, end: int) -> bytes:
+    """
+    Hash of the first and the last bytes of data[:end], to check that the indexed part of a
+    file is still there when the file grew.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(data[:min(end, _FINGERPRINT_BYTES)])
+    digest.update(data[max(end - _FINGERPRINT_BYTES, 0):end])
+    return digest.digest()
+
+
+#--------------------------------------------
+# write the key index
+#--------------------------------------------
+def write_key_index(key_index: KeyIndex, filename: str, header_size: int, alignment: int, key_start: int,
+                    key_length: int, key_index_path: Optional[str] = None, data: Optional[mmap.mmap] = None,
+                    end: int = 0) -> str:
+    """
+    Write the KeyIndex of a file to its sidecar key index and return the path of the index.
+    - data: memory map of the file, end: end of the last indexed record (RecordIndex.end),
+      kept so the index can be updated when the file grows (see load_appendable_key_index)
+    """
+    key_index_path = key_index_path or key_index_path_for(filename)
+    stat = os.stat(filename)
+    header = _KEY_INDEX_HEADER.pack(
+        KEY_INDEX_MAGIC, KEY_INDEX_VERSION, header_size, alignment, key_start, key_length,
+        stat.st_size, stat.st_mtime_ns, len(key_index.keys),
+        end if data is not None else 0, _fingerprint(data, end) if data is not None else bytes(8),
+    )
+    tmp_path = key_index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(_KEY_INDEX_HEADER_SIZE, b'\x00'))
+        f.write(np.ascontiguousarray(key_index.keys).tobytes())
+        f.write(np.ascontiguousarray(key_index.offsets, dtype='<i8').tobytes())
+        f.write(np.ascontiguousarray(key_index.lengths, dtype='<i4').tobytes())
+        f.write(np.ascontiguousarray(key_index.statuses, dtype=np.uint8).tobytes())
+    os.replace(tmp_path, key_index_path)
+    return key_index_path
+
+
+#--------------------------------------------
+# load the key index
+#--------------------------------------------
+def load_key_index(filename: str, header_size: int, alignment: int, key_start: int, key_length: int,
+                   key_index_path: Optional[str] = None) -> Optional[KeyIndex]:
+    """
+    Load the sidecar key index of a file (memory mapped).
+    Return None if there is no key index or if it doesn't match the file or the key anymore.
+    """
+    loaded = _read_key_index(filename, header_size, alignment, key_start, key_length, key_index_path)
+    if loaded is None:
+        return None
+    key_index, file_size, file_mtime_ns, _, _ = loaded
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if (file_size, file_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return key_index
+
+
+def load_appendable_key_index(filename: str, data: mmap.mmap, header_size: int, alignment: int, key_start: int,
+                              key_length: int, key_index_path: Optional[str] = None) -> Optional[Tuple[KeyIndex, int]]:
+    """
+    Load the sidecar key index of a file that grew since the index was written, and return it
+    with the position of the first record it doesn't hold (see merge_key_indexes).
+    Return None if there is no key index or if the indexed part of the file changed.
+    """
+    loaded = _read_key_index(filename, header_size, alignment, key_start, key_length, key_index_path)
+    if loaded is None:
+        return None
+    key_index, file_size, _, end, fingerprint = loaded
+    if end == 0 or len(data) <= file_size or _fingerprint(data, end) != fingerprint:
+        return None
+    return key_index, end
+
+
+def _read_key_index(filename: str, header_size: int, alignment: int, key_start: int, key_length: int,
+                    key_index_path: Optional[str]) -> Optional[Tuple[KeyIndex, int, int, int, bytes]]:
+    """
+    Return the key index of the file with the size and mtime of the file it was built from, the
+    end of its last record and the fingerprint of the indexed part (None if there is no valid
+    key index for the key).
+    """
+    key_index_path = key_index_path or key_index_path_for(filename)
+    try:
+        with open(key_index_path, 'rb') as f:
+            header = f.read(_KEY_INDEX_HEADER_SIZE)
+    except OSError:
+        return None
+    if len(header) < _KEY_INDEX_HEADER_SIZE:
+        return None
+
+    magic, version, index_header_size, index_alignment, index_key_start, index_key_length, \
+        file_size, file_mtime_ns, count, end, fingerprint = _KEY_INDEX_HEADER.unpack_from(header)
+    if magic != KEY_INDEX_MAGIC or version != KEY_INDEX_VERSION:
+        return None
+    if (index_header_size, index_alignment, index_key_start, index_key_length) != \
+            (header_size, alignment, key_start, key_length):
+        return None
+    if os.path.getsize(key_index_path) != _KEY_INDEX_HEADER_SIZE + count * (key_length + 13):
+        return None
+
+    if count == 0:
+        key_index = KeyIndex(np.empty(0, f'S{key_length}'), np.empty(0, np.int64), np.empty(0, np.int32),
+                             np.empty(0, np.uint8))
+    else:
+        position = _KEY_INDEX_HEADER_SIZE
+        arrays = []
+        for dtype, size in ((f'S{key_length}', key_length), ('<i8', 8), ('<i4', 4), (np.uint8, 1)):
+            arrays.append(np.memmap(key_index_path, dtype=dtype, mode='r', offset=position, shape=(count,)))
+            position += count * size
+        key_index = KeyIndex(*arrays)
+    return key_index, file_size, file_mtime_ns, end, fingerprint
@@ -0,0 +1,37 @@
+"""
+This module contains lazy_import, which keeps NumPy and pyarrow out of the imports of the light
+modules (RecordHeader, the record and key indexes, the checks, the metrics, the decoder and the
+writer), so `import ecopass.core.record_header` and the help of the CLI only load the stdlib:
+the module is imported the first time one of its attributes is used.
+
+The modules using it have `from __future__ import annotations`, so annotations like np.ndarray
+are not evaluated when the functions are defined.
+"""
+import importlib
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Placeholder of a module not imported yet: the first attribute used imports the module
+    (importlib takes care of the locking between threads) and copies its attributes.
+    Not importlib.util.LazyLoader: its find_spec imports the parent package (pyarrow for
+    pyarrow.parquet) and it puts the module in sys.modules before it's used.
+    """
+    def __getattr__(self, name: str):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+#--------------------------------------------
+# import a module on first use
+#--------------------------------------------
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Return the module if it's already imported, otherwise a placeholder that imports it on first use.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
@@ -0,0 +1,99 @@
+"""
+This module contains the helpers of the multi-file conversion:
+- expand_inputs: the input files of a list of paths, glob patterns and directories
+- source_names: a unique name per input, used for its output directory
+- write_manifest: the manifest of a run (_ecopass_manifest.json in the output directory)
+
+With several inputs, each one is converted into its own sub-directory of the output:
+    <output>/source=<name>/rdw=<length>/part-<shard>-<sequence>.parquet
+so each input keeps its own checkpoint (--resume and --incremental work per input), and the
+whole output can be read as one dataset with a `source` column (hive partitioning).
+"""
+import glob
+import json
+import os
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Sequence
+
+from ecopass.core.record_index import INDEX_SUFFIX
+
+MANIFEST_FILE = '_ecopass_manifest.json'
+
+# files of a directory that are never inputs
+_IGNORED_SUFFIXES = (INDEX_SUFFIX, '.tmp', '.parquet', '.json')
+
+
+#--------------------------------------------
+# list the input files
+#--------------------------------------------
+def expand_inputs(paths: Sequence[str]) -> List[str]:
+    """
+    Return the input files of the paths, in order and without duplicates:
+    - a file is used as is
+    - a directory gives its files (recursively), except ecopass index, checkpoint and output files
+    - any other path is a glob pattern (e.g. "extracts/*.dat")
+    Raise a ValueError when a path matches no file.
+    """
+    files: List[str] = []
+    for path in paths:
+        if os.path.isfile(path):
+            matches = [path]
+        elif os.path.isdir(path):
+            matches = []
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                matches.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if not name.startswith(('.', '_')) and not name.endswith(_IGNORED_SUFFIXES)
+                )
+        else:
+            matches = sorted(p for p in glob.glob(path, recursive=True) if os.path.isfile(p))
+        if not matches:
+            raise ValueError(f"No input file matches {path}")
+        files.extend(matches)
+
+    unique = {}
+    for path in files:
+        unique.setdefault(os.path.abspath(path), path)
+    return list(unique.values())
+
+
+#--------------------------------------------
+# unique name of every input
+#--------------------------------------------
+def source_names(paths: Sequence[str]) -> List[str]:
+    """
+    Return a name per input to use as its partition value: the file name, or the path relative
+    to the common directory of the inputs when two files have the same name.
+    Characters that can't be used in a partition value are replaced by '_'.
+    """
+    absolute = [os.path.abspath(path) for path in paths]
+    names = [os.path.basename(path) for path in absolute]
+    if len(set(names)) < len(names):
+        common = os.path.commonpath([os.path.dirname(path) for path in absolute])
+        names = [os.path.relpath(path, common).replace(os.sep, '__') for path in absolute]
+    return [re.sub(r'[^A-Za-z0-9._-]', '_', name) for name in names]
+
+
+#--------------------------------------------
+# write the manifest of the run
+#--------------------------------------------
+def write_manifest(path_output: str, entries: List[Dict[str, Any]], **extra: Any) -> str:
+    """
+    Write the manifest of the run (one entry per input: input, source, output, size, records,
+    files, duration) next to the outputs and return its path.
+    """
+    manifest = dict(
+        created_at=datetime.now().isoformat(timespec='seconds'),
+        **extra,
+        inputs=entries,
+    )
+    path = os.path.join(path_output, MANIFEST_FILE)
+    os.makedirs(path_output, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
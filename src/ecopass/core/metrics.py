@@ -0,0 +1,276 @@
+"""
+This module contains the Metrics class, which collects machine-readable metrics of a run:
+- cumulative time per stage: scan (header walk), build (Arrow batches from the memory map),
+  decode (copybook fields), write (partitioning and Parquet encoding), commit (closing the files
+  and writing the checkpoint)
+- counters: bytes read and written, records per status, batches
+- latency of the batches (time from reading a batch to having written it): their number and
+  sum, and percentiles computed from a bounded reservoir sample (LATENCY_RESERVOIR latencies,
+  every batch having the same chance to be kept), so a long run doesn't grow the memory
+- peak RSS of the process and its worker processes
+
+The metrics can be exported as JSON or as a Prometheus textfile (for the node_exporter textfile
+collector). With the stages of the pipelined mode running at the same time, the stage times
+can add up to more than the duration of the run.
+
+A disabled Metrics (the default everywhere) does nothing: stage() returns a shared no-op
+context manager and the callers check `enabled` before computing anything for it.
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from ecopass.core.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+_NO_OP = contextlib.nullcontext()
+
+# percentiles of the batch latency reported
+PERCENTILES = (50, 90, 99)
+
+# batch latencies kept to compute the percentiles
+LATENCY_RESERVOIR = 10_000
+
+
+class Metrics():
+    """
+    Metrics of a run (see the module docstring). Safe to update from several threads.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stage_seconds: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        self.records_per_status: Dict[int, int] = {}
+        self.batch_latencies: List[float] = []      # reservoir sample of the latencies
+        self.batch_latency_count = 0
+        self.batch_latency_sum = 0.0
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    #--------------------------------------------
+    # time a stage
+    #--------------------------------------------
+    def stage(self, name: str):
+        """
+        Context manager adding the time spent in the block to the stage.
+        """
+        if not self.enabled:
+            return _NO_OP
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed_iter(self, iterable: Iterable, name: str) -> Iterator:
+        """
+        Iterate over iterable, adding the time spent producing every item to the stage.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+
+    #--------------------------------------------
+    # counters
+    #--------------------------------------------
+    def add(self, name: str, value: int = 1) -> None:
+        """
+        Add value to a counter (bytes_read, bytes_written, batches, ...).
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def count_statuses(self, statuses: np.ndarray) -> None:
+        """
+        Count the records of every status (statuses is the uint8 array of a RecordIndex).
+        """
+        if not self.enabled or not len(statuses):
+            return
+        counts = np.bincount(statuses, minlength=16)
+        with self._lock:
+            for status in np.flatnonzero(counts):
+                self.records_per_status[int(status)] = self.records_per_status.get(int(status), 0) + int(counts[status])
+
+    def observe_batch(self, seconds: float) -> None:
+        """
+        Record the latency of a batch.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.batch_latency_count += 1
+            self.batch_latency_sum += seconds
+            if len(self.batch_latencies) < LATENCY_RESERVOIR:
+                self.batch_latencies.append(seconds)
+            else:
+                slot = self._random.randrange(self.batch_latency_count)
+                if slot < LATENCY_RESERVOIR:
+                    self.batch_latencies[slot] = seconds
+
+    #--------------------------------------------
+    # combine the metrics of the worker processes
+    #--------------------------------------------
+    def merge(self, other: Dict[str, Any]) -> None:
+        """
+        Add the metrics of another run (the to_dict() of a worker) to these ones.
+        """
+        if not self.enabled or not other:
+            return
+        with self._lock:
+            for name, seconds in other['stage_seconds'].items():
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+            for name, value in other['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for status, count in other['records_per_status'].items():
+                self.records_per_status[int(status)] = self.records_per_status.get(int(status), 0) + count
+            latencies = other.get('batch_latencies', [])
+            count = other.get('batch_latency_count', len(latencies))
+            self.batch_latencies = self._merge_latencies(latencies, count)
+            self.batch_latency_count += count
+            self.batch_latency_sum += other.get('batch_latency_sum_seconds', sum(latencies))
+
+    def _merge_latencies(self, latencies: List[float], count: int) -> List[float]:
+        """
+        Return a reservoir of the latencies of both runs, each run taking a share of it in
+        proportion to its number of batches.
+        """
+        if len(self.batch_latencies) + len(latencies) <= LATENCY_RESERVOIR:
+            return self.batch_latencies + list(latencies)
+        total = self.batch_latency_count + count
+        own = round(LATENCY_RESERVOIR * self.batch_latency_count / total)
+        own = max(min(own, len(self.batch_latencies)), LATENCY_RESERVOIR - len(latencies))
+        return (self._random.sample(self.batch_latencies, own)
+                + self._random.sample(list(latencies), LATENCY_RESERVOIR - own))
+
+    #--------------------------------------------
+    # export
+    #--------------------------------------------
+    def to_dict(self, include_latencies: bool = True) -> Dict[str, Any]:
+        """
+        Return the metrics as a dict (with the reservoir of batch latencies when include_latencies
+        is True, used to send the metrics of a worker to the parent process).
+        """
+        latencies = np.array(self.batch_latencies, dtype=np.float64)
+        result: Dict[str, Any] = dict(
+            duration_seconds=time.perf_counter() - self._start,
+            stage_seconds=dict(sorted(self.stage_seconds.items())),
+            counters=dict(sorted(self.counters.items())),
+            records_per_status={str(k): v for k, v in sorted(self.records_per_status.items())},
+            batch_latency_seconds={
+                f"p{p}": float(np.percentile(latencies, p)) if len(latencies) else None for p in PERCENTILES
+            },
+            batch_latency_count=self.batch_latency_count,
+            batch_latency_sum_seconds=self.batch_latency_sum,
+            peak_rss_bytes=peak_rss_bytes(),
+        )
+        if include_latencies:
+            result['batch_latencies'] = self.batch_latencies
+        return result
+
+    def write_json(self, path: str, **extra: Any) -> None:
+        """
+        Write the metrics (and the extra values, e.g. the input and the records written) as JSON.
+        """
+        state = dict(extra, **self.to_dict(include_latencies=False))
+        _write_atomic(path, json.dumps(state, indent=2))
+
+    def write_prometheus(self, path: str, **labels: str) -> None:
+        """
+        Write the metrics in the Prometheus text format, with the labels on every sample.
+        """
+        state = self.to_dict(include_latencies=False)
+        base = ','.join(f'{k}="{_escape(str(v))}"' for k, v in sorted(labels.items()))
+
+        def sample(name: str, value: Any, **extra_labels: str) -> str:
+            label_text = ','.join(filter(None, [base] + [f'{k}="{_escape(v)}"' for k, v in extra_labels.items()]))
+            return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+        lines = [
+            "# HELP ecopass_run_duration_seconds Duration of the run.",
+            "# TYPE ecopass_run_duration_seconds gauge",
+            sample("ecopass_run_duration_seconds", round(state['duration_seconds'], 6)),
+            "# HELP ecopass_stage_seconds_total Cumulative time spent in each stage.",
+            "# TYPE ecopass_stage_seconds_total counter",
+        ]
+        lines += [sample("ecopass_stage_seconds_total", round(v, 6), stage=k) for k, v in state['stage_seconds'].items()]
+        for name, value in state['counters'].items():
+            lines += [f"# TYPE ecopass_{name}_total counter", sample(f"ecopass_{name}_total", value)]
+        lines += ["# HELP ecopass_records_total Records scanned per status.", "# TYPE ecopass_records_total counter"]
+        lines += [sample("ecopass_records_total", v, status=k) for k, v in state['records_per_status'].items()]
+        lines += ["# HELP ecopass_batch_latency_seconds Latency of the batches.", "# TYPE ecopass_batch_latency_seconds summary"]
+        lines += [
+            sample("ecopass_batch_latency_seconds", round(v, 6), quantile=str(int(k[1:]) / 100))
+            for k, v in state['batch_latency_seconds'].items() if v is not None
+        ]
+        lines += [
+            sample("ecopass_batch_latency_seconds_sum", round(state['batch_latency_sum_seconds'], 6)),
+            sample("ecopass_batch_latency_seconds_count", state['batch_latency_count']),
+        ]
+        lines += [
+            "# HELP ecopass_peak_rss_bytes Peak resident memory of the process and its workers.",
+            "# TYPE ecopass_peak_rss_bytes gauge",
+            sample("ecopass_peak_rss_bytes", state['peak_rss_bytes']),
+            "# TYPE ecopass_last_run_timestamp_seconds gauge",
+            sample("ecopass_last_run_timestamp_seconds", int(time.time())),
+        ]
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+# shared disabled instance, the default of RecordHeader and the conversion functions
+DISABLED = Metrics(enabled=False)
+
+
+#--------------------------------------------
+# helpers
+#--------------------------------------------
+def peak_rss_bytes() -> Optional[int]:
+    """
+    Peak RSS of the process and of its (finished) worker processes, None if unknown.
+    """
+    try:
+        import resource
+        import sys
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024   # ru_maxrss is in bytes on macOS, KB elsewhere
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path: str, text: str) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
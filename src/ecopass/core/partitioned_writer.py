@@ -0,0 +1,375 @@
+"""
+This module contains the PartitionedWriter class, which writes record batches into a Parquet
+dataset partitioned by rdw (hive layout: <root>/rdw=<length>/<prefix>-<sequence>.parquet).
+
+Instead of writing a new file in every partition for every batch, the PartitionedWriter keeps
+one open ParquetWriter per partition and appends row groups to it:
+- the rows of a partition are buffered until the buffer reaches row_group_bytes (the biggest
+  buffers are written earlier when all the buffers together reach max_buffered_bytes)
+- a file is closed (rolled over) once it reaches max_file_bytes, the next rows go to a new file
+- at most max_open_writers files are open at the same time, the least recently used one is
+  closed when a new partition needs a writer
+- commit() closes every open file, so all the rows written so far are in complete files
+  (the next rows of a partition go to a new file)
+- write_dataset_metadata writes the _common_metadata and _metadata summary files at the end
+
+A file name already used in the output directory is never overwritten: the sequence number
+is increased until the name is free, so several runs can append to the same dataset.
+
+The files can also be written in the Arrow IPC formats (file_format), which consumers like
+DuckDB, Polars or pyarrow can memory map without a copy:
+- 'arrow': IPC file format (Feather v2), with random access to the batches
+- 'arrow-stream': IPC stream format
+The partition column can be any column of the batches (e.g. 'status'), or None to write all
+the rows to <root>/<prefix>-<sequence>.<extension> without partitions.
+
+With fixed_size, the `value` column of every rdw=N partition is written as fixed_size_binary(N)
+(a Parquet FIXED_LEN_BYTE_ARRAY) instead of binary: every record of the partition has N bytes,
+so the 4-byte length of every value is dropped. The files of different partitions then have
+different schemas, see write_dataset_metadata.
+"""
+from __future__ import annotations
+
+import os
+import warnings
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from ecopass.core.lazy import lazy_import
+from ecopass.core.record_header import record_schema
+
+np = lazy_import('numpy')
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+
+
+# extension of the files of every file format
+FILE_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow', 'arrow-stream': '.arrows'}
+
+# first pyarrow version writing integers and fixed-size values with BYTE_STREAM_SPLIT (floats only before)
+BYTE_STREAM_SPLIT_PYARROW = 16
+
+
+class _PartitionFile():
+    """
+    An open Parquet file of a partition.
+    """
+    def __init__(self, path: str, schema: pa.Schema, **parquet_options):
+        self.path = path
+        if parquet_options.get('use_byte_stream_split') is True:
+            #-------------------------------------------------------------------
+            # BYTE_STREAM_SPLIT on the columns that support it only (not on binary or strings)
+            #-------------------------------------------------------------------
+            columns = [field.name for field in schema if _byte_stream_splittable(field.type)]
+            if not columns:
+                warnings.warn(
+                    f"use_byte_stream_split has no effect on {path}: none of its columns can be written with "
+                    f"BYTE_STREAM_SPLIT by pyarrow {pa.__version__} (integers and fixed-size values need pyarrow "
+                    f"{BYTE_STREAM_SPLIT_PYARROW} or later)", stacklevel=2)
+            parquet_options = dict(parquet_options, use_byte_stream_split=columns or False)
+        self.sink = pa.OSFile(path, 'wb')
+        self.writer = pq.ParquetWriter(self.sink, schema, **parquet_options)
+
+    def write(self, table: pa.Table) -> None:
+        self.writer.write_table(table, row_group_size=table.num_rows)
+
+    @property
+    def size(self) -> int:
+        return self.sink.tell()
+
+    def close(self) -> None:
+        self.writer.close()
+        self.sink.close()
+
+
+class _IpcPartitionFile(_PartitionFile):
+    """
+    An open Arrow IPC file (or stream) of a partition.
+    - ipc_options: passed to pyarrow.ipc.IpcWriteOptions (compression, ...)
+    """
+    def __init__(self, path: str, schema: pa.Schema, stream: bool = False, **ipc_options):
+        self.path = path
+        self.sink = pa.OSFile(path, 'wb')
+        options = pa.ipc.IpcWriteOptions(**ipc_options)
+        new_writer = pa.ipc.new_stream if stream else pa.ipc.new_file
+        self.writer = new_writer(self.sink, schema, options=options)
+
+    def write(self, table: pa.Table) -> None:
+        self.writer.write_table(table)
+
+
+class PartitionedWriter():
+    """
+    PartitionedWriter writes record batches (RECORD_SCHEMA) into a dataset partitioned by rdw
+    with one long-lived ParquetWriter per partition.
+    """
+    def __init__(self, root_path: str, prefix: str = "part-00000", schema: Optional[pa.Schema] = None,
+                 partition_col: Optional[str] = 'rdw', max_file_bytes: int = 512 * 1024 * 1024,
+                 max_open_writers: int = 64, row_group_bytes: int = 128 * 1024 * 1024,
+                 max_buffered_bytes: int = 512 * 1024 * 1024, file_format: str = 'parquet', fixed_size: bool = False,
+                 **parquet_options):
+        """
+        Initialize the PartitionedWriter class.
+        - prefix: prefix of the file names, must be unique per writer of the same dataset
+        - schema: schema of the batches (default: RECORD_SCHEMA)
+        - partition_col: column the files are partitioned by (None: no partitions)
+        - file_format: 'parquet', 'arrow' (IPC file / Feather v2) or 'arrow-stream' (IPC stream)
+        - fixed_size: write the binary `value` column of the rdw partitions as fixed_size_binary(rdw)
+        - parquet_options: passed to pyarrow.parquet.ParquetWriter (compression, ...),
+          or to pyarrow.ipc.IpcWriteOptions for the Arrow formats
+        """
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError(f"Unknown file format {file_format!r}, use one of {', '.join(FILE_EXTENSIONS)}")
+        self.root_path = root_path
+        self.prefix = prefix
+        self.partition_col = partition_col
+        self.file_format = file_format
+        schema = schema if schema is not None else record_schema()
+        if partition_col is None:
+            self.file_schema = schema
+        else:
+            self.file_schema = schema.remove(schema.get_field_index(partition_col))
+        self.fixed_size = (
+            fixed_size and partition_col == 'rdw'
+            and 'value' in self.file_schema.names and self.file_schema.field('value').type == pa.binary()
+        )
+        self.max_file_bytes = max_file_bytes
+        self.max_open_writers = max(max_open_writers, 1)
+        self.row_group_bytes = row_group_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+        self.parquet_options = parquet_options
+
+        self.files: List[str] = []                                 # relative paths of the files written
+        self._committed = 0                                        # number of files returned by commit
+        self._open: "OrderedDict[Optional[int], _PartitionFile]" = OrderedDict()  # open files in LRU order
+        self._sequence: Dict[Optional[int], int] = {}              # next file number per partition
+        self._pending: Dict[Optional[int], List[pa.RecordBatch]] = {}  # buffered rows per partition
+        self._pending_bytes: Dict[Optional[int], int] = {}
+        self._schemas: Dict[int, pa.Schema] = {}                    # file schema per partition with fixed_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    #--------------------------------------------
+    # split a batch by partition and buffer the rows
+    #--------------------------------------------
+    def write_batch(self, batch: pa.RecordBatch) -> None:
+        """
+        Buffer the rows of the batch in their partition and write the partitions whose
+        buffer reached row_group_bytes.
+        """
+        if not batch.num_rows:
+            return
+        if self.partition_col is None:
+            self._buffer(None, pa.RecordBatch.from_arrays(
+                [batch.column(name) for name in self.file_schema.names], schema=self.file_schema
+            ))
+            return
+        keys = batch.column(self.partition_col).to_numpy()
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.diff(keys)) + 1
+        bounds = np.concatenate([[0], starts, [len(keys)]])
+
+        data = pa.RecordBatch.from_arrays([batch.column(name) for name in self.file_schema.names], schema=self.file_schema)
+        if len(bounds) > 2:
+            data = data.take(pa.array(order))
+
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            self._buffer(int(keys[first]), data.slice(first, last - first))
+
+    def _buffer(self, key: Optional[int], part: pa.RecordBatch) -> None:
+        """
+        Buffer rows of a partition, write them once the buffer reaches row_group_bytes.
+        """
+        self._pending.setdefault(key, []).append(part)
+        self._pending_bytes[key] = self._pending_bytes.get(key, 0) + part.nbytes
+        if self._pending_bytes[key] >= self.row_group_bytes:
+            self._flush(key)
+
+        #-------------------------------------------------------------------
+        # keep the memory used by the buffers under max_buffered_bytes
+        #-------------------------------------------------------------------
+        while self._pending_bytes and sum(self._pending_bytes.values()) >= self.max_buffered_bytes:
+            self._flush(max(self._pending_bytes, key=self._pending_bytes.get))
+
+    #--------------------------------------------
+    # write the buffered rows of a partition as a row group
+    #--------------------------------------------
+    def _flush(self, key: Optional[int]) -> None:
+        parts = self._pending.pop(key, None)
+        self._pending_bytes.pop(key, None)
+        if not parts:
+            return
+        partition_file = self._writer(key)
+        table = pa.Table.from_batches(parts, schema=self.file_schema)
+        if self._schema_for(key) is not self.file_schema:
+            column = self.file_schema.get_field_index('value')
+            values = pa.chunked_array([_to_fixed_size(chunk, key) for chunk in table.column(column).chunks], pa.binary(key))
+            table = table.set_column(column, self._schema_for(key).field(column), values)
+        partition_file.write(table)
+
+        #-------------------------------------------------------------------
+        # roll over to a new file once the target size is reached
+        #-------------------------------------------------------------------
+        if partition_file.size >= self.max_file_bytes:
+            self._close_writer(key)
+
+    def _writer(self, key: Optional[int]) -> _PartitionFile:
+        """
+        Return the open file of the partition (open a new one if needed, closing the least
+        recently used file when max_open_writers are already open).
+        """
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key]
+
+        while len(self._open) >= self.max_open_writers:
+            self._close_writer(next(iter(self._open)))
+
+        directory = f"{self.partition_col}={key}/" if self.partition_col is not None else ""
+        extension = FILE_EXTENSIONS[self.file_format]
+        os.makedirs(os.path.join(self.root_path, directory), exist_ok=True)
+        sequence = self._sequence.get(key, 0)
+        relative_path = f"{directory}{self.prefix}-{sequence:05d}{extension}"
+        while os.path.exists(os.path.join(self.root_path, relative_path)):
+            sequence += 1
+            relative_path = f"{directory}{self.prefix}-{sequence:05d}{extension}"
+        self._sequence[key] = sequence + 1
+
+        path = os.path.join(self.root_path, relative_path)
+        if self.file_format == 'parquet':
+            partition_file = _PartitionFile(path, self._schema_for(key), **self.parquet_options)
+        else:
+            partition_file = _IpcPartitionFile(
+                path, self._schema_for(key), stream=self.file_format == 'arrow-stream', **self.parquet_options
+            )
+        self._open[key] = partition_file
+        self.files.append(relative_path)
+        return partition_file
+
+    def _schema_for(self, key: Optional[int]) -> pa.Schema:
+        """
+        Schema of the files of a partition: value is fixed_size_binary(rdw) with fixed_size
+        (an empty value stays binary, Parquet has no zero-length FIXED_LEN_BYTE_ARRAY).
+        """
+        if not self.fixed_size or not key:
+            return self.file_schema
+        if key not in self._schemas:
+            column = self.file_schema.get_field_index('value')
+            self._schemas[key] = self.file_schema.set(column, pa.field('value', pa.binary(key)))
+        return self._schemas[key]
+
+    def _close_writer(self, key: Optional[int]) -> None:
+        partition_file = self._open.pop(key, None)
+        if partition_file is not None:
+            partition_file.close()
+
+    #--------------------------------------------
+    # write the buffered rows and close every file
+    #--------------------------------------------
+    def commit(self) -> List[str]:
+        """
+        Write the buffered rows, close every open file and return the files written since
+        the previous commit (they are all complete now).
+        """
+        for key in sorted(self._pending):
+            self._flush(key)
+        for key in list(self._open):
+            self._close_writer(key)
+        files = self.files[self._committed:]
+        self._committed = len(self.files)
+        return files
+
+    def close(self) -> None:
+        """
+        Write the buffered rows and close every open file.
+        """
+        self.commit()
+
+
+def byte_stream_split_columns(schema: pa.Schema, partition_col: Optional[str] = 'rdw',
+                              fixed_size: bool = False) -> List[str]:
+    """
+    Columns of the files a PartitionedWriter with these options writes with BYTE_STREAM_SPLIT
+    (use_byte_stream_split=True) on the installed pyarrow: the partition column isn't in the
+    files, and the `value` column is only fixed-size with fixed_size and the rdw partitions.
+    """
+    columns = []
+    for field in schema:
+        if field.name == partition_col:
+            continue
+        fixed_value = fixed_size and partition_col == 'rdw' and field.name == 'value' and field.type == pa.binary()
+        if _byte_stream_splittable(pa.binary(1) if fixed_value else field.type):
+            columns.append(field.name)
+    return columns
+
+
+def _byte_stream_splittable(data_type: pa.DataType) -> bool:
+    """
+    Types written with the BYTE_STREAM_SPLIT encoding by use_byte_stream_split: floats, and
+    integers and fixed-size values (FIXED_LEN_BYTE_ARRAY) with pyarrow 16 or later.
+    """
+    if pa.types.is_floating(data_type):
+        return True
+    if int(pa.__version__.split('.')[0]) < BYTE_STREAM_SPLIT_PYARROW:
+        return False
+    return (
+        data_type in (pa.int32(), pa.int64())
+        or pa.types.is_fixed_size_binary(data_type) or pa.types.is_decimal(data_type)
+    )
+
+
+#--------------------------------------------
+# fixed_size_binary values without a copy
+#--------------------------------------------
+def _to_fixed_size(array: pa.Array, width: int) -> pa.Array:
+    """
+    Return the binary array, whose values all have `width` bytes, as a fixed_size_binary(width)
+    array sharing its data buffer.
+    """
+    if array.null_count:
+        return array.cast(pa.binary(width))
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int32)[array.offset:array.offset + len(array) + 1]
+    if int(offsets[-1]) - int(offsets[0]) != width * len(array):
+        raise ValueError(f"The values of the rdw={width} partition don't all have {width} bytes")
+    data = array.buffers()[2].slice(int(offsets[0]), width * len(array))
+    return pa.Array.from_buffers(pa.binary(width), len(array), [None, data])
+
+
+#--------------------------------------------
+# write the summary files of the dataset
+#--------------------------------------------
+def write_dataset_metadata(root_path: str, files: List[str], schema: Optional[pa.Schema] = None) -> None:
+    """
+    Write the _common_metadata and _metadata summary files of the dataset.
+    The footers of the files are read back so files written by several processes can be combined.
+    When the files have different schemas (fixed_size values), _common_metadata gets the schema
+    with binary values, the one to read the whole dataset with, and there is no _metadata
+    (its row groups must all have the same schema).
+    """
+    if not files:
+        return
+    metadata_collector = []
+    for relative_path in sorted(files):
+        metadata = pq.read_metadata(os.path.join(root_path, relative_path))
+        metadata.set_file_path(relative_path)
+        metadata_collector.append(metadata)
+
+    schemas = [metadata.schema.to_arrow_schema() for metadata in metadata_collector]
+    if schema is None and any(not other.equals(schemas[0]) for other in schemas[1:]):
+        file_schema = pa.schema([
+            field.with_type(pa.binary()) if pa.types.is_fixed_size_binary(field.type) else field
+            for field in schemas[0]
+        ])
+        pq.write_metadata(file_schema, os.path.join(root_path, '_common_metadata'))
+        if os.path.exists(os.path.join(root_path, '_metadata')):
+            os.remove(os.path.join(root_path, '_metadata'))
+        return
+
+    file_schema = schema or schemas[0]
+    pq.write_metadata(file_schema, os.path.join(root_path, '_common_metadata'))
+    pq.write_metadata(file_schema, os.path.join(root_path, '_metadata'), metadata_collector=metadata_collector)
@@ -0,0 +1,322 @@
+"""
+This module contains the pipelined conversion, where reading, converting and writing run at
+the same time instead of one after the other:
+
+    reader thread --(queue)--> conversion (calling thread) --(one queue per writer)--> writer threads
+
+- the reader thread scans the headers and copies the records out of the memory map into batches
+- the conversion stage decodes the batches (with a RecordDecoder, if any) and routes the rows of
+  every rdw partition to the writer thread that owns that partition
+- every writer thread has its own PartitionedWriter, pyarrow releases the GIL while it encodes
+  and compresses, so several partitions are written in parallel while the next batches are read
+
+The queues are bounded, so a slow writer stops the reader from getting ahead, and the batches
+are sized in bytes from a memory budget (see PipelineBudget) rather than in records, so the
+memory used doesn't depend on the length of the records.
+
+With Metrics, the batch latency is the time from reading a batch to handing it to the writers.
+
+A partition is always written by the same writer thread, so the writers can share the file
+prefix without two of them ever using the same file name.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import pyarrow as pa
+
+from ecopass.core.checkpoint import Checkpoint
+from ecopass.core.convert import writer_schema
+from ecopass.core.decoder import RecordDecoder
+from ecopass.core.metrics import DISABLED, Metrics
+from ecopass.core.partitioned_writer import PartitionedWriter
+from ecopass.core.record_header import MAX_BATCH_BYTES, RecordHeader
+
+# batches waiting between the reader and the conversion stage, and in front of every writer
+READ_QUEUE_SIZE = 4
+WRITE_QUEUE_SIZE = 4
+
+# how often a blocked stage checks whether another stage failed (seconds)
+_POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class PipelineBudget(NamedTuple):
+    """
+    How a memory budget is shared between the stages of the pipeline.
+    - batch_bytes: maximum record data of a batch
+    - row_group_bytes / max_buffered_bytes: buffers of the PartitionedWriter of each writer thread
+    """
+    batch_bytes: int
+    row_group_bytes: int
+    max_buffered_bytes: int
+
+
+#--------------------------------------------
+# split the memory budget between the stages
+#--------------------------------------------
+def pipeline_budget(max_memory: int, writer_threads: int) -> PipelineBudget:
+    """
+    Split max_memory (bytes) between the batches in flight and the buffers of the writers:
+    - half for the batches: the ones in the queues, plus the one each stage is working on
+    - half for the row groups buffered by the writer threads
+    """
+    in_flight = READ_QUEUE_SIZE + writer_threads * WRITE_QUEUE_SIZE + writer_threads + 2
+    batch_bytes = max(min(max_memory // 2 // in_flight, MAX_BATCH_BYTES), 1)
+    max_buffered_bytes = max(max_memory // 2 // writer_threads, 1)
+    return PipelineBudget(
+        batch_bytes=batch_bytes,
+        row_group_bytes=min(128 * 1024 * 1024, max_buffered_bytes),
+        max_buffered_bytes=max_buffered_bytes,
+    )
+
+
+class _Stage(threading.Thread):
+    """
+    A thread of the pipeline consuming or producing batches through bounded queues.
+    An error is kept and raised again by the conversion stage.
+    """
+    def __init__(self, name: str, failed: threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.failed = failed
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            self.work()
+        except BaseException as error:
+            self.error = error
+            self.failed.set()
+
+    def work(self) -> None:
+        raise NotImplementedError
+
+
+def _put(q: queue.Queue, item: Any, failed: threading.Event) -> None:
+    """
+    Put an item in a bounded queue, waiting while it's full unless a stage failed.
+    """
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=_POLL_INTERVAL)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q: queue.Queue, failed: threading.Event) -> Any:
+    """
+    Get an item from a queue, or _DONE once a stage failed.
+    """
+    while not failed.is_set():
+        try:
+            return q.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+#--------------------------------------------
+# reader stage
+#--------------------------------------------
+class _Reader(_Stage):
+    """
+    Read the batches of the gaps and put (gap, end, batch) in the queue, then _DONE.
+    """
+    def __init__(self, batches: Iterator[Tuple[int, int, pa.RecordBatch]], out: queue.Queue, failed: threading.Event):
+        super().__init__('ecopass-reader', failed)
+        self.batches = batches
+        self.out = out
+
+    def work(self) -> None:
+        for item in self.batches:
+            if self.failed.is_set():
+                return
+            _put(self.out, item, self.failed)
+        _put(self.out, _DONE, self.failed)
+
+
+#--------------------------------------------
+# writer stage
+#--------------------------------------------
+class _Writer(_Stage):
+    """
+    Write the batches of its queue with its own PartitionedWriter.
+    A Future in the queue is a commit: the files are closed and returned in the Future.
+    """
+    def __init__(self, number: int, writer: PartitionedWriter, failed: threading.Event, metrics: Metrics = DISABLED):
+        super().__init__(f'ecopass-writer-{number}', failed)
+        self.writer = writer
+        self.metrics = metrics
+        self.queue: queue.Queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+
+    def work(self) -> None:
+        while True:
+            item = _get(self.queue, self.failed)
+            if item is _DONE:
+                return
+            if isinstance(item, Future):
+                with self.metrics.stage('commit'):
+                    files = self.writer.commit()
+                item.set_result(files)
+            else:
+                with self.metrics.stage('write'):
+                    self.writer.write_batch(item)
+
+
+#--------------------------------------------
+# convert the gaps with the pipeline
+#--------------------------------------------
+def convert_pipelined(record_header: RecordHeader, path_output: str, checkpoint: Checkpoint,
+                      gaps: List[Tuple[int, int]], prefix: str = "part-00000", writer_threads: int = 2,
+                      max_memory: int = 1024 * 1024 * 1024, batch_size: int = 500_000,
+                      commit_bytes: int = 1024 * 1024 * 1024,
+                      writer_options: Optional[Dict[str, Any]] = None,
+                      on_batch: Optional[Callable[[pa.RecordBatch], None]] = None,
+                      decoder: Optional[RecordDecoder] = None, metrics: Metrics = DISABLED) -> None:
+    """
+    Convert the gaps in order like convert_sequential, with the reader, the conversion and
+    writer_threads writers running at the same time within the max_memory budget (bytes).
+    Every commit_bytes of record data (and at the end of every gap) the writers close their
+    files and the range read so far is committed to the checkpoint.
+    on_batch is called with every batch converted.
+    """
+    writer_threads = max(writer_threads, 1)
+    budget = pipeline_budget(max_memory, writer_threads)
+    options = dict(writer_options or {})
+    options.update(
+        row_group_bytes=min(options.get('row_group_bytes', budget.row_group_bytes), budget.row_group_bytes),
+        max_buffered_bytes=budget.max_buffered_bytes,
+    )
+    schema = writer_schema(decoder, record_header.schema)
+    partition_col = options.get('partition_col', 'rdw')
+
+    def batches() -> Iterator[Tuple[int, int, pa.RecordBatch, float]]:
+        for gap, (start, stop) in enumerate(gaps):
+            batch_start = time.perf_counter()
+            for end, batch in record_header.read_positioned_batches(
+                    max_rows=batch_size, max_bytes=budget.batch_bytes, start=start, stop=stop):
+                yield gap, end, batch, batch_start
+                batch_start = time.perf_counter()
+
+    failed = threading.Event()
+    read_queue: queue.Queue = queue.Queue(maxsize=READ_QUEUE_SIZE)
+    reader = _Reader(batches(), read_queue, failed)
+    #-------------------------------------------------------------------
+    # without partitions the writers get their own prefix (they share the directory)
+    #-------------------------------------------------------------------
+    writers = [
+        _Writer(number, PartitionedWriter(
+            path_output, prefix=prefix if partition_col is not None else f"{prefix}-{number}", schema=schema, **options,
+        ), failed, metrics)
+        for number in range(writer_threads)
+    ]
+
+    def commit() -> List[str]:
+        """Close the files of every writer (after the batches already queued) and return them."""
+        futures: List[Future] = []
+        for writer in writers:
+            futures.append(Future())
+            _put(writer.queue, futures[-1], failed)
+        files = []
+        for future in futures:
+            while not failed.is_set():
+                try:
+                    files.extend(future.result(timeout=_POLL_INTERVAL))
+                    break
+                except FutureTimeoutError:
+                    pass
+        return files
+
+    for stage in [reader] + writers:
+        stage.start()
+    try:
+        #-------------------------------------------------------------------
+        # conversion stage: decode, route the rows to the writers, commit
+        #-------------------------------------------------------------------
+        current_gap = None
+        range_start = end = 0
+        records = written = 0
+        while True:
+            item = _get(read_queue, failed)
+            if item is _DONE:
+                break
+            gap, next_end, batch, batch_start = item
+            if gap != current_gap:
+                if current_gap is not None and end > range_start:
+                    files = commit()
+                    if failed.is_set():
+                        break
+                    checkpoint.commit(range_start, end, records, files)
+                current_gap = gap
+                range_start = end = gaps[gap][0]
+                records = written = 0
+            end = next_end
+
+            if batch.num_rows:
+                if decoder is not None:
+                    with metrics.stage('decode'):
+                        batch = decoder.decode(batch)
+                with metrics.stage('route'):
+                    _route(batch, writers, partition_col, failed)
+                if metrics.enabled:
+                    metrics.add('batches')
+                    metrics.add('records_written', batch.num_rows)
+                    metrics.observe_batch(time.perf_counter() - batch_start)
+                records += batch.num_rows
+                written += batch.nbytes
+                if on_batch is not None:
+                    on_batch(batch)
+
+            if written >= commit_bytes:
+                files = commit()
+                if failed.is_set():
+                    break
+                checkpoint.commit(range_start, end, records, files)
+                range_start, records, written = end, 0, 0
+
+        if not failed.is_set() and current_gap is not None and end > range_start:
+            files = commit()
+            if not failed.is_set():
+                checkpoint.commit(range_start, end, records, files)
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        #-------------------------------------------------------------------
+        # stop the threads (the reader must be done before the memory map is closed)
+        #-------------------------------------------------------------------
+        for writer in writers:
+            _put(writer.queue, _DONE, failed)
+        reader.join()
+        for writer in writers:
+            writer.join()
+            if writer.error is None:
+                writer.writer.close()
+
+    for stage in [reader] + writers:
+        if stage.error is not None:
+            raise stage.error
+
+
+def _route(batch: pa.RecordBatch, writers: List[_Writer], partition_col: Optional[str], failed: threading.Event) -> None:
+    """
+    Send the rows of every partition to the writer that owns it (key % number of writers),
+    or the whole batch to the writer with the fewest queued batches without partitions.
+    """
+    if len(writers) == 1:
+        _put(writers[0].queue, batch, failed)
+        return
+    if partition_col is None:
+        _put(min(writers, key=lambda writer: writer.queue.qsize()).queue, batch, failed)
+        return
+    owners = batch.column(partition_col).to_numpy() % len(writers)
+    for number, writer in enumerate(writers):
+        mask = owners == number
+        if mask.all():
+            _put(writer.queue, batch, failed)
+        elif mask.any():
+            _put(writer.queue, batch.filter(pa.array(mask)), failed)
@@ -16,10 +16,107 @@ The record is aligned to the alignment.
 
 The RecordHeader class is used to read the header of a record and return the length and the data.
 It is used to iterate over the records of a file.
+
+RecordHeader.scan_index() walks the headers only (no record data is copied) and returns
+a RecordIndex with the offsets, lengths and statuses of every record as NumPy arrays,
+so the other paths (conversion, filtering, stats) can work from those arrays.
+
+RecordHeader.read_batches() builds pyarrow RecordBatches (rdw, value) straight from the
+memory map using that index, without creating a Python object per record.
+
+RecordHeader.load_index() keeps the index in a sidecar file next to the input (see
+ecopass.core.record_index), so the next runs on the same file skip the header walk and
+records can be accessed by number with get_record(n), iter_range(start, stop) and len().
+
+RecordHeader.load_key_index() does the same for the primary key of indexed files (see
+ecopass.core.key_index), so records can be looked up with get_by_key(key) and key_range(low, high).
+
+RecordHeader.stats() counts the records and bytes per status and per length, the padding and the
+largest records from the headers only (see ecopass.core.stats).
+
+With tolerant=True, a bad record (invalid status, data past the end of the file, longer than
+max_record_length) doesn't stop read_batches: the reader skips ahead to the next plausible
+header and the skipped byte ranges are added to RecordHeader.skipped (see ecopass.core.verify).
+
+With growing=True (a file still being written, `ecopass convert --incremental`), a last record
+whose data isn't complete yet ends the file instead of raising a ValueError: the records are
+read up to the end of the last complete one, the tail is left for the next run.
+
+The records can be filtered by status (include_statuses / exclude_statuses) and by length
+(record_length). The filters are applied to the index right after the header scan, so the
+data of a rejected record is never copied out of the memory map.
+
+NumPy and pyarrow are imported the first time they are used (see ecopass.core.lazy), so this
+module can be imported with the stdlib only.
 """
+from __future__ import annotations
+
+import array
 import enum
+import logging
 import mmap
-from typing import Tuple
+import os
+import struct
+import sys
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from ecopass.core.key_index import (
+    LIVE_STATUSES, KeyIndex, build_key_index, key_range, load_appendable_key_index, load_key_index, merge_key_indexes,
+    write_key_index,
+)
+from ecopass.core.lazy import lazy_import
+from ecopass.core.metrics import DISABLED, Metrics
+from ecopass.core.record_index import RecordIndex, load_index, write_index
+from ecopass.core.stats import FileStats, file_stats
+from ecopass.core.verify import BadRegion, verified_chunks
+
+np = lazy_import('numpy')
+pa = lazy_import('pyarrow')
+
+# messages of the debug mode (RecordHeader(debug=True)), on stderr with `ecopass convert --debug`
+logger = logging.getLogger(__name__)
+
+
+def debug_logging() -> None:
+    """
+    Write the debug messages of ecopass (the loggers under "ecopass") to stderr, so they never mix
+    with the records streamed to stdout.
+    """
+    ecopass_logger = logging.getLogger('ecopass')
+    if not ecopass_logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("[DEBUG] %(message)s"))
+        ecopass_logger.addHandler(handler)
+    ecopass_logger.setLevel(logging.DEBUG)
+
+
+#--------------------------------------------
+# schema of the batches returned by read_batches
+# rdw: length of the record, value: the record data
+# (+ status: the status of every record, RecordHeader(with_status=True))
+#--------------------------------------------
+@lru_cache(maxsize=None)
+def record_schema(with_status: bool = False) -> pa.Schema:
+    schema = pa.schema([
+        ('rdw', pa.int32()),
+        ('value', pa.binary())
+    ])
+    return schema.append(pa.field('status', pa.uint8())) if with_status else schema
+
+
+def __getattr__(name: str):
+    """
+    RECORD_SCHEMA and STATUS_SCHEMA are built on first use, so importing the module doesn't load pyarrow.
+    """
+    if name == 'RECORD_SCHEMA':
+        return record_schema()
+    if name == 'STATUS_SCHEMA':
+        return record_schema(with_status=True)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# the binary column uses 32-bit offsets so a batch can't hold more than 2 GB of data
+MAX_BATCH_BYTES = 2**31 - 1
 
 class RecordType(enum.Enum):
     SYSTEM_RECORD_DUPLICATE = 1  # A system record (duplicate occurrence)
@@ -37,18 +134,69 @@ class RecordType(enum.Enum):
     MID_TRANSACTION_REDUCED_USER_RECORD_REFERENCED = 13  # Mid-transaction reduced user record referenced by a pointer
 
 
+@lru_cache(maxsize=1)
+def _window_positions(count: int) -> np.ndarray:
+    """
+    Return 0 .. count - 1 (int32), allocated once for RecordHeader._scan_window.
+    """
+    return np.arange(count, dtype=np.int32)
+
+
+class _EmptyMap(bytes):
+    """
+    Memory map of an empty file (mmap can't map 0 bytes): no bytes, same read methods.
+    """
+    def tell(self) -> int:
+        return 0
+
+    def read(self, size: int = -1) -> bytes:
+        return b''
+
+    def seek(self, pos: int, whence: int = 0) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
 class RecordHeader():
     """
     RecordHeader is a class that reads the header of a record.
     It is used to read the header of a record and return the length and the data.
     It is used to iterate over the records of a file.
     """
-    def __init__(self, filename, record_length: list = [], header_size: int = 2, alignment: int = 2, debug=False):
+    # number of same-length records checked at once by scan_index (grows while the run continues)
+    _SCAN_BLOCK_MIN = 16
+    _SCAN_BLOCK_MAX = 1 << 16
+    # candidate header positions decoded at once by scan_index for the variable-length records,
+    # used while the records are at most _SCAN_WINDOW_STRIDE alignment units long on average
+    _SCAN_WINDOW = 1 << 16
+    _SCAN_WINDOW_STRIDE = 256
+
+    def __init__(self, filename, record_length: list = [], header_size: int = 2, alignment: int = 2, debug=False,
+                 index_path: Optional[str] = None, include_statuses: Optional[Iterable[int]] = None,
+                 exclude_statuses: Iterable[int] = (), metrics: Optional[Metrics] = None, with_status: bool = False,
+                 tolerant: bool = False, max_record_length: Optional[int] = None, growing: bool = False):
         """
         Initialize the RecordHeader class.
+        - record_length: only return the records with one of these lengths (all lengths when empty)
+        - include_statuses: only return the records with one of these statuses (default: allowed_statuses)
+        - exclude_statuses: never return the records with one of these statuses
+        - index_path: path of the sidecar index (default: <filename>.ecpidx)
+        - metrics: Metrics updated by read_batches (scan and build time, bytes read, statuses)
+        - with_status: add the status of every record to the batches (STATUS_SCHEMA)
+        - tolerant: skip the bad regions of the file instead of failing (see RecordHeader.skipped)
+        - max_record_length: in tolerant mode, a longer record is bad
+        - growing: the file is still being written, an incomplete last record ends the file
+        - debug: log the headers read and the errors at the DEBUG level (see debug_logging)
         """
         if header_size not in {2, 4}:
             raise ValueError("Only 2-byte or 4-byte headers are supported")
+        for status in list(include_statuses or []) + list(exclude_statuses):
+            if not 0 <= status <= 0x0F:
+                raise ValueError(f"Invalid status {status}, a status is between 0 and 15")
+        if any(length < 0 for length in record_length):
+            raise ValueError("Record lengths can't be negative")
         
         self.filename = filename
         self.header_size = header_size
@@ -71,10 +219,24 @@ class RecordHeader():
             RecordType.MID_TRANSACTION_USER_RECORD_REFERENCED.value,
             RecordType.MID_TRANSACTION_REDUCED_USER_RECORD_REFERENCED.value,
         ]
+        if include_statuses is not None:
+            self.allowed_statuses = sorted(set(include_statuses))
+        self.allowed_statuses = [status for status in self.allowed_statuses if status not in set(exclude_statuses)]
         self.alignment = alignment
         self.file = None        # Will be set in __enter__
         self.mmap_obj = None    # Will be set in __enter__
         self.debug = debug      # Debug mode flag __track_errors & __fix_bugs__
+        self.index_path = index_path
+        self.index: Optional[RecordIndex] = None       # Will be set by load_index
+        self._numbers: Optional[np.ndarray] = None     # positions in the index of the records that pass the filters
+        self._numbers_loaded = False
+        self.key_index: Optional[KeyIndex] = None      # Will be set by load_key_index
+        self.metrics = metrics or DISABLED
+        self.with_status = with_status
+        self.tolerant = tolerant
+        self.max_record_length = max_record_length
+        self.growing = growing
+        self.skipped: List[BadRegion] = []             # regions skipped by read_batches in tolerant mode
 
     #--------------------------------------------
     # open the file and create a memory map for it
@@ -89,7 +251,12 @@ class RecordHeader():
         # --------------------------------------------
         # create a memory map for the file
         # --------------------------------------------
-        self.mmap_obj = mmap.mmap(self.file.fileno(), length=0, access=mmap.ACCESS_READ)
+        # (an empty file can't be mapped: it's read as a file with no records)
+        # --------------------------------------------
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.mmap_obj = _EmptyMap()
+        else:
+            self.mmap_obj = mmap.mmap(self.file.fileno(), length=0, access=mmap.ACCESS_READ)
         return self
 
     #--------------------------------------------
@@ -187,11 +354,8 @@ class RecordHeader():
                 #-------------------------------------------------------------------
                 if len(header) < self.header_size:
                     if self.debug:
-                        print("--------------------------------")
-                        print(f"header len: {len(header)}, expected header size: {self.header_size}")
-                        print(f"\n[DEBUG] Reading header at position {pos}: bytes={header.hex()}")
-                        print("[DEBUG] Reached end of file (incomplete header)")
-                        print("--------------------------------")
+                        logger.debug("Reached end of file (incomplete header of %d bytes at position %d: %s)",
+                                     len(header), pos, header.hex())
                     break  # End of file
 
                 status, length = self._parse_header(header)
@@ -201,9 +365,7 @@ class RecordHeader():
                 #-------------------------------------------------------------------
                 if status not in self.allowed_statuses:
                     if self.debug:
-                        print("--------------------------------")
-                        print(f"[DEBUG] Invalid status: {status}")
-                        print("--------------------------------")
+                        logger.debug("Invalid status %d at position %d", status, pos)
                 
                 #-------------------------------------------------------------------------------------
                 # used as a example to stop the iteration
@@ -217,17 +379,19 @@ class RecordHeader():
                 #-------------------------------------------------------------------------------------
                 if status in self.allowed_statuses:
                     if self.debug:
-                        print("--------------------------------")
-                        print(f"[DEBUG] Parsed -> status={status}, length={length}")
-                        print(f"[DEBUG] Record type: {RecordType(status).name}")
-                        print(f"[DEBUG] Expected data length: {length} bytes")
-                        print("--------------------------------")
+                        logger.debug("Parsed -> status=%d (%s), length=%d at position %d",
+                                     status, RecordType(status).name, length, pos)
 
                 #-------------------------------------------------------------------------------------  
-                # Read the record data
+                # Read the record data (a filtered out record is skipped without reading its data)
                 #-------------------------------------------------------------------------------------
-                data = f.read(length)
-                actual_data_length = len(data)
+                keep = status in self.allowed_statuses and (not self.record_length or length in self.record_length)
+                if keep:
+                    data = f.read(length)
+                    actual_data_length = len(data)
+                else:
+                    actual_data_length = min(length, len(f) - f.tell())
+                    f.seek(actual_data_length, 1)
                 
                 #-------------------------------------------------------------------------------------
                 # if the data is not complete, raise an error
@@ -235,10 +399,7 @@ class RecordHeader():
                 if actual_data_length < length:
                     self._close()
                     if self.debug:
-                        print("\n--------------------------------")
-                        print(f"[DEBUG] ERROR: Incomplete data at {pos}")
-                        print(f"[DEBUG] Expected {length} bytes, got {actual_data_length}")
-                        print("\n--------------------------------")
+                        logger.debug("Incomplete data at %d: expected %d bytes, got %d", pos, length, actual_data_length)
                     raise ValueError(f"Incomplete data at position {pos}")
                 
                 #-------------------------------------------------------------------------------------
@@ -246,7 +407,7 @@ class RecordHeader():
                 #-------------------------------------------------------------------------------------
                 # if status in self.allowed_statuses and length in self.record_length:
                 #-------------------------------------------------------------------------------------
-                if status in self.allowed_statuses:
+                if keep:
                     yield length, bytes(data)
 
                 #-------------------------------------------------------------------------------------
@@ -254,12 +415,565 @@ class RecordHeader():
                 #-------------------------------------------------------------------------------------
                 padding_size = self._parse_padding(length=length)
                 f.seek(padding_size, 1)
-        except:
+        except Exception as error:
             #-------------------------------------------------------------------------------------
             # close the file and raise an error
             # stop the iteration
             #-------------------------------------------------------------------------------------
             self._close()
-            raise ValueError(f"Incomplete data at position {pos}")
+            raise ValueError(f"Incomplete data at position {pos}") from error
         finally:
             ...
+
+    #--------------------------------------------
+    # scan the headers and build the index
+    #--------------------------------------------
+    def scan_index(self, start: int = 0, stop: Optional[int] = None, max_records: Optional[int] = None,
+                   strict: Optional[bool] = None) -> RecordIndex:
+        """
+        Walk the headers of the memory map in one pass and return a RecordIndex.
+        Only the headers are read, the record data is never copied.
+        - start: position of the first record header to read (must be a record boundary)
+        - stop: records whose header starts at or after this position are not indexed
+        - max_records: stop after this number of records
+        - strict: raise a ValueError on a record whose data runs past the end of the file
+          (otherwise the scan stops before it, at RecordIndex.end), default: not growing
+        Every status is indexed, filter on RecordIndex.statuses if needed.
+
+        Runs of records with the same length (the usual case for fixed layouts) are
+        checked with NumPy in blocks: if the header at pos + k * stride still holds the
+        same length, the record k is valid without walking the records in between.
+
+        Records of variable lengths are scanned in windows (see _scan_window): the header at
+        every aligned position of the window is decoded with NumPy as if a record started there,
+        then the chain of next positions is followed from the first record. The chain is a
+        Python loop, but it only reads one integer per record. Measured with benchmarks/bench.py
+        on 300k records of "uniform:0:300" (2-byte headers, alignment 2): about 2.5M rec/s
+        (read_records: 0.43M rec/s), and 23M rec/s on fixed lengths. Long records (more than
+        _SCAN_WINDOW_STRIDE alignment units on average) are walked one header at a time, at
+        about 0.45M rec/s.
+        """
+        f = self.mmap_obj
+        size = len(f)
+        stop = size if stop is None else min(stop, size)
+        strict = not self.growing if strict is None else strict
+        remaining = -1 if max_records is None else max_records
+        header_size = self.header_size
+        alignment = self.alignment
+
+        #-------------------------------------------------------------------
+        # the header is read as one big-endian integer:
+        # status = the first 4 bits, length = the remaining 12 or 28 bits
+        #-------------------------------------------------------------------
+        unpack_header = struct.Struct('>H' if header_size == 2 else '>I').unpack_from
+        status_shift = header_size * 8 - 4
+        length_mask = (1 << status_shift) - 1
+
+        offsets, lengths, statuses = array.array('q'), array.array('i'), array.array('B')
+        chunks = []  # (offsets, lengths, statuses) blocks of NumPy arrays
+
+        def flush():
+            if offsets:
+                chunks.append((
+                    np.frombuffer(offsets, dtype=np.int64).copy(),
+                    np.frombuffer(lengths, dtype=np.int32).copy(),
+                    np.frombuffer(statuses, dtype=np.uint8).copy(),
+                ))
+                del offsets[:], lengths[:], statuses[:]
+
+        view = np.frombuffer(f, dtype=np.uint8) if size else None
+        block = self._SCAN_BLOCK_MIN
+        previous_length = -1
+        scanned = 0
+        pos = start
+        try:
+            while pos < stop and remaining != 0:
+                #-------------------------------------------------------------------
+                # if the header is not complete, we reached the end of the file
+                #-------------------------------------------------------------------
+                if pos + header_size > size:
+                    if self.debug:
+                        logger.debug("Reached end of file (incomplete header) at position %d", pos)
+                    break
+
+                header, = unpack_header(f, pos)
+                length = header & length_mask
+                stride = header_size + length
+                stride += (alignment - (stride % alignment)) % alignment
+
+                #-------------------------------------------------------------------
+                # if the data is not complete, raise an error
+                #-------------------------------------------------------------------
+                if pos + header_size + length > size:
+                    if self.debug:
+                        logger.debug("Incomplete data at %d: expected %d bytes, got %d",
+                                     pos, length, size - pos - header_size)
+                    if not strict:
+                        break
+                    raise ValueError(f"Incomplete data at position {pos}")
+
+                #-------------------------------------------------------------------
+                # same length as the previous record: check a whole block at once
+                #-------------------------------------------------------------------
+                if length == previous_length:
+                    count = min(block, (stop - pos - 1) // stride + 1, (size - pos - header_size - length) // stride + 1)
+                    if remaining > 0:
+                        count = min(count, remaining)
+                    candidates = pos + stride * np.arange(count, dtype=np.int64)
+                    values = view[candidates].astype(np.uint32)
+                    for i in range(1, header_size):
+                        values = (values << 8) | view[candidates + i]
+                    mismatch = np.flatnonzero((values & length_mask) != length)
+                    accepted = int(mismatch[0]) if mismatch.size else count
+
+                    flush()
+                    chunks.append((
+                        candidates[:accepted],
+                        np.full(accepted, length, dtype=np.int32),
+                        (values[:accepted] >> status_shift).astype(np.uint8),
+                    ))
+                    pos += accepted * stride
+                    remaining -= accepted
+                    scanned += accepted
+                    block = min(block * 2, self._SCAN_BLOCK_MAX) if accepted == count else max(accepted * 2, self._SCAN_BLOCK_MIN)
+                    continue
+
+                #-------------------------------------------------------------------
+                # short records of variable lengths: decode a whole window at once
+                #-------------------------------------------------------------------
+                if scanned >= self._SCAN_BLOCK_MIN and pos - start < scanned * alignment * self._SCAN_WINDOW_STRIDE:
+                    count = min(self._SCAN_WINDOW, (stop - pos - 1) // alignment + 1, (size - header_size - pos) // alignment + 1)
+                    window = self._scan_window(view, pos, count)
+                    accepted = len(window.offsets)
+                    if window.offsets[-1] + header_size + window.lengths[-1] > size:
+                        accepted -= 1  # the data of the last record is incomplete, handled on the next turn
+                    if remaining > 0:
+                        accepted = min(accepted, remaining)
+                    flush()
+                    chunks.append((window.offsets[:accepted], window.lengths[:accepted], window.statuses[:accepted]))
+                    pos = window.end if accepted == len(window.offsets) else int(window.offsets[accepted])
+                    remaining -= accepted
+                    scanned += accepted
+                    previous_length = int(window.lengths[accepted - 1]) if accepted else previous_length
+                    continue
+
+                offsets.append(pos)
+                lengths.append(length)
+                statuses.append(header >> status_shift)
+                remaining -= 1
+                scanned += 1
+                previous_length = length
+
+                #-------------------------------------------------------------------
+                # skip the data and the padding to the next header
+                #-------------------------------------------------------------------
+                pos += stride
+            flush()
+        finally:
+            #-------------------------------------------------------------------
+            # release the NumPy view, the memory map can't be closed while it exists
+            #-------------------------------------------------------------------
+            del view
+
+        if not chunks:
+            chunks.append((np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.uint8)))
+        return RecordIndex(
+            offsets=np.concatenate([chunk[0] for chunk in chunks]),
+            lengths=np.concatenate([chunk[1] for chunk in chunks]),
+            statuses=np.concatenate([chunk[2] for chunk in chunks]),
+            end=min(pos, size),
+        )
+
+    def _scan_window(self, view: np.ndarray, pos: int, count: int) -> RecordIndex:
+        """
+        Return the RecordIndex of the chain of records starting at pos, among the count aligned
+        positions pos + k * alignment (whose headers must be in the file). RecordIndex.end is
+        the position of the record after the last one (the data of the last record may go past
+        the end of the file).
+        """
+        header_size = self.header_size
+        alignment = self.alignment
+        status_shift = header_size * 8 - 4
+
+        #-------------------------------------------------------------------
+        # next[k]: position (in alignment units) of the record after a record at k
+        #-------------------------------------------------------------------
+        headers = np.ndarray((count,), dtype='>u2' if header_size == 2 else '>u4', buffer=view,
+                             offset=pos, strides=(alignment,))
+        lengths = (headers & ((1 << status_shift) - 1)).astype(np.int32)
+        following = lengths + np.int32(header_size + alignment - 1)
+        if alignment > 1:
+            following //= np.int32(alignment)
+        following += _window_positions(self._SCAN_WINDOW)[:count]
+
+        #-------------------------------------------------------------------
+        # follow the chain from the first record
+        #-------------------------------------------------------------------
+        next_of = memoryview(following)
+        chain = array.array('i')
+        append = chain.append
+        k = 0
+        while k < count:
+            append(k)
+            k = next_of[k]
+        chain = np.frombuffer(chain, dtype=np.int32)
+        return RecordIndex(
+            offsets=pos + chain.astype(np.int64) * alignment,
+            lengths=lengths[chain],
+            statuses=(headers[chain] >> status_shift).astype(np.uint8),
+            end=pos + k * alignment,
+        )
+
+    #--------------------------------------------
+    # read the records as arrow record batches
+    #--------------------------------------------
+    def read_batches(self, max_rows: int = 500_000, max_bytes: Optional[int] = None,
+                     start: int = 0, stop: Optional[int] = None) -> Iterator[pa.RecordBatch]:
+        """
+        Read the records from the memory map as pyarrow RecordBatches with the RECORD_SCHEMA
+        (STATUS_SCHEMA with_status).
+        Only the records whose header is in [start, stop) are read (see shard_boundaries).
+        - Scan the headers of up to max_rows records with scan_index
+        - Keep the records that pass the status and length filters (nothing else is copied)
+        - Split them so a batch holds at most max_bytes of record data
+        - Copy the data of the batch out of the memory map in one vectorized pass
+        A single record bigger than max_bytes is returned alone in its batch.
+        """
+        for _, batch in self.read_positioned_batches(max_rows=max_rows, max_bytes=max_bytes, start=start, stop=stop):
+            if batch.num_rows:
+                yield batch
+
+    def read_positioned_batches(self, max_rows: int = 500_000, max_bytes: Optional[int] = None,
+                                start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, pa.RecordBatch]]:
+        """
+        Same as read_batches, but return (end, batch) where end is the position where reading
+        can resume after the batch (every record before it is in this batch or a previous one).
+        A chunk of records that all fail the filters returns an empty batch, so end still moves on.
+        """
+        max_bytes = MAX_BATCH_BYTES if max_bytes is None else min(max_bytes, MAX_BATCH_BYTES)
+        metrics = self.metrics
+        for index in metrics.timed_iter(self._scan_chunks(start=start, stop=stop, max_records=max_rows), 'scan'):
+            if metrics.enabled and len(index.offsets):
+                metrics.count_statuses(index.statuses)
+                metrics.add('bytes_read', index.end - int(index.offsets[0]))
+            keep = self._keep(index)
+            headers = index.offsets[keep]
+            offsets = headers + self.header_size
+            lengths = index.lengths[keep]
+            statuses = index.statuses[keep] if self.with_status else None
+
+            #-------------------------------------------------------------------
+            # split the chunk on max_bytes (at least one record per batch)
+            #-------------------------------------------------------------------
+            if not len(lengths):
+                yield index.end, pa.RecordBatch.from_pylist([], schema=self.schema)
+                continue
+            ends = np.cumsum(lengths, dtype=np.int64)
+            first = 0
+            while first < len(lengths):
+                done = int(ends[first - 1]) if first else 0
+                last = max(int(np.searchsorted(ends, done + max_bytes, side='right')), first + 1)
+                end = int(headers[last]) if last < len(lengths) else index.end
+                with metrics.stage('build'):
+                    batch = self._build_batch(offsets[first:last], lengths[first:last])
+                    if statuses is not None:
+                        status = pa.array(statuses[first:last], type=pa.uint8())
+                        batch = pa.RecordBatch.from_arrays(batch.columns + [status], schema=record_schema(True))
+                yield end, batch
+                first = last
+
+    @property
+    def schema(self) -> pa.Schema:
+        """
+        Schema of the batches returned by read_batches.
+        """
+        return record_schema(self.with_status)
+
+    #--------------------------------------------
+    # split the file in shards at record boundaries
+    #--------------------------------------------
+    def shard_boundaries(self, shards: int, start: int = 0, stop: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Split the file (or the range [start, stop) of the file, start being a record header) in
+        up to `shards` byte ranges (start, stop) of about the same size.
+        Every range starts on a record header, so each one can be read on its own with
+        read_batches(start=start, stop=stop).
+        The boundaries are taken from the loaded index, or found by scanning the headers in chunks.
+        """
+        size = len(self.mmap_obj) if stop is None else min(stop, len(self.mmap_obj))
+        target = max((size - start) // max(shards, 1), 1)
+
+        if self.index is not None:
+            offsets = self.index.offsets
+            first = int(np.searchsorted(offsets, start))
+            last = int(np.searchsorted(offsets, size))
+            if first == last:
+                return []
+            cuts = np.searchsorted(offsets[first:last], start + np.arange(1, max(shards, 1)) * target) + first
+            starts = np.unique(np.concatenate([[first], cuts[cuts < last]]))
+            positions = [int(offsets[i]) for i in starts]
+            positions[0] = start
+            positions.append(int(offsets[last]) if last < len(offsets) else self.index.end)
+            return list(zip(positions[:-1], positions[1:]))
+
+        boundaries = []
+        begin = start
+        while begin < size:
+            #-------------------------------------------------------------------
+            # walk the headers up to the next multiple of the target size
+            # (the same cuts as the ones taken from the index)
+            #-------------------------------------------------------------------
+            shard = (begin - start) // target + 1
+            cut = start + shard * target if shard < shards else size
+            pos = begin
+            if self.tolerant:
+                for index in verified_chunks(self, start=pos, stop=cut, max_records=1_000_000,
+                                             max_length=self.max_record_length):
+                    pos = index.end
+            while pos < cut and not self.tolerant:
+                index = self.scan_index(start=pos, stop=cut, max_records=1_000_000)
+                if not len(index.offsets):
+                    break
+                pos = index.end
+            if pos == begin:
+                break  # end of file (incomplete header)
+            boundaries.append((begin, pos))
+            begin = pos
+        return boundaries
+
+    #--------------------------------------------
+    # index chunks of a byte range
+    #--------------------------------------------
+    def _scan_chunks(self, start: int = 0, stop: Optional[int] = None, max_records: int = 500_000) -> Iterator[RecordIndex]:
+        """
+        Return the RecordIndex of the records in [start, stop) in chunks of max_records,
+        sliced from the loaded index or scanned from the memory map (skipping the bad regions
+        in tolerant mode).
+        """
+        if self.index is not None:
+            offsets = self.index.offsets
+            first = int(np.searchsorted(offsets, start))
+            last = len(offsets) if stop is None else int(np.searchsorted(offsets, stop))
+            for lo in range(first, last, max_records):
+                hi = min(lo + max_records, last)
+                end = int(offsets[hi]) if hi < len(offsets) else self.index.end
+                yield RecordIndex(offsets[lo:hi], self.index.lengths[lo:hi], self.index.statuses[lo:hi], end)
+            return
+
+        if self.tolerant:
+            yield from verified_chunks(self, start=start, stop=stop, max_records=max_records,
+                                       max_length=self.max_record_length, regions=self.skipped)
+            return
+
+        pos = start
+        while True:
+            index = self.scan_index(start=pos, stop=stop, max_records=max_records)
+            if not len(index.offsets):
+                break
+            pos = index.end
+            yield index
+
+    #--------------------------------------------
+    # load or build the sidecar index
+    #--------------------------------------------
+    def load_index(self, build: bool = True, persist: bool = True) -> Optional[RecordIndex]:
+        """
+        Load the sidecar index of the file (see ecopass.core.record_index) into self.index.
+        If there is no valid index and build is True, the headers are scanned once and the
+        index is written next to the file (if persist is True) for the next runs.
+        Once loaded, read_batches, shard_boundaries and the access by record number use it.
+        """
+        if self.index is not None:
+            return self.index
+
+        index = load_index(self.filename, self.header_size, self.alignment, index_path=self.index_path)
+        if index is None and build:
+            index = self.scan_index()
+            if persist:
+                try:
+                    write_index(index, self.filename, self.header_size, self.alignment, index_path=self.index_path)
+                except OSError as error:
+                    if self.debug:
+                        logger.debug("Could not write the index: %s", error)
+        self.index = index
+        self._numbers_loaded = False
+        return index
+
+    #--------------------------------------------
+    # load or build the sidecar key index (indexed files)
+    #--------------------------------------------
+    def load_key_index(self, key_start: int, key_length: int, statuses: Iterable[int] = LIVE_STATUSES,
+                       build: bool = True, persist: bool = True,
+                       key_index_path: Optional[str] = None) -> Optional[KeyIndex]:
+        """
+        Load the sidecar key index of the file (see ecopass.core.key_index) into self.key_index.
+        - key_start: 0-based position of the primary key in the records, key_length: its length
+        - statuses: records indexed when the key index is built (the user data records)
+        If there is no valid key index and build is True, it's built from the record index (or
+        one scan of the headers) and written next to the file if persist is True. When the file
+        only grew since the key index was written, only the records after the last indexed one
+        are scanned and added to it.
+        Pointer records (status 6) are never indexed, see ecopass.core.key_index.
+        """
+        key_index = load_key_index(self.filename, self.header_size, self.alignment, key_start, key_length,
+                                   key_index_path=key_index_path)
+        if key_index is None and build:
+            appendable = load_appendable_key_index(self.filename, self.mmap_obj, self.header_size, self.alignment,
+                                                   key_start, key_length, key_index_path=key_index_path)
+            start = appendable[1] if appendable is not None else 0
+            if self.index is not None:
+                first = int(np.searchsorted(self.index.offsets, start))
+                index = RecordIndex(self.index.offsets[first:], self.index.lengths[first:],
+                                    self.index.statuses[first:], self.index.end)
+            else:
+                index = self.scan_index(start=start)
+            key_index = build_key_index(self.mmap_obj, index, self.header_size, key_start, key_length,
+                                        statuses=list(statuses))
+            if appendable is not None:
+                key_index = merge_key_indexes(appendable[0], key_index)
+            if persist:
+                try:
+                    write_key_index(key_index, self.filename, self.header_size, self.alignment, key_start, key_length,
+                                    key_index_path=key_index_path, data=self.mmap_obj, end=index.end)
+                except OSError as error:
+                    if self.debug:
+                        logger.debug("Could not write the key index: %s", error)
+        self.key_index = key_index
+        return key_index
+
+    def key_range(self, low: bytes, high: Optional[bytes] = None) -> KeyIndex:
+        """
+        Return the records whose key is low (high is None) or between low and high (both
+        included), sorted by key. Keys shorter than the key length compare as if padded with
+        x'00', so pad them (e.g. with spaces) to match the keys of the file.
+        """
+        if self.key_index is None:
+            raise ValueError("No key index loaded, call load_key_index first")
+        return key_range(self.key_index, low, high)
+
+    def get_by_key(self, key: bytes) -> List[Tuple[int, bytes]]:
+        """
+        Return the length and the data of the records with the key (usually one).
+        """
+        found = self.key_range(key)
+        return [
+            (int(length), self.mmap_obj[int(offset) + self.header_size:int(offset) + self.header_size + int(length)])
+            for offset, length in zip(found.offsets, found.lengths)
+        ]
+
+    #--------------------------------------------
+    # statistics of the file
+    #--------------------------------------------
+    def stats(self, top: int = 10, max_records: int = 1_000_000) -> FileStats:
+        """
+        Return the FileStats of the file (see ecopass.core.stats): records and bytes per status,
+        histogram of the (status, length) pairs, header and padding bytes and the top largest
+        records. Only the headers are read (or the loaded index is used); the status and length
+        filters are not applied.
+        """
+        return file_stats(self, top=top, max_records=max_records)
+
+    #--------------------------------------------
+    # filter the records of an index
+    #--------------------------------------------
+    def _keep(self, index: RecordIndex) -> np.ndarray:
+        """
+        Return the mask of the records of the index that pass the status and length filters.
+        """
+        keep = np.isin(index.statuses, np.array(self.allowed_statuses, dtype=np.uint8))
+        if self.record_length:
+            keep &= np.isin(index.lengths, np.array(self.record_length, dtype=np.int64))
+        return keep
+
+    #--------------------------------------------
+    # access the records by number (uses the index)
+    #--------------------------------------------
+    def _record_numbers(self) -> Optional[np.ndarray]:
+        """
+        Return the positions in the index of the records that pass the filters,
+        or None when every record of the index passes them.
+        """
+        index = self.load_index()
+        if not self._numbers_loaded:
+            keep = self._keep(index)
+            self._numbers = None if keep.all() else np.flatnonzero(keep)
+            self._numbers_loaded = True
+        return self._numbers
+
+    def __len__(self) -> int:
+        """
+        Number of records that pass the filters (the records returned by read_records).
+        """
+        numbers = self._record_numbers()
+        return len(self.index.offsets) if numbers is None else len(numbers)
+
+    def get_record(self, n: int) -> Tuple[int, bytes]:
+        """
+        Return the length and the data of the record number n (same numbering as read_records).
+        """
+        count = len(self)
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError(f"Record {n} out of range ({count} records)")
+        numbers = self._record_numbers()
+        i = n if numbers is None else int(numbers[n])
+        offset = int(self.index.offsets[i]) + self.header_size
+        length = int(self.index.lengths[i])
+        return length, self.mmap_obj[offset:offset + length]
+
+    def iter_range(self, start: int, stop: Optional[int] = None) -> Iterator[Tuple[int, bytes]]:
+        """
+        Iterate over the length and the data of the records number start to stop (excluded),
+        like read_records but without walking the headers before start.
+        """
+        first, last, _ = slice(start, stop).indices(len(self))
+        numbers = self._record_numbers()
+        f = self.mmap_obj
+        for n in range(first, last):
+            i = n if numbers is None else int(numbers[n])
+            offset = int(self.index.offsets[i]) + self.header_size
+            yield int(self.index.lengths[i]), f[offset:offset + int(self.index.lengths[i])]
+
+    def _build_batch(self, offsets: np.ndarray, lengths: np.ndarray) -> pa.RecordBatch:
+        """
+        Build a RecordBatch from the data offsets and lengths of the records.
+        The bytes of the records are copied once from the span of the memory map they cover
+        into the values buffer of the binary column:
+        - records with the same length at a fixed stride are copied as a strided 2D view
+        - otherwise the span is wrapped without a copy in a binary array whose values alternate
+          between a record and the gap after it (header and padding of the next record), and
+          pyarrow's take copies the records out (one memcpy per record, in C++)
+        """
+        span_start = int(offsets[0])
+        span_end = int(offsets[-1]) + int(lengths[-1])
+        strides = np.diff(offsets)
+
+        #-------------------------------------------------------------------
+        # the view on the memory map is released right away,
+        # the memory map can't be closed while it exists
+        #-------------------------------------------------------------------
+        view = np.frombuffer(self.mmap_obj, dtype=np.uint8, count=span_end - span_start, offset=span_start)
+        try:
+            if len(lengths) > 1 and (lengths == lengths[0]).all() and (strides == strides[0]).all():
+                values = np.lib.stride_tricks.as_strided(
+                    view, shape=(len(lengths), int(lengths[0])), strides=(int(strides[0]), 1), writeable=False
+                ).copy()
+                value_offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+                np.cumsum(lengths, out=value_offsets[1:])
+                value = pa.Array.from_buffers(
+                    pa.binary(), len(lengths), [None, pa.py_buffer(value_offsets), pa.py_buffer(values)]
+                )
+            else:
+                bounds = np.empty(2 * len(lengths), dtype=np.int64)
+                bounds[0::2] = offsets - span_start
+                bounds[1::2] = bounds[0::2] + lengths
+                interleaved = pa.Array.from_buffers(
+                    pa.large_binary(), len(bounds) - 1, [None, pa.py_buffer(bounds), pa.py_buffer(view)]
+                )
+                value = interleaved.take(pa.array(np.arange(0, len(bounds), 2))).cast(pa.binary())
+                del interleaved
+        finally:
+            del view
+
+        return pa.RecordBatch.from_arrays([pa.array(lengths, type=pa.int32()), value], schema=record_schema())
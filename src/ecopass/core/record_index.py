@@ -0,0 +1,124 @@
+"""
+This module contains the RecordIndex returned by RecordHeader.scan_index and the sidecar
+record index, which stores the RecordIndex of a file on disk next to the file, so the headers
+don't have to be walked again the next time the same file is read.
+
+The index file is <filename>.ecpidx with a fixed 64-byte header followed by the arrays:
+- header: magic, format version, header size, alignment, size and mtime of the indexed file,
+  number of records and end position of the last record (little-endian)
+- offsets: int64[count]
+- lengths: int32[count]
+- statuses: uint8[count]
+
+The arrays are memory mapped when the index is loaded (nothing is read up front).
+The index is only used when the size and mtime of the file, the header size and the
+alignment match the ones it was built with.
+"""
+from __future__ import annotations
+
+import os
+import struct
+from typing import NamedTuple, Optional
+
+from ecopass.core.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+INDEX_SUFFIX = '.ecpidx'
+INDEX_MAGIC = b'ECPIDX\x00\x00'
+INDEX_VERSION = 1
+
+# magic, version, header_size, alignment, file_size, file_mtime_ns, count, end
+_INDEX_HEADER = struct.Struct('<8sHHIqqqq')
+_INDEX_HEADER_SIZE = 64
+
+
+class RecordIndex(NamedTuple):
+    """
+    Compact index of the records of a file returned by RecordHeader.scan_index().
+    - offsets: position of each record header in the file (int64)
+    - lengths: length of the data of each record (int32)
+    - statuses: status of each record, see RecordType (uint8)
+    - end: position right after the last indexed record (where a next scan can start)
+    """
+    offsets: np.ndarray
+    lengths: np.ndarray
+    statuses: np.ndarray
+    end: int
+
+
+#--------------------------------------------
+# path of the index of a file
+#--------------------------------------------
+def index_path_for(filename: str) -> str:
+    """
+    Return the path of the sidecar index of a file.
+    """
+    return os.fspath(filename) + INDEX_SUFFIX
+
+
+#--------------------------------------------
+# write the index
+#--------------------------------------------
+def write_index(index: RecordIndex, filename: str, header_size: int, alignment: int,
+                index_path: Optional[str] = None) -> str:
+    """
+    Write the RecordIndex of a file to its sidecar index and return the path of the index.
+    The index is written to a temporary file first, so a reader never sees a partial index.
+    """
+    index_path = index_path or index_path_for(filename)
+    stat = os.stat(filename)
+    header = _INDEX_HEADER.pack(
+        INDEX_MAGIC, INDEX_VERSION, header_size, alignment,
+        stat.st_size, stat.st_mtime_ns, len(index.offsets), index.end,
+    )
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(_INDEX_HEADER_SIZE, b'\x00'))
+        f.write(np.ascontiguousarray(index.offsets, dtype='<i8').tobytes())
+        f.write(np.ascontiguousarray(index.lengths, dtype='<i4').tobytes())
+        f.write(np.ascontiguousarray(index.statuses, dtype=np.uint8).tobytes())
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+#--------------------------------------------
+# load the index
+#--------------------------------------------
+def load_index(filename: str, header_size: int, alignment: int,
+               index_path: Optional[str] = None) -> Optional[RecordIndex]:
+    """
+    Load the sidecar index of a file.
+    Return None if there is no index or if it doesn't match the file anymore
+    (size, mtime, header size or alignment changed).
+    """
+    index_path = index_path or index_path_for(filename)
+    try:
+        with open(index_path, 'rb') as f:
+            header = f.read(_INDEX_HEADER_SIZE)
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if len(header) < _INDEX_HEADER_SIZE:
+        return None
+
+    magic, version, index_header_size, index_alignment, file_size, file_mtime_ns, count, end = \
+        _INDEX_HEADER.unpack_from(header)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        return None
+    if (index_header_size, index_alignment) != (header_size, alignment):
+        return None
+    if (file_size, file_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    if os.path.getsize(index_path) != _INDEX_HEADER_SIZE + count * 13:
+        return None
+
+    #-------------------------------------------------------------------
+    # memory map the arrays (np.memmap can't map empty arrays)
+    #-------------------------------------------------------------------
+    if count == 0:
+        return RecordIndex(np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.uint8), end)
+    offsets = np.memmap(index_path, dtype='<i8', mode='r', offset=_INDEX_HEADER_SIZE, shape=(count,))
+    lengths = np.memmap(index_path, dtype='<i4', mode='r', offset=_INDEX_HEADER_SIZE + count * 8, shape=(count,))
+    statuses = np.memmap(index_path, dtype=np.uint8, mode='r', offset=_INDEX_HEADER_SIZE + count * 12, shape=(count,))
+    return RecordIndex(offsets=offsets, lengths=lengths, statuses=statuses, end=end)
@@ -0,0 +1,223 @@
+"""
+This module contains the statistics of a file, used by `ecopass stats` and RecordHeader.stats():
+records and bytes per status, the distribution of the record lengths, the bytes taken by the
+headers and the padding, and the largest records.
+
+The headers are walked once (or the sidecar index is used when it's loaded) and every chunk of
+the index is reduced with NumPy, so no record data is read:
+- the (status, length) pairs are counted with one bincount per chunk (a sort for the lengths
+  too large for a dense count, see _DENSE_LENGTHS)
+- the totals per status are computed from those counts at the end
+- the largest records are the longest of every chunk, merged with the ones kept so far
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Tuple
+
+from ecopass.core.key_index import LIVE_STATUSES
+from ecopass.core.lazy import lazy_import
+
+if TYPE_CHECKING:
+    from ecopass.core.record_header import RecordHeader
+
+np = lazy_import('numpy')
+
+# status of the deleted records (RecordType.DELETED_RECORD), their space is available for reuse
+DELETED_STATUS = 2
+
+# lengths counted with a dense bincount (16 statuses * 64K lengths = 8 MB of counters)
+_DENSE_LENGTHS = 1 << 16
+
+
+class StatusStats(NamedTuple):
+    """
+    Records of one status.
+    - data_bytes: bytes of record data, padding_bytes: bytes of padding after the records
+    - bytes: space taken in the file (headers, data and padding)
+    """
+    records: int
+    data_bytes: int
+    padding_bytes: int
+    bytes: int
+
+
+class LargestRecord(NamedTuple):
+    offset: int
+    length: int
+    status: int
+
+
+class FileStats(NamedTuple):
+    """
+    Result of file_stats.
+    - size: size of the file, records: records found
+    - header_bytes / data_bytes / padding_bytes: bytes of the headers, the record data and the padding
+      (only the padding in the file: the last record can end the file without its padding)
+    - trailing_bytes: bytes after the last record, skipped_bytes: bad regions skipped (tolerant mode)
+    - by_status: StatusStats of every status found
+    - statuses, lengths, counts: the histogram, records per (status, length), sorted by status and length
+    - largest: the largest records, longest first (then in file order)
+    """
+    size: int
+    records: int
+    header_bytes: int
+    data_bytes: int
+    padding_bytes: int
+    trailing_bytes: int
+    skipped_bytes: int
+    by_status: Dict[int, StatusStats]
+    statuses: np.ndarray
+    lengths: np.ndarray
+    counts: np.ndarray
+    largest: List[LargestRecord]
+
+    @property
+    def live_bytes(self) -> int:
+        """Space taken by the user data records (normal and reduced, at their place or moved)."""
+        return sum(stats.bytes for status, stats in self.by_status.items() if status in LIVE_STATUSES)
+
+    @property
+    def deleted_bytes(self) -> int:
+        """Space taken by the deleted records."""
+        return self.by_status[DELETED_STATUS].bytes if DELETED_STATUS in self.by_status else 0
+
+    @property
+    def padding_overhead(self) -> float:
+        """Share of the file taken by the padding."""
+        return self.padding_bytes / self.size if self.size else 0.0
+
+    def length_counts(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the distinct lengths (sorted) and their number of records, all statuses together.
+        """
+        lengths, inverse = np.unique(self.lengths, return_inverse=True)
+        return lengths, np.bincount(inverse, weights=self.counts, minlength=len(lengths)).astype(np.int64)
+
+
+#--------------------------------------------
+# count the (status, length) pairs of a chunk
+#--------------------------------------------
+class _Histogram():
+    """
+    Records per (status, length): dense counters for the short lengths, a dict for the others.
+    """
+    def __init__(self):
+        self.dense = np.zeros(0, dtype=np.int64)
+        self.sparse: Dict[int, int] = {}
+
+    def add(self, statuses: np.ndarray, lengths: np.ndarray) -> None:
+        keys = lengths.astype(np.int64) * 16 + statuses
+        short = lengths < _DENSE_LENGTHS
+        if not short.all():
+            values, counts = np.unique(keys[~short], return_counts=True)
+            for key, count in zip(values.tolist(), counts.tolist()):
+                self.sparse[key] = self.sparse.get(key, 0) + count
+            keys = keys[short]
+        if len(keys):
+            counts = np.bincount(keys, minlength=len(self.dense))
+            counts[:len(self.dense)] += self.dense
+            self.dense = counts
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return the statuses, lengths and counts of the pairs found, sorted by status and length.
+        """
+        keys = np.flatnonzero(self.dense)
+        counts = self.dense[keys]
+        if self.sparse:
+            keys = np.concatenate([keys, np.array(list(self.sparse), dtype=np.int64)])
+            counts = np.concatenate([counts, np.array(list(self.sparse.values()), dtype=np.int64)])
+        statuses, lengths = keys % 16, keys // 16
+        order = np.lexsort((lengths, statuses))
+        return statuses[order].astype(np.uint8), lengths[order], counts[order]
+
+
+def _largest(offsets: np.ndarray, lengths: np.ndarray, count: int) -> np.ndarray:
+    """
+    Return the positions of the count longest records (the first ones in file order on ties).
+    """
+    if len(lengths) <= count:
+        return np.arange(len(lengths))
+    shortest = np.partition(lengths, len(lengths) - count)[len(lengths) - count]
+    longer = np.flatnonzero(lengths > shortest)
+    tied = np.flatnonzero(lengths == shortest)
+    tied = tied[np.argsort(offsets[tied], kind='stable')[:count - len(longer)]]
+    return np.concatenate([longer, tied])
+
+
+#--------------------------------------------
+# statistics of a whole file
+#--------------------------------------------
+def file_stats(record_header: 'RecordHeader', top: int = 10, max_records: int = 1_000_000) -> FileStats:
+    """
+    Return the FileStats of every record of the file (the status and length filters of the
+    RecordHeader are not applied) and its top largest records.
+    """
+    header_size = record_header.header_size
+    alignment = record_header.alignment
+    histogram = _Histogram()
+    top_offsets = np.empty(0, np.int64)
+    top_lengths = np.empty(0, np.int64)
+    top_statuses = np.empty(0, np.uint8)
+    skipped_before = sum(region.stop - region.start for region in record_header.skipped)
+    end = 0
+    last_status, last_stop, last_length = None, 0, 0     # the last record: status, end of its data, length
+    for index in record_header._scan_chunks(max_records=max_records):
+        end = index.end
+        if not len(index.offsets):
+            continue
+        histogram.add(index.statuses, index.lengths)
+        last_status = int(index.statuses[-1])
+        last_length = int(index.lengths[-1])
+        last_stop = int(index.offsets[-1]) + header_size + last_length
+        if top > 0:
+            keep = _largest(index.offsets, index.lengths, top)
+            top_offsets = np.concatenate([top_offsets, index.offsets[keep].astype(np.int64)])
+            top_lengths = np.concatenate([top_lengths, index.lengths[keep].astype(np.int64)])
+            top_statuses = np.concatenate([top_statuses, index.statuses[keep]])
+            keep = _largest(top_offsets, top_lengths, top)
+            top_offsets, top_lengths, top_statuses = top_offsets[keep], top_lengths[keep], top_statuses[keep]
+
+    #-------------------------------------------------------------------
+    # totals per status from the histogram
+    # the file can end right after the data of the last record: only the padding bytes in
+    # the file are counted, so headers + data + padding never exceed the size
+    #-------------------------------------------------------------------
+    size = len(record_header.mmap_obj)
+    statuses, lengths, counts = histogram.arrays()
+    padding = (alignment - (header_size + lengths) % alignment) % alignment
+    last_padding = (alignment - (header_size + last_length) % alignment) % alignment
+    missing_padding = max(last_stop + last_padding - size, 0)
+    by_status = {}
+    for status in np.unique(statuses).tolist():
+        mask = statuses == status
+        records = int(counts[mask].sum())
+        data_bytes = int((lengths[mask] * counts[mask]).sum())
+        padding_bytes = int((padding[mask] * counts[mask]).sum())
+        if status == last_status:
+            padding_bytes -= missing_padding
+        by_status[status] = StatusStats(
+            records=records, data_bytes=data_bytes, padding_bytes=padding_bytes,
+            bytes=records * header_size + data_bytes + padding_bytes,
+        )
+
+    order = np.lexsort((top_offsets, -top_lengths))
+    records = int(counts.sum())
+    return FileStats(
+        size=size,
+        records=records,
+        header_bytes=records * header_size,
+        data_bytes=sum(stats.data_bytes for stats in by_status.values()),
+        padding_bytes=sum(stats.padding_bytes for stats in by_status.values()),
+        trailing_bytes=max(size - end, 0),
+        skipped_bytes=sum(region.stop - region.start for region in record_header.skipped) - skipped_before,
+        by_status=by_status,
+        statuses=statuses,
+        lengths=lengths,
+        counts=counts,
+        largest=[
+            LargestRecord(offset, length, status)
+            for offset, length, status in zip(
+                top_offsets[order].tolist(), top_lengths[order].tolist(), top_statuses[order].tolist())
+        ],
+    )
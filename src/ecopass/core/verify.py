@@ -0,0 +1,262 @@
+"""
+This module contains the structural checks of a file, used by `ecopass verify` and by the
+tolerant mode of RecordHeader (RecordHeader(tolerant=True)).
+
+A record is bad when:
+- its status isn't one of the RecordType values (0, 14 and 15 are never written)
+- its data runs past the end of the file
+- it's longer than the maximum record length, when it is given
+- its padding bytes aren't zero (only when check_padding is set)
+
+The headers are walked with RecordHeader.scan_index and every chunk is checked with NumPy, so
+the whole file is checked at header-scan speed without copying record data. After a bad record
+the next plausible header is searched (aligned positions starting RESYNC_CONFIRM valid records
+with zero padding in a row, or valid records up to the end of the file), and the bytes in
+between are reported as a BadRegion instead of stopping there. The padding is always checked
+while searching: random bytes often look like a few valid headers, rarely with zero padding.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+from typing import TYPE_CHECKING, Iterator, List, NamedTuple, Optional, Tuple
+
+from ecopass.core.lazy import lazy_import
+from ecopass.core.record_index import RecordIndex
+
+if TYPE_CHECKING:
+    from ecopass.core.record_header import RecordHeader
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+# statuses of the RecordType values
+VALID_STATUSES = tuple(range(1, 14))
+
+# valid records in a row needed to accept a position as the next header after a bad region
+RESYNC_CONFIRM = 8
+
+# positions checked at once while searching the next header
+_RESYNC_WINDOW = 1 << 16
+
+SKIPPED_FILE = '_ecopass_skipped.json'
+
+
+class BadRegion(NamedTuple):
+    """
+    Byte range [start, stop) of the file that holds no valid record, and why its first record is bad.
+    """
+    start: int
+    stop: int
+    reason: str
+
+
+class VerifyReport(NamedTuple):
+    """
+    Result of verify_file.
+    - records: valid records found
+    - size: size of the file
+    - trailing_bytes: bytes after the last record too short to hold a header
+    - regions: the bad regions, in order
+    """
+    records: int
+    size: int
+    trailing_bytes: int
+    regions: List[BadRegion]
+
+    @property
+    def bad_bytes(self) -> int:
+        return sum(region.stop - region.start for region in self.regions)
+
+
+#--------------------------------------------
+# check the records of an index chunk
+#--------------------------------------------
+def check_records(data, index: RecordIndex, header_size: int, alignment: int, max_length: Optional[int] = None,
+                  check_padding: bool = False) -> Tuple[int, Optional[str]]:
+    """
+    Return the number of valid records at the start of the chunk and the reason why the next
+    one is bad (None when every record is valid).
+    """
+    if not len(index.offsets):
+        return 0, None
+    firsts = []
+    bad = np.flatnonzero(~np.isin(index.statuses, np.array(VALID_STATUSES, dtype=np.uint8)))
+    if bad.size:
+        firsts.append((int(bad[0]), f"invalid status {int(index.statuses[bad[0]])}"))
+    if max_length is not None:
+        bad = np.flatnonzero(index.lengths > max_length)
+        if bad.size:
+            firsts.append((int(bad[0]), f"length {int(index.lengths[bad[0]])} over the maximum of {max_length}"))
+    if check_padding and alignment > 1:
+        #-------------------------------------------------------------------
+        # the padding bytes of every record, up to the end of the file
+        #-------------------------------------------------------------------
+        view = np.frombuffer(data, dtype=np.uint8)
+        try:
+            ends = index.offsets.astype(np.int64) + header_size + index.lengths
+            padding = (alignment - (header_size + index.lengths.astype(np.int64)) % alignment) % alignment
+            nonzero = np.zeros(len(ends), dtype=bool)
+            for i in range(alignment - 1):
+                positions = ends + i
+                checked = (padding > i) & (positions < len(view))
+                nonzero[checked] |= view[positions[checked]] != 0
+        finally:
+            del view
+        bad = np.flatnonzero(nonzero)
+        if bad.size:
+            firsts.append((int(bad[0]), "padding is not zero"))
+    if not firsts:
+        return len(index.offsets), None
+    return min(firsts)
+
+
+#--------------------------------------------
+# find the next header after a bad record
+#--------------------------------------------
+def find_next_record(data, pos: int, stop: int, header_size: int, alignment: int,
+                     max_length: Optional[int] = None) -> int:
+    """
+    Return the first aligned position in [pos, stop) that starts RESYNC_CONFIRM valid records
+    with zero padding (or such records up to the end of the file), or stop if there is none.
+    """
+    size = len(data)
+    stop = min(stop, size)
+    pos += (alignment - pos % alignment) % alignment
+    status_shift = header_size * 8 - 4
+    length_mask = (1 << status_shift) - 1
+
+    def header(p: int) -> Tuple[int, int]:
+        value = int.from_bytes(data[p:p + header_size], 'big')
+        return value >> status_shift, value & length_mask
+
+    def plausible(p: int) -> bool:
+        status, length = header(p)
+        if not 1 <= status <= 13 or p + header_size + length > size:
+            return False
+        if max_length is not None and length > max_length:
+            return False
+        end = p + header_size + length
+        padding = (alignment - (header_size + length) % alignment) % alignment
+        return not any(data[end:min(end + padding, size)])
+
+    def confirmed(p: int) -> bool:
+        for _ in range(RESYNC_CONFIRM):
+            if p + header_size > size:
+                return True   # end of the file
+            if not plausible(p):
+                return False
+            _, length = header(p)
+            p += header_size + length
+            p += (alignment - (header_size + length) % alignment) % alignment
+        return True
+
+    while pos < stop:
+        count = min(_RESYNC_WINDOW, (min(stop - 1, size - header_size) - pos) // alignment + 1)
+        if count <= 0:
+            break
+        candidates = pos + alignment * np.arange(count, dtype=np.int64)
+        view = np.frombuffer(data, dtype=np.uint8)
+        try:
+            values = view[candidates].astype(np.int64)
+            for i in range(1, header_size):
+                values = (values << 8) | view[candidates + i]
+        finally:
+            del view
+        statuses = values >> status_shift
+        lengths = values & length_mask
+        maybe = (statuses >= 1) & (statuses <= 13) & (candidates + header_size + lengths <= size)
+        if max_length is not None:
+            maybe &= lengths <= max_length
+        for candidate in candidates[maybe]:
+            if confirmed(int(candidate)):
+                return int(candidate)
+        pos = int(candidates[-1]) + alignment
+    return stop
+
+
+#--------------------------------------------
+# walk the valid records of a range
+#--------------------------------------------
+def verified_chunks(record_header: 'RecordHeader', start: int = 0, stop: Optional[int] = None,
+                    max_records: int = 500_000, max_length: Optional[int] = None, check_padding: bool = False,
+                    regions: Optional[List[BadRegion]] = None) -> Iterator[RecordIndex]:
+    """
+    Return the RecordIndex of the valid records in [start, stop) in chunks of up to max_records,
+    like RecordHeader._scan_chunks, but skip the bad regions instead of failing on them.
+    Every bad region is added to regions and followed by an empty chunk ending where reading
+    resumes, so a reader committing up to the end of its chunks moves past it.
+    """
+    data = record_header.mmap_obj
+    size = len(data)
+    stop = size if stop is None else min(stop, size)
+    header_size = record_header.header_size
+    alignment = record_header.alignment
+    pos = start
+    while pos < stop:
+        index = record_header.scan_index(start=pos, stop=stop, max_records=max_records, strict=False)
+        good, reason = check_records(data, index, header_size, alignment, max_length, check_padding)
+        if good < len(index.offsets):
+            bad = int(index.offsets[good])
+        elif index.end < stop and index.end + header_size <= size and len(index.offsets) < max_records:
+            bad, reason = index.end, "record past the end of the file"
+        else:
+            if not len(index.offsets):
+                break   # end of the file (incomplete header)
+            pos = index.end
+            yield index
+            continue
+
+        if good:
+            yield RecordIndex(index.offsets[:good], index.lengths[:good], index.statuses[:good], bad)
+        resume = find_next_record(data, bad + alignment, stop, header_size, alignment, max_length)
+        region = BadRegion(bad, resume, reason)
+        if regions is not None:
+            regions.append(region)
+        record_header.metrics.add('bytes_skipped', resume - bad)
+        if record_header.debug:
+            logger.debug("Skipped bytes %s to %s: %s", f"{bad:,}", f"{resume:,}", reason)
+        yield RecordIndex(np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.uint8), resume)
+        pos = resume
+
+
+#--------------------------------------------
+# verify a whole file
+#--------------------------------------------
+def verify_file(record_header: 'RecordHeader', max_length: Optional[int] = None, check_padding: bool = True,
+                max_records: int = 1_000_000) -> VerifyReport:
+    """
+    Check every record of the file and return a VerifyReport with all the bad regions.
+    """
+    regions: List[BadRegion] = []
+    records = end = 0
+    for index in verified_chunks(record_header, max_records=max_records, max_length=max_length,
+                                 check_padding=check_padding, regions=regions):
+        records += len(index.offsets)
+        end = index.end
+    size = len(record_header.mmap_obj)
+    return VerifyReport(records=records, size=size, trailing_bytes=size - end, regions=regions)
+
+
+#--------------------------------------------
+# keep the skipped regions of a conversion
+#--------------------------------------------
+def write_skipped(path_output: str, path_input: str, regions: List[BadRegion]) -> str:
+    """
+    Add the regions skipped by a tolerant conversion to <path_output>/_ecopass_skipped.json
+    (the ones of the previous runs are kept) and return its path.
+    """
+    path = os.path.join(path_output, SKIPPED_FILE)
+    known = []
+    if os.path.exists(path):
+        with open(path) as f:
+            known = [BadRegion(**region) for region in json.load(f)['regions']]
+    merged = sorted(set(known) | set(regions))
+    os.makedirs(path_output, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(input=os.path.abspath(path_input), regions=[region._asdict() for region in merged]), f, indent=2)
+    os.replace(tmp_path, path)
+    return path
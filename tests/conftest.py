@@ -0,0 +1,42 @@
+"""
+Shared helpers of the tests: the package is imported from src/ and the synthetic files are
+written with benchmarks/generate.py (or record by record with write_records).
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, 'src'), os.path.join(ROOT, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def _encode_records(records, header_size=2, alignment=2):
+    out = bytearray()
+    for status, data in records:
+        out += ((status << (header_size * 8 - 4)) | len(data)).to_bytes(header_size, 'big')
+        out += data
+        out += bytes((alignment - (header_size + len(data)) % alignment) % alignment)
+    return bytes(out)
+
+
+@pytest.fixture
+def encode_records():
+    """
+    Return the bytes of a file holding the (status, data) records, with zero padding.
+    """
+    return _encode_records
+
+
+@pytest.fixture
+def write_records(tmp_path):
+    """
+    Write (status, data) records to a file of tmp_path and return its path.
+    """
+    def write(records, name='input.bin', header_size=2, alignment=2):
+        path = tmp_path / name
+        path.write_bytes(_encode_records(records, header_size, alignment))
+        return str(path)
+    return write
@@ -0,0 +1,127 @@
+import json
+import os
+
+import pyarrow.dataset as ds
+import pytest
+from click.testing import CliRunner
+from generate import generate_file
+
+from ecopass.cli import main
+from ecopass.core.checkpoint import CHECKPOINT_FILE
+from ecopass.core.partitioned_writer import PartitionedWriter
+from ecopass.core.record_header import RecordHeader
+
+
+def _convert(*args):
+    result = CliRunner().invoke(main, ['convert', *args])
+    return result
+
+
+def _rows(path_output):
+    table = ds.dataset(path_output, format='parquet', partitioning='hive').to_table()
+    return sorted(zip(table.column('rdw').to_pylist(), table.column('value').to_pylist()))
+
+
+def _expected(path_input):
+    with RecordHeader(path_input) as record_header:
+        return sorted(record_header.read_records())
+
+
+def _checkpoint(path_output):
+    with open(os.path.join(path_output, CHECKPOINT_FILE)) as f:
+        return json.load(f)
+
+
+def test_incremental(tmp_path):
+    path_input = str(tmp_path / 'input.bin')
+    path_output = str(tmp_path / 'out')
+    generate_file(path_input, records=3000, lengths='choice:10,20,30', seed=1)
+    assert _convert('--input', path_input, '--output', path_output).exit_code == 0
+    first = _checkpoint(path_output)
+
+    #-------------------------------------------------------------------
+    # append records to the input: only they are converted
+    #-------------------------------------------------------------------
+    appended = str(tmp_path / 'appended.bin')
+    generate_file(appended, records=1000, lengths='choice:10,20,30', seed=2)
+    with open(path_input, 'ab') as f, open(appended, 'rb') as g:
+        f.write(g.read())
+    result = _convert('--input', path_input, '--output', path_output, '--incremental')
+    assert result.exit_code == 0, result.output
+    second = _checkpoint(path_output)
+
+    assert second['ranges'] == [[0, os.path.getsize(path_input)]]
+    assert second['records'] == first['records'] + len(_expected(appended))
+    assert set(first['files']) < set(second['files'])
+    assert _rows(path_output) == _expected(path_input)
+
+
+
+@pytest.mark.parametrize('workers', ['1', '2'])
+@pytest.mark.parametrize('written', [1, 5])   # bytes of the last record written so far (header, data)
+def test_incremental_partial_record(tmp_path, encode_records, workers, written):
+    path_input = str(tmp_path / 'input.bin')
+    path_output = str(tmp_path / 'out')
+    generate_file(path_input, records=3000, lengths='choice:10,20,30', seed=1)
+    size = os.path.getsize(path_input)
+
+    #-------------------------------------------------------------------
+    # the producer is writing a record: the run stops before it
+    #-------------------------------------------------------------------
+    tail = encode_records([(4, b'x' * 30), (4, b'y' * 12)])
+    with open(path_input, 'ab') as f:
+        f.write(tail[:written])
+    result = _convert('--input', path_input, '--output', path_output, '--incremental', '--workers', workers)
+    assert result.exit_code == 0, result.output
+    assert _checkpoint(path_output)['ranges'] == [[0, size]]
+
+    #-------------------------------------------------------------------
+    # the record is complete and another one is appended: both are converted
+    #-------------------------------------------------------------------
+    with open(path_input, 'ab') as f:
+        f.write(tail[written:])
+    result = _convert('--input', path_input, '--output', path_output, '--incremental', '--workers', workers)
+    assert result.exit_code == 0, result.output
+    assert _checkpoint(path_output)['ranges'] == [[0, size + len(tail)]]
+    assert _rows(path_output) == _expected(path_input)
+
+def test_resume(tmp_path, monkeypatch):
+    path_input = str(tmp_path / 'input.bin')
+    path_output = str(tmp_path / 'out')
+    generate_file(path_input, records=40000, lengths='choice:100,200', seed=3)
+
+    #-------------------------------------------------------------------
+    # interrupt the conversion after a few batches (one commit every batch)
+    #-------------------------------------------------------------------
+    write_batch = PartitionedWriter.write_batch
+    calls = []
+
+    def failing_write_batch(self, batch):
+        calls.append(batch.num_rows)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        write_batch(self, batch)
+
+    monkeypatch.setattr(PartitionedWriter, 'write_batch', failing_write_batch)
+    result = _convert('--input', path_input, '--output', path_output, '--batch-size', '10000', '--checkpoint-every', '1')
+    assert result.exit_code != 0
+    interrupted = _checkpoint(path_output)
+    assert 0 < interrupted['records'] < 40000
+    monkeypatch.setattr(PartitionedWriter, 'write_batch', write_batch)
+
+    result = _convert('--input', path_input, '--output', path_output, '--batch-size', '10000', '--resume')
+    assert result.exit_code == 0, result.output
+    resumed = _checkpoint(path_output)
+    assert resumed['ranges'] == [[0, os.path.getsize(path_input)]]
+    assert resumed['records'] == len(_expected(path_input))
+    assert _rows(path_output) == _expected(path_input)
+
+
+def test_resume_rejects_another_input(tmp_path):
+    path_output = str(tmp_path / 'out')
+    for name in ('a.bin', 'b.bin'):
+        generate_file(str(tmp_path / name), records=100)
+    assert _convert('--input', str(tmp_path / 'a.bin'), '--output', path_output).exit_code == 0
+    result = _convert('--input', str(tmp_path / 'b.bin'), '--output', path_output, '--resume')
+    assert result.exit_code != 0
+    assert "The checkpoint was written for" in result.output
@@ -0,0 +1,65 @@
+from decimal import Decimal
+
+import pyarrow as pa
+import pytest
+
+from ecopass.core.decoder import RecordDecoder, parse_layout
+from ecopass.core.record_header import RECORD_SCHEMA
+
+
+def _batch(values):
+    return pa.RecordBatch.from_arrays(
+        [pa.array([len(value) for value in values], pa.int32()), pa.array(values, pa.binary())], schema=RECORD_SCHEMA,
+    )
+
+
+def _decode(layout, values, encoding='latin1'):
+    return RecordDecoder(layout, encoding=encoding).decode(_batch(values)).to_pydict()
+
+
+def test_packed():
+    layout = [{'name': 'amount', 'start': 1, 'length': 3, 'type': 'packed', 'scale': 2}]
+    values = [b'\x12\x34\x5C', b'\x12\x34\x5D', b'\x00\x00\x0F', b'\x12\x34\x55', b'\x1A\x34\x5C', b'\x12']
+    assert _decode(layout, values)['amount'] == [Decimal('123.45'), Decimal('-123.45'), Decimal('0.00'), None, None, None]
+
+
+def test_packed_over_18_digits():
+    layout = [{'name': 'amount', 'start': 2, 'length': 10, 'type': 'packed', 'scale': 4}]
+    value = b'X' + bytes.fromhex('1234567890123456789D')
+    decoded = _decode(layout, [value])['amount']
+    assert decoded == [Decimal('-123456789012345.6789')]
+
+
+def test_zoned():
+    layout = [{'name': 'count', 'start': 1, 'length': 5, 'type': 'zoned', 'scale': 1}]
+    values = [b'12345', b'1234u', b'\xF1\xF2\xF3\xF4\xD5', b'12a45']
+    assert _decode(layout, values)['count'] == [Decimal('1234.5'), Decimal('-1234.5'), Decimal('-1234.5'), None]
+
+
+def test_text_cp037():
+    layout = [{'name': 'name', 'start': 1, 'length': 6}, {'name': 'city', 'start': 7, 'length': 4}]
+    values = ['Zoë  ÉParis'.encode('cp037'), 'Ann'.encode('cp037')]
+    decoded = _decode(layout, values, encoding='cp037')
+    assert decoded['name'] == ['Zoë  É', None]
+    assert decoded['city'] == ['Pari', None]
+
+
+def test_text_latin1():
+    layout = [{'name': 'name', 'start': 1, 'length': 4}]
+    assert _decode(layout, ['Noël'.encode('latin1')])['name'] == ['Noël']
+
+
+def test_notebook_layout():
+    fields = parse_layout([(1, 3, 3, 'CUST-ID', 0, 0), (4, 6, 3, 'BALANCE', 1, 2), (7, 8, 2, 'CODE', 1, 0)])
+    assert [(field.name, field.start, field.kind, field.scale) for field in fields] == [
+        ('CUST_ID', 0, 'text', 0), ('BALANCE', 3, 'packed', 2), ('CODE', 6, 'packed', 0),
+    ]
+    decoded = _decode([(1, 3, 3, 'CUST-ID', 0, 0), (4, 6, 3, 'BALANCE', 1, 2)], [b'A01\x00\x12\x3D'])
+    assert decoded == {'rdw': [6], 'CUST_ID': ['A01'], 'BALANCE': [Decimal('-1.23')]}
+
+
+def test_invalid_layout():
+    with pytest.raises(ValueError, match="Unknown type"):
+        parse_layout([{'name': 'x', 'start': 1, 'length': 2, 'type': 'float'}])
+    with pytest.raises(ValueError, match="decimal128"):
+        parse_layout([{'name': 'x', 'start': 1, 'length': 20, 'type': 'packed'}])
@@ -0,0 +1,86 @@
+import json
+import os
+import random
+
+import pyarrow.dataset as ds
+import pytest
+from click.testing import CliRunner
+
+from ecopass.cli import main
+from ecopass.core.diff import DIFF_FILE, diff_files
+
+
+def _snapshots(write_records, deleted=range(100, 150), updated=range(300, 340), inserted=range(2000, 2030)):
+    """
+    Write an old snapshot of 1000 keyed records and a new one with records deleted, updated and inserted.
+    """
+    rng = random.Random(0)
+    old = {key: f"{key:06d}".encode() + bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 40)))
+           for key in range(1000)}
+    new = {key: data for key, data in old.items() if key not in deleted}
+    for key in updated:
+        new[key] = f"{key:06d}".encode() + b'updated'
+    for key in inserted:
+        new[key] = f"{key:06d}".encode() + b'inserted'
+    keys = sorted(new)
+    moved = keys[500:]    # the start of the file is unchanged (common prefix)
+    rng.shuffle(moved)
+    keys[500:] = moved
+    records = [(4, new[key]) for key in keys] + [(2, b'deleted record')]
+    return (write_records([(4, old[key]) for key in range(1000)], name='old.bin'),
+            write_records(records, name='new.bin'))
+
+
+def _changes(path_output):
+    table = ds.dataset(path_output, format='parquet', partitioning='hive').to_table()
+    return sorted(zip(table.column('change').to_pylist(), [value[:6] for value in table.column('value').to_pylist()]))
+
+
+@pytest.mark.parametrize('workers,max_memory', [(1, 1024 * 1024 * 1024), (2, 64 * 1024)])
+def test_diff_by_key(tmp_path, write_records, workers, max_memory):
+    path_old, path_new = _snapshots(write_records)
+    path_output = str(tmp_path / 'changes')
+    result = diff_files(path_old, path_new, path_output, key_start=0, key_length=6, workers=workers,
+                        max_memory=max_memory)
+    assert (result.inserted, result.deleted, result.updated) == (30, 50, 40)
+    assert (result.old_records, result.new_records) == (1000, 980)
+    assert result.unchanged == 910
+    assert result.prefix_records == 100
+    assert os.path.exists(os.path.join(path_output, DIFF_FILE))
+
+    expected = sorted(
+        [('delete', f"{key:06d}".encode()) for key in range(100, 150)]
+        + [('update', f"{key:06d}".encode()) for key in range(300, 340)]
+        + [('insert', f"{key:06d}".encode()) for key in range(2000, 2030)]
+    )
+    assert _changes(path_output) == expected
+
+
+def test_diff_by_content(tmp_path, write_records):
+    path_old, path_new = _snapshots(write_records)
+    result = diff_files(path_old, path_new, str(tmp_path / 'changes'))
+    # without a key an updated record is a delete and an insert
+    assert (result.inserted, result.deleted, result.updated) == (70, 90, 0)
+
+
+def test_diff_identical_files(tmp_path, write_records):
+    path_old, _ = _snapshots(write_records)
+    result = diff_files(path_old, path_old, str(tmp_path / 'changes'), key_start=0, key_length=6)
+    assert (result.inserted, result.deleted, result.updated) == (0, 0, 0)
+    assert result.prefix_records == 1000
+
+
+def test_diff_needs_both_key_options(tmp_path, write_records):
+    path_old, path_new = _snapshots(write_records)
+    with pytest.raises(ValueError, match="key_start and key_length"):
+        diff_files(path_old, path_new, str(tmp_path / 'changes'), key_start=0)
+
+
+def test_diff_with_invalid_layout(tmp_path, write_records):
+    path_old, path_new = _snapshots(write_records)
+    layout = tmp_path / 'bad.json'
+    layout.write_text(json.dumps([{'name': 'KEY', 'start': 'one', 'length': 6, 'type': 'text'}]))
+    result = CliRunner().invoke(main, ['diff', path_old, path_new, '--output', str(tmp_path / 'changes'),
+                                       '--layout', str(layout), '--key-field', 'KEY'])
+    assert result.exit_code == 1
+    assert f"Invalid layout {layout}" in result.output
@@ -0,0 +1,42 @@
+"""
+Startup of ecopass: every check runs in a fresh interpreter, so nothing is imported yet, and
+must not import the modules only the conversion commands need.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must only be imported by the commands that use them
+HEAVY_MODULES = ('numpy', 'pyarrow', 'rich', 'psutil')
+
+CHECKS = {
+    'import_record_header': "import ecopass.core.record_header",
+    'cli_help': "from ecopass.cli import main; main(['-h'], standalone_mode=False)",
+    'verify_help': "from ecopass.cli import main; main(['verify', '-h'], standalone_mode=False)",
+    'stats_help': "from ecopass.cli import main; main(['stats', '-h'], standalone_mode=False)",
+    'convert_help': "from ecopass.cli import main; main(['convert', '-h'], standalone_mode=False)",
+    'get_help': "from ecopass.cli import main; main(['get', '-h'], standalone_mode=False)",
+    'diff_help': "from ecopass.cli import main; main(['diff', '-h'], standalone_mode=False)",
+}
+
+_RUN = """
+import contextlib, io, json, sys
+with contextlib.redirect_stdout(io.StringIO()):
+    {code}
+print(json.dumps([name for name in {heavy!r} if name in sys.modules]))
+"""
+
+
+@pytest.mark.parametrize('code', CHECKS.values(), ids=list(CHECKS))
+def test_startup_imports(code):
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, 'src'))
+    output = subprocess.run(
+        [sys.executable, '-c', _RUN.format(code=code, heavy=HEAVY_MODULES)],
+        check=True, capture_output=True, text=True, env=env,
+    ).stdout
+    assert json.loads(output.splitlines()[-1]) == []
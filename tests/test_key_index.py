@@ -0,0 +1,90 @@
+import json
+import os
+
+import numpy as np
+from click.testing import CliRunner
+
+from ecopass.cli import main
+from ecopass.core.key_index import key_index_path_for
+from ecopass.core.record_header import RecordHeader
+
+
+def _record(key, text, status=4):
+    return status, f"{key:05d}".encode() + text
+
+
+RECORDS = [_record(key, b'-' * (key % 9)) for key in range(0, 500, 2)] + [
+    _record(7, b'deleted', status=2),
+    _record(9, b'', status=6),            # pointer record, the moved record is below
+    _record(9, b'moved', status=7),
+]
+
+
+def _lookup(path, key, scans=None):
+    with RecordHeader(path) as record_header:
+        if scans is not None:
+            scan_index = record_header.scan_index
+            record_header.scan_index = lambda **options: scans.append(options) or scan_index(**options)
+        record_header.load_key_index(0, 5)
+        return record_header.get_by_key(f"{key:05d}".encode())
+
+
+def _key_index(path):
+    with RecordHeader(path) as record_header:
+        return record_header.load_key_index(0, 5, build=False)
+
+
+def test_lookup_skips_deleted_and_pointer_records(write_records):
+    path = write_records(RECORDS)
+    assert _lookup(path, 4) == [(9, b'00004----')]
+    assert _lookup(path, 7) == []
+    assert _lookup(path, 9) == [(10, b'00009moved')]
+    assert os.path.exists(key_index_path_for(path))
+
+
+def test_appended_records_are_added(write_records, encode_records):
+    path = write_records(RECORDS)
+    _lookup(path, 4)
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(encode_records([_record(3, b'appended'), _record(4, b'again')]))
+
+    scans = []
+    assert _lookup(path, 3, scans) == [(13, b'00003appended')]
+    assert scans == [dict(start=size)]
+    assert _lookup(path, 4) == [(9, b'00004----'), (10, b'00004again')]
+
+    #-------------------------------------------------------------------
+    # the updated index is the one a full build gives
+    #-------------------------------------------------------------------
+    updated = _key_index(path)
+    os.remove(key_index_path_for(path))
+    _lookup(path, 4)
+    rebuilt = _key_index(path)
+    for updated_array, rebuilt_array in zip(updated, rebuilt):
+        assert np.array_equal(updated_array, rebuilt_array)
+
+
+def test_rewritten_file_is_rebuilt(write_records, encode_records):
+    path = write_records(RECORDS)
+    _lookup(path, 4)
+    data = bytearray(encode_records(RECORDS))
+    data[2:7] = b'99999'       # the key of the first record, rewritten in place
+    with open(path, 'wb') as f:
+        f.write(bytes(data) + encode_records([_record(3, b'appended')]))
+
+    scans = []
+    assert _lookup(path, 99999, scans) == [(5, b'99999')]
+    assert scans == [dict(start=0)]
+    assert _lookup(path, 0) == []
+
+
+def test_get_with_invalid_layout(tmp_path, write_records):
+    path = write_records(RECORDS)
+    layout = tmp_path / 'bad.json'
+    layout.write_text(json.dumps([{'name': 'KEY', 'start': 'one', 'length': 5, 'type': 'text'}]))
+    result = CliRunner().invoke(main, ['get', '--input', path, '--layout', str(layout), '--key-field', 'KEY',
+                                       '--key', '00002'])
+    assert result.exit_code == 1
+    assert f"Invalid layout {layout}" in result.output
+    assert "Traceback" not in result.output
@@ -0,0 +1,85 @@
+import json
+import os
+
+import pyarrow.dataset as ds
+import pytest
+from click.testing import CliRunner
+from generate import generate_file
+
+from ecopass.cli import main
+from ecopass.core.manifest import MANIFEST_FILE, expand_inputs, source_names
+from ecopass.core.record_header import RecordHeader
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """
+    Write a directory of inputs: two files, one empty file and files that are never inputs.
+    """
+    root = tmp_path / 'in'
+    (root / 'sub').mkdir(parents=True)
+    generate_file(str(root / 'a.dat'), records=500, seed=1)
+    generate_file(str(root / 'sub' / 'b.dat'), records=300, seed=2)
+    (root / 'empty.dat').write_bytes(b'')
+    (root / '_ecopass_checkpoint.json').write_text('{}')
+    (root / '.hidden').write_bytes(b'x')
+    return root
+
+
+def _records(path):
+    with RecordHeader(str(path)) as record_header:
+        return len(list(record_header.read_records()))
+
+
+def test_expand_inputs(inputs):
+    expected = [str(inputs / 'a.dat'), str(inputs / 'empty.dat'), str(inputs / 'sub' / 'b.dat')]
+    assert expand_inputs([str(inputs)]) == expected
+    assert expand_inputs([str(inputs / '**' / '*.dat')]) == expected
+    assert expand_inputs([str(inputs / 'a.dat'), str(inputs / '*.dat')]) == expected[:2]
+    with pytest.raises(ValueError, match="No input file matches"):
+        expand_inputs([str(inputs / '*.bin')])
+
+
+def test_source_names(tmp_path):
+    assert source_names([str(tmp_path / 'a.dat'), str(tmp_path / 'b c.dat')]) == ['a.dat', 'b_c.dat']
+    assert source_names([str(tmp_path / 'x' / 'a.dat'), str(tmp_path / 'y' / 'a.dat')]) == ['x__a.dat', 'y__a.dat']
+
+
+@pytest.mark.parametrize('workers', ['1', '2'])
+def test_convert_directory(tmp_path, inputs, workers):
+    path_output = str(tmp_path / 'out')
+    result = CliRunner().invoke(main, ['convert', '--input', str(inputs), '--output', path_output, '--workers', workers])
+    assert result.exit_code == 0, result.output
+
+    with open(os.path.join(path_output, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    entries = {entry['source']: entry for entry in manifest['inputs']}
+    assert sorted(entries) == ['a.dat', 'b.dat', 'empty.dat']
+    assert entries['empty.dat']['records'] == 0 and entries['empty.dat']['files'] == []
+    assert entries['a.dat']['records'] == _records(inputs / 'a.dat')
+    assert entries['b.dat']['output'] == 'source=b.dat'
+    assert manifest['records'] == _records(inputs / 'a.dat') + _records(inputs / 'sub' / 'b.dat')
+
+    table = ds.dataset(path_output, format='parquet', partitioning='hive').to_table()
+    counts = table.group_by('source').aggregate([('rdw', 'count')]).to_pydict()
+    assert dict(zip(counts['source'], counts['rdw_count'])) == {
+        'a.dat': _records(inputs / 'a.dat'), 'b.dat': _records(inputs / 'sub' / 'b.dat'),
+    }
+
+
+def test_convert_glob_then_incremental(tmp_path, inputs):
+    path_output = str(tmp_path / 'out')
+    args = ['convert', '--input', str(inputs / '*.dat'), '--output', path_output]
+    assert CliRunner().invoke(main, args).exit_code == 0
+
+    #-------------------------------------------------------------------
+    # records written to the empty file since: only they are converted
+    #-------------------------------------------------------------------
+    generate_file(str(inputs / 'empty.dat'), records=200, seed=3)
+    result = CliRunner().invoke(main, args + ['--incremental'])
+    assert result.exit_code == 0, result.output
+    with open(os.path.join(path_output, MANIFEST_FILE)) as f:
+        entries = {entry['source']: entry for entry in json.load(f)['inputs']}
+    assert entries['empty.dat']['records'] == _records(inputs / 'empty.dat')
+    assert entries['a.dat']['records'] == 0
+    assert entries['a.dat']['records_in_output'] == _records(inputs / 'a.dat')
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from ecopass.core.metrics import LATENCY_RESERVOIR, Metrics
+
+
+def test_latency_reservoir_is_bounded():
+    metrics = Metrics()
+    for i in range(3 * LATENCY_RESERVOIR):
+        metrics.observe_batch(i / 1000)
+    assert len(metrics.batch_latencies) == LATENCY_RESERVOIR
+    state = metrics.to_dict(include_latencies=False)
+    assert state['batch_latency_count'] == 3 * LATENCY_RESERVOIR
+    assert state['batch_latency_sum_seconds'] == pytest.approx(sum(range(3 * LATENCY_RESERVOIR)) / 1000)
+    assert state['batch_latency_seconds']['p50'] == pytest.approx(15, rel=0.05)
+
+
+def test_merge_keeps_the_counts():
+    parent, worker = Metrics(), Metrics()
+    for _ in range(LATENCY_RESERVOIR):
+        parent.observe_batch(1.0)
+    for _ in range(3 * LATENCY_RESERVOIR):
+        worker.observe_batch(3.0)
+    parent.merge(json.loads(json.dumps(worker.to_dict())))
+    assert parent.batch_latency_count == 4 * LATENCY_RESERVOIR
+    assert parent.batch_latency_sum == pytest.approx(10 * LATENCY_RESERVOIR)
+    assert len(parent.batch_latencies) == LATENCY_RESERVOIR
+    # the worker ran 3 batches for every batch of the parent
+    assert parent.batch_latencies.count(3.0) / LATENCY_RESERVOIR == pytest.approx(0.75, abs=0.02)
+
+
+def test_prometheus_summary(tmp_path):
+    metrics = Metrics()
+    for seconds in (0.1, 0.2, 0.3):
+        metrics.observe_batch(seconds)
+    path = tmp_path / 'metrics.prom'
+    metrics.write_prometheus(str(path), input='file.bin')
+    lines = path.read_text().splitlines()
+    summary = [line for line in lines if line.startswith('ecopass_batch_latency_seconds')]
+    assert "# TYPE ecopass_batch_latency_seconds summary" in lines
+    assert 'ecopass_batch_latency_seconds{input="file.bin",quantile="0.5"} 0.2' in summary
+    assert 'ecopass_batch_latency_seconds_sum{input="file.bin"} 0.6' in summary
+    assert 'ecopass_batch_latency_seconds_count{input="file.bin"} 3' in summary
+
+
+def test_disabled_metrics_collect_nothing():
+    metrics = Metrics(enabled=False)
+    metrics.observe_batch(1.0)
+    metrics.add('batches')
+    assert metrics.batch_latency_count == 0 and metrics.counters == {}
@@ -0,0 +1,59 @@
+import glob
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from click.testing import CliRunner
+
+from ecopass.cli import main
+from ecopass.core.partitioned_writer import BYTE_STREAM_SPLIT_PYARROW, PartitionedWriter, byte_stream_split_columns
+from ecopass.core.record_header import record_schema
+
+RECORDS = [(4, bytes([i % 251]) * (20 + 20 * (i % 3))) for i in range(300)]
+NEW_PYARROW = int(pa.__version__.split('.')[0]) >= BYTE_STREAM_SPLIT_PYARROW
+
+
+def _encodings(path_output, column):
+    encodings = set()
+    for path in glob.glob(f"{path_output}/**/*.parquet", recursive=True):
+        metadata = pq.ParquetFile(path).metadata
+        for row_group in range(metadata.num_row_groups):
+            chunk = metadata.row_group(row_group)
+            names = [chunk.column(i).path_in_schema for i in range(chunk.num_columns)]
+            encodings.update(chunk.column(names.index(column)).encodings)
+    return encodings
+
+
+def test_byte_stream_split_columns(monkeypatch):
+    assert byte_stream_split_columns(record_schema()) == []
+    assert byte_stream_split_columns(pa.schema([('x', pa.float64()), ('rdw', pa.int32())])) == ['x']
+    monkeypatch.setattr(pa, '__version__', f'{BYTE_STREAM_SPLIT_PYARROW}.0.0')
+    assert byte_stream_split_columns(record_schema(), fixed_size=True) == ['value']
+    assert byte_stream_split_columns(record_schema(True), partition_col='status') == ['rdw']
+    monkeypatch.setattr(pa, '__version__', f'{BYTE_STREAM_SPLIT_PYARROW - 1}.0.0')
+    assert byte_stream_split_columns(record_schema(), fixed_size=True) == []
+
+
+def test_byte_stream_split_without_effect_is_refused(tmp_path, write_records):
+    path = write_records(RECORDS)
+    result = CliRunner().invoke(main, ['convert', '--input', path, '--output', str(tmp_path / 'out'),
+                                       '--byte-stream-split'])
+    assert result.exit_code == 2
+    assert "--byte-stream-split has no effect" in result.output
+
+
+@pytest.mark.skipif(not NEW_PYARROW, reason=f"needs pyarrow {BYTE_STREAM_SPLIT_PYARROW} or later")
+def test_byte_stream_split_fixed_size_values(tmp_path, write_records):
+    path = write_records(RECORDS)
+    path_output = str(tmp_path / 'out')
+    result = CliRunner().invoke(main, ['convert', '--input', path, '--output', path_output,
+                                       '--byte-stream-split', '--fixed-size-values', '--no-dictionary'])
+    assert result.exit_code == 0, result.output
+    assert 'BYTE_STREAM_SPLIT' in _encodings(path_output, 'value')
+
+
+def test_partition_file_warns_without_splittable_column(tmp_path):
+    batch = pa.record_batch([pa.array([3], pa.int32()), pa.array([b'abc'])], schema=record_schema())
+    with pytest.warns(UserWarning, match="use_byte_stream_split has no effect"):
+        with PartitionedWriter(str(tmp_path), use_byte_stream_split=True) as writer:
+            writer.write_batch(batch)
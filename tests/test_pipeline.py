@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+from click.testing import CliRunner
+from generate import generate_file
+
+from ecopass.cli import main
+from ecopass.core.checkpoint import CHECKPOINT_FILE, Checkpoint
+from ecopass.core.partitioned_writer import PartitionedWriter
+from ecopass.core.pipeline import _Writer, _route, convert_pipelined, pipeline_budget
+from ecopass.core.record_header import RecordHeader, record_schema
+
+PIPELINE = ['--pipeline', '--writer-threads', '3', '--max-memory', '16']
+
+
+def _convert(*args):
+    return CliRunner().invoke(main, ['convert', *args])
+
+
+def _rows(path_output):
+    table = ds.dataset(path_output, format='parquet', partitioning='hive').to_table()
+    return sorted(zip(table.column('rdw').to_pylist(), table.column('value').to_pylist()))
+
+
+def _expected(path_input):
+    with RecordHeader(path_input) as record_header:
+        return sorted(record_header.read_records())
+
+
+def _checkpoint(path_output):
+    with open(os.path.join(path_output, CHECKPOINT_FILE)) as f:
+        return json.load(f)
+
+
+def _run(target, timeout=60):
+    """
+    Run target in a thread and return the error it raised; fail if it doesn't end (a hang).
+    """
+    errors = []
+
+    def run():
+        try:
+            target()
+        except BaseException as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the pipeline hangs"
+    return errors[0] if errors else None
+
+
+def test_pipeline_budget():
+    budget = pipeline_budget(16 * 1024 * 1024, 3)
+    in_flight = 4 + 3 * 4 + 3 + 2
+    assert budget.batch_bytes * in_flight <= 8 * 1024 * 1024
+    assert budget.max_buffered_bytes * 3 <= 8 * 1024 * 1024
+    assert budget.row_group_bytes <= budget.max_buffered_bytes
+
+
+def test_pipeline_matches_sequential(tmp_path):
+    path_input = str(tmp_path / 'input.bin')
+    generate_file(path_input, records=20000, lengths='uniform:1:400', run_length=5, seed=4)
+    sequential, pipelined = str(tmp_path / 'sequential'), str(tmp_path / 'pipelined')
+    assert _convert('--input', path_input, '--output', sequential).exit_code == 0
+    result = _convert('--input', path_input, '--output', pipelined, *PIPELINE, '--checkpoint-every', '1')
+    assert result.exit_code == 0, result.output
+    assert _rows(pipelined) == _rows(sequential)
+    assert _checkpoint(pipelined)['ranges'] == [[0, os.path.getsize(path_input)]]
+    assert _checkpoint(pipelined)['records'] == 20000
+
+
+def test_route_by_partition():
+    failed = threading.Event()
+    writers = [_Writer(number, None, failed) for number in range(3)]
+    rdw = pa.array(np.arange(30, dtype=np.int32) % 7)
+    batch = pa.record_batch([rdw, pa.array([b'x'] * 30)], schema=record_schema())
+    _route(batch, writers, 'rdw', failed)
+    for number, writer in enumerate(writers):
+        routed = writer.queue.get_nowait().column('rdw').to_pylist()
+        assert routed and all(length % 3 == number for length in routed)
+        assert writer.queue.empty()
+
+
+@pytest.mark.parametrize('stage', ['writer', 'reader'])
+def test_failing_stage(tmp_path, monkeypatch, stage):
+    path_input = str(tmp_path / 'input.bin')
+    generate_file(path_input, records=20000, lengths='choice:100,200', seed=5)
+    calls = []
+
+    if stage == 'writer':
+        write_batch = PartitionedWriter.write_batch
+
+        def failing(self, batch):
+            calls.append(1)
+            if len(calls) == 3:
+                raise RuntimeError("disk full")
+            write_batch(self, batch)
+        monkeypatch.setattr(PartitionedWriter, 'write_batch', failing)
+    else:
+        read = RecordHeader.read_positioned_batches
+
+        def failing(self, *args, **kwargs):
+            for item in read(self, *args, **kwargs):
+                calls.append(1)
+                if len(calls) == 3:
+                    raise RuntimeError("disk full")
+                yield item
+        monkeypatch.setattr(RecordHeader, 'read_positioned_batches', failing)
+
+    path_output = str(tmp_path / 'out')
+    checkpoint = Checkpoint(path_output, path_input, 2, 2)
+
+    def convert():
+        with RecordHeader(path_input) as record_header:
+            convert_pipelined(record_header, path_output, checkpoint, [(0, os.path.getsize(path_input))],
+                              writer_threads=3, max_memory=1024 * 1024, batch_size=1000)
+
+    error = _run(convert)
+    assert isinstance(error, RuntimeError) and str(error) == "disk full"
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('ecopass-')]
+
+
+def test_interrupted_pipeline_checkpoint(tmp_path, monkeypatch):
+    path_input = str(tmp_path / 'input.bin')
+    path_output = str(tmp_path / 'out')
+    generate_file(path_input, records=40000, lengths='choice:100,200', seed=3)
+    expected = _expected(path_input)
+
+    #-------------------------------------------------------------------
+    # a writer fails after a few commits (one commit every MB)
+    #-------------------------------------------------------------------
+    write_batch = PartitionedWriter.write_batch
+    calls = []
+
+    def failing_write_batch(self, batch):
+        calls.append(batch.num_rows)
+        if len(calls) == 12:
+            raise RuntimeError("disk full")
+        write_batch(self, batch)
+
+    monkeypatch.setattr(PartitionedWriter, 'write_batch', failing_write_batch)
+    result = _convert('--input', path_input, '--output', path_output, *PIPELINE, '--checkpoint-every', '1')
+    assert result.exit_code != 0
+    interrupted = _checkpoint(path_output)
+    assert 0 < interrupted['records'] < len(expected)
+    committed = sum(pq.read_metadata(os.path.join(path_output, path)).num_rows for path in interrupted['files'])
+    assert committed == interrupted['records']
+    monkeypatch.setattr(PartitionedWriter, 'write_batch', write_batch)
+
+    #-------------------------------------------------------------------
+    # the resumed run converts the rest: every record once
+    #-------------------------------------------------------------------
+    result = _convert('--input', path_input, '--output', path_output, *PIPELINE, '--resume')
+    assert result.exit_code == 0, result.output
+    resumed = _checkpoint(path_output)
+    assert resumed['ranges'] == [[0, os.path.getsize(path_input)]]
+    assert resumed['records'] == len(expected)
+    assert _rows(path_output) == expected
@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import pytest
+from generate import generate_file
+
+from ecopass.core.record_header import RecordHeader
+
+ALL_STATUSES = range(16)
+
+
+def _records(path, header_size, alignment, **options):
+    with RecordHeader(path, header_size=header_size, alignment=alignment, **options) as record_header:
+        return list(record_header.read_records())
+
+
+def _batches(path, header_size, alignment, max_bytes=None, **options):
+    with RecordHeader(path, header_size=header_size, alignment=alignment, **options) as record_header:
+        batches = list(record_header.read_batches(max_rows=1000, max_bytes=max_bytes))
+    return [(length, value) for batch in batches
+            for length, value in zip(batch.column('rdw').to_pylist(), batch.column('value').to_pylist())]
+
+
+@pytest.mark.parametrize('header_size', [2, 4])
+@pytest.mark.parametrize('alignment', [1, 2, 4, 8])
+@pytest.mark.parametrize('lengths,run_length', [('uniform:0:300', 1), ('choice:3,5,7,400', 20), ('fixed:100', 1)])
+def test_scan_index_matches_read_records(tmp_path, header_size, alignment, lengths, run_length):
+    path = str(tmp_path / 'input.bin')
+    generate_file(path, records=3000, header_size=header_size, alignment=alignment, lengths=lengths,
+                  run_length=run_length, seed=alignment)
+    expected = _records(path, header_size, alignment, include_statuses=ALL_STATUSES)
+    with RecordHeader(path, header_size=header_size, alignment=alignment) as record_header:
+        index = record_header.scan_index()
+        chunks = list(record_header._scan_chunks(max_records=700))
+    assert index.lengths.tolist() == [length for length, _ in expected]
+    assert index.end == os.path.getsize(path)
+    assert np.array_equal(np.concatenate([chunk.offsets for chunk in chunks]), index.offsets)
+
+
+def test_scan_index_truncated_file(tmp_path):
+    path = str(tmp_path / 'input.bin')
+    generate_file(path, records=2000, lengths='uniform:10:300')
+    size = os.path.getsize(path)
+    with RecordHeader(path) as record_header:
+        offsets = record_header.scan_index().offsets
+    with open(path, 'r+b') as f:
+        f.truncate(size - 5)
+
+    with RecordHeader(path) as record_header:
+        with pytest.raises(ValueError, match=f"Incomplete data at position {offsets[-1]}"):
+            record_header.scan_index()
+        index = record_header.scan_index(strict=False)
+    assert np.array_equal(index.offsets, offsets[:-1])
+    assert index.end == offsets[-1]
+
+
+@pytest.mark.parametrize('header_size', [2, 4])
+@pytest.mark.parametrize('alignment', [1, 2, 4, 8])
+@pytest.mark.parametrize('lengths,run_length', [('uniform:0:300', 1), ('choice:3,5,7,400', 20), ('fixed:100', 1)])
+def test_read_batches_matches_read_records(tmp_path, header_size, alignment, lengths, run_length):
+    path = str(tmp_path / 'input.bin')
+    generate_file(path, records=3000, header_size=header_size, alignment=alignment, lengths=lengths,
+                  run_length=run_length, seed=alignment)
+    expected = _records(path, header_size, alignment)
+    assert expected
+    assert _batches(path, header_size, alignment) == expected
+    assert _batches(path, header_size, alignment, max_bytes=4096) == expected
+
+
+def test_read_batches_of_shards(tmp_path):
+    path = str(tmp_path / 'input.bin')
+    generate_file(path, records=5000)
+    with RecordHeader(path) as record_header:
+        boundaries = record_header.shard_boundaries(4)
+        rows = [row for start, stop in boundaries for batch in record_header.read_batches(start=start, stop=stop)
+                for row in zip(batch.column('rdw').to_pylist(), batch.column('value').to_pylist())]
+    assert len(boundaries) == 4
+    assert rows == _records(path, 2, 2)
+
+
+def test_read_batches_filters(tmp_path):
+    path = str(tmp_path / 'input.bin')
+    generate_file(path, records=2000, lengths='choice:10,20,30')
+    options = dict(include_statuses=[4], record_length=[10, 30])
+    expected = _records(path, 2, 2, **options)
+    assert expected and all(length in (10, 30) for length, _ in expected)
+    assert _batches(path, 2, 2, **options) == expected
+
+
+def test_record_access(tmp_path):
+    path = str(tmp_path / 'input.bin')
+    generate_file(path, records=2000, lengths='uniform:0:300', seed=6)
+    expected = _records(path, 2, 2)
+    with RecordHeader(path) as record_header:
+        assert len(record_header) == len(expected)
+        assert record_header.get_record(0) == expected[0]
+        assert record_header.get_record(1234) == expected[1234]
+        assert record_header.get_record(-1) == expected[-1]
+        assert record_header.get_record(-len(expected)) == expected[0]
+        for n in (len(expected), -len(expected) - 1):
+            with pytest.raises(IndexError, match="out of range"):
+                record_header.get_record(n)
+        assert list(record_header.iter_range(500, 700)) == expected[500:700]
+        assert list(record_header.iter_range(-10)) == expected[-10:]
+        assert list(record_header.iter_range(1990, 5000)) == expected[1990:]
+    assert os.path.exists(path + '.ecpidx')
+
+
+def test_record_access_filtered(write_records):
+    records = [((4, 5, 7)[i % 3], bytes([i % 251]) * (10 + i % 4)) for i in range(900)]
+    path = write_records(records)
+    with RecordHeader(path, include_statuses=[4, 7], record_length=[10, 11, 12]) as record_header:
+        expected = list(record_header.read_records())
+        assert len(record_header) == len(expected) < 900
+        assert [record_header.get_record(n) for n in range(len(expected))] == expected
+        assert record_header.get_record(-1) == expected[-1]
+        assert list(record_header.iter_range(100, 200)) == expected[100:200]
+
+
+def test_stale_index_is_rebuilt(write_records):
+    path = write_records([(4, b'a' * (i % 50)) for i in range(1000)])
+    with RecordHeader(path) as record_header:
+        record_header.load_index()
+        assert len(record_header) == 1000
+
+    #-------------------------------------------------------------------
+    # the file is rewritten with other records: the .ecpidx no longer matches it
+    #-------------------------------------------------------------------
+    stat = os.stat(path + '.ecpidx')
+    path = write_records([(4, b'b' * (i % 30)) for i in range(1500)])
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with RecordHeader(path) as record_header:
+        expected = list(record_header.read_records())
+        assert len(record_header) == 1500
+        assert record_header.get_record(-1) == expected[-1]
+        assert list(record_header.iter_range(700, 800)) == expected[700:800]
+    with RecordHeader(path) as record_header:
+        assert record_header.load_index(build=False) is not None
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from ecopass.cli import main
+from ecopass.core.record_header import RecordHeader
+
+RECORDS = [(4, b'abc'), (2, b'abcd'), (4, b'abcdefg'), (1, b'xyz')]
+
+
+def _stats(tmp_path, data, header_size=2, alignment=4):
+    path = tmp_path / 'input.bin'
+    path.write_bytes(data)
+    with RecordHeader(str(path), header_size=header_size, alignment=alignment) as record_header:
+        return record_header.stats()
+
+
+def test_stats_totals(tmp_path, encode_records):
+    stats = _stats(tmp_path, encode_records(RECORDS, 2, 4))
+    assert stats.records == 4
+    assert stats.data_bytes == 17
+    assert {status: s.records for status, s in stats.by_status.items()} == {1: 1, 2: 1, 4: 2}
+    assert stats.deleted_bytes == 8
+    assert [record.length for record in stats.largest] == [7, 4, 3, 3]
+
+
+@pytest.mark.parametrize('cut', [0, 1, 3])
+def test_stats_last_padding_missing(tmp_path, encode_records, cut):
+    data = encode_records(RECORDS, 2, 4)
+    stats = _stats(tmp_path, data[:len(data) - cut])
+    assert stats.size == len(data) - cut
+    assert stats.header_bytes + stats.data_bytes + stats.padding_bytes == stats.size
+    assert sum(s.bytes for s in stats.by_status.values()) == stats.size
+    assert stats.by_status[1].padding_bytes == 3 - cut
+    assert stats.trailing_bytes == 0
+
+
+def test_stats_empty_file(tmp_path):
+    stats = _stats(tmp_path, b'')
+    assert (stats.size, stats.records, stats.padding_bytes, stats.trailing_bytes) == (0, 0, 0, 0)
+    assert stats.by_status == {} and stats.largest == []
+    assert stats.padding_overhead == 0.0
+
+    result = CliRunner().invoke(main, ['stats', '--input', str(tmp_path / 'input.bin'), '--json'])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)[0]['records'] == 0
@@ -0,0 +1,61 @@
+import glob
+import os
+
+import pyarrow as pa
+import pytest
+from click.testing import CliRunner
+
+from ecopass.cli import main
+
+RECORDS = [((4, 2, 7, 8)[i % 4], bytes([i % 251]) * (5 + i % 40)) for i in range(2000)]
+CONVERTED = [(status, data) for status, data in RECORDS if status != 8]  # 8 is not converted by default
+
+
+def _runner():
+    """CliRunner keeping stderr out of stdout (click < 8.2 mixes them by default)."""
+    try:
+        return CliRunner(mix_stderr=False)
+    except TypeError:
+        return CliRunner()
+
+
+def _expected(records, with_status=False):
+    return sorted((len(data), data, status) if with_status else (len(data), data) for status, data in records)
+
+
+def test_stream_to_stdout(write_records):
+    path = write_records(RECORDS)
+    result = _runner().invoke(main, ['convert', '--input', path, '--output', '-', '--batch-size', '300'])
+    assert result.exit_code == 0, result.stderr
+
+    #-------------------------------------------------------------------
+    # stdout holds one Arrow IPC stream and nothing else (the progress goes to stderr)
+    #-------------------------------------------------------------------
+    source = pa.BufferReader(result.stdout_bytes)
+    table = pa.ipc.open_stream(source).read_all()
+    assert source.tell() == len(result.stdout_bytes)
+    assert table.num_rows == len(CONVERTED)
+    assert sorted(zip(table.column('rdw').to_pylist(), table.column('value').to_pylist())) == _expected(CONVERTED)
+    assert "Processing batch" in result.stderr
+
+
+@pytest.mark.parametrize('file_format,extension', [('arrow', '.arrow'), ('arrow-stream', '.arrows')])
+def test_arrow_files_by_status(tmp_path, write_records, file_format, extension):
+    path = write_records(RECORDS)
+    path_output = str(tmp_path / 'out')
+    result = CliRunner().invoke(main, ['convert', '--input', path, '--output', path_output,
+                                       '--format', file_format, '--split-by', 'status'])
+    assert result.exit_code == 0, result.output
+
+    assert sorted(os.listdir(path_output)) == ['_ecopass_checkpoint.json', 'status=2', 'status=4', 'status=7']
+    paths = glob.glob(os.path.join(path_output, 'status=*', '*'))
+    assert paths and all(path.endswith(extension) for path in paths)
+    open_file = pa.ipc.open_file if file_format == 'arrow' else pa.ipc.open_stream
+    rows = []
+    for path in paths:
+        status = int(os.path.basename(os.path.dirname(path)).split('=')[1])
+        with pa.OSFile(path) as source:
+            table = open_file(source).read_all()
+        rows += [(length, value, status) for length, value in
+                 zip(table.column('rdw').to_pylist(), table.column('value').to_pylist())]
+    assert sorted(rows) == _expected(CONVERTED, with_status=True)
@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from ecopass.cli import main
+from ecopass.core.record_header import RecordHeader
+from ecopass.core.verify import SKIPPED_FILE, BadRegion, verify_file
+
+GOOD = [(4, bytes([i]) * (10 + i % 7)) for i in range(40)]
+GARBAGE = b'\xf0\x3e' + b'\xff' * 62     # a record of status 15, then 0xff bytes
+
+
+@pytest.fixture
+def corrupt_file(tmp_path, encode_records):
+    """
+    Write 20 good records, 64 bytes of garbage and 20 good records, return the path and the region.
+    """
+    head, tail = encode_records(GOOD[:20]), encode_records(GOOD[20:])
+    path = tmp_path / 'bad.bin'
+    path.write_bytes(head + GARBAGE + tail)
+    return str(path), BadRegion(len(head), len(head) + len(GARBAGE), "invalid status 15")
+
+
+def test_verify_valid_file(write_records):
+    path = write_records(GOOD)
+    with RecordHeader(path) as record_header:
+        report = verify_file(record_header)
+    assert report.records == len(GOOD)
+    assert report.regions == [] and report.trailing_bytes == 0
+
+
+def test_verify_finds_the_bad_region(corrupt_file):
+    path, region = corrupt_file
+    with RecordHeader(path) as record_header:
+        report = verify_file(record_header)
+    assert report.records == len(GOOD)
+    assert report.regions == [region]
+    assert report.bad_bytes == len(GARBAGE)
+
+
+def test_verify_padding_and_max_length(tmp_path, encode_records):
+    data = bytearray(encode_records(GOOD))
+    data[2 + 10 + 2 + 11] = 1     # padding byte of the second record (length 11)
+    path = tmp_path / 'padding.bin'
+    path.write_bytes(bytes(data))
+    path = str(path)
+    with RecordHeader(path) as record_header:
+        assert verify_file(record_header).regions[0].reason == "padding is not zero"
+        assert verify_file(record_header, check_padding=False).regions == []
+        report = verify_file(record_header, max_length=15, check_padding=False)
+    assert report.regions[0].reason == "length 16 over the maximum of 15"
+
+
+def test_tolerant_read_resyncs(corrupt_file):
+    path, region = corrupt_file
+    with RecordHeader(path, tolerant=True) as record_header:
+        rows = [(length, value) for batch in record_header.read_batches()
+                for length, value in zip(batch.column('rdw').to_pylist(), batch.column('value').to_pylist())]
+        skipped = record_header.skipped
+    assert rows == [(len(data), data) for _, data in GOOD]
+    assert skipped == [region]
+
+
+def test_verify_command(corrupt_file):
+    path, region = corrupt_file
+    result = CliRunner().invoke(main, ['verify', '--input', path, '--json'])
+    assert result.exit_code == 1
+    report = json.loads(result.output)[0]
+    assert report['records'] == len(GOOD)
+    assert report['regions'] == [region._asdict()]
+
+
+def test_tolerant_convert(tmp_path, corrupt_file):
+    path, region = corrupt_file
+    path_output = str(tmp_path / 'out')
+    result = CliRunner().invoke(main, ['convert', '--input', path, '--output', path_output, '--tolerant'])
+    assert result.exit_code == 0, result.output
+    with open(os.path.join(path_output, SKIPPED_FILE)) as f:
+        assert json.load(f)['regions'] == [region._asdict()]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_strict_convert_of_a_truncated_file(tmp_path, encode_records, workers):
+    path = tmp_path / 'truncated.bin'
+    path.write_bytes(encode_records(GOOD) + b'\x40\x50' + bytes(10))   # 80 bytes announced, 10 left
+    result = CliRunner().invoke(main, ['convert', '--input', str(path), '--output', str(tmp_path / 'out'),
+                                       '--workers', str(workers)])
+    assert result.exit_code == 1
+    assert f"{path}: Incomplete data at position {len(encode_records(GOOD))}" in result.output
+    assert "see ecopass verify, or use --tolerant" in result.output
+    assert "Traceback" not in result.output
+
+
+def test_verify_empty_file(tmp_path):
+    path = tmp_path / 'empty.dat'
+    path.write_bytes(b'')
+    result = CliRunner().invoke(main, ['verify', '--input', str(path), '--json'])
+    assert result.exit_code == 0, result.output
+    report = json.loads(result.output)[0]
+    assert report['records'] == 0
+    assert report['regions'] == []